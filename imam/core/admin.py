@@ -4,13 +4,13 @@ __author__ = 'www.grillazz.com'
 
 from django.contrib import admin
 from django.contrib.admin import site
-import adminactions.actions as actions
+from .lazy import lazy_action
 from .models import Personnel, Program, Item, ProgramReport#, LowStockAlert
 
-# register all adminactions
-site.add_action(actions.export_as_fixture)
-site.add_action(actions.export_as_csv)
-site.add_action(actions.mass_update)
+# register all adminactions (imported when first used)
+site.add_action(lazy_action('adminactions.actions', 'export_as_fixture'))
+site.add_action(lazy_action('adminactions.actions', 'export_as_csv'))
+site.add_action(lazy_action('adminactions.actions', 'mass_update'))
 
 
 class personelAdmin(admin.ModelAdmin, ):
@@ -0,0 +1,172 @@
+"""In-process cache for resolving short codes (item, position, group, program
+and site codes) to model instances.
+
+Reference tables change rarely while every inbound SMS resolves several codes,
+so results are kept in a bounded LRU with a TTL.  Entries are keyed on the
+upper-cased code and dropped for a whole model whenever an instance of that
+model is saved or deleted.  Other worker processes only notice changes once
+their own entries expire, so keep CODE_CACHE_TTL short enough for that.
+"""
+from __future__ import unicode_literals
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+
+DEFAULT_MAX_SIZE = 2048
+DEFAULT_TTL = 600  # seconds
+
+
+def _model_label(model):
+    return '{}.{}'.format(model._meta.app_label, model._meta.model_name)
+
+
+def normalize_code(code):
+    """Canonical form of a code as used for cache keys."""
+    if isinstance(code, basestring):
+        return code.strip().upper()
+    return code
+
+
+class CodeCache(object):
+    """Bounded, time-limited cache of code -> model instance lookups.
+
+    Codes which do not resolve to anything are cached as well (as None) so
+    that malformed messages do not hit the database repeatedly.  Setting
+    either max_size or ttl to 0 disables caching.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    @staticmethod
+    def make_key(model, code):
+        return _model_label(model), normalize_code(code)
+
+    def resolve(self, model, code, loader):
+        """Return the instance of model matching code, calling loader with
+        the normalised code on a cache miss.  A copy of the cached instance
+        is returned so that callers may modify it without affecting other
+        callers.
+        """
+        code = normalize_code(code)
+        if code is None or not self.enabled:
+            return loader(code)
+
+        key = self.make_key(model, code)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                # re-insert to mark the entry as most recently used
+                self._entries[key] = entry
+                self.hits += 1
+                return copy.copy(entry[1])
+            self.misses += 1
+
+        obj = loader(code)
+        self._store(key, obj)
+
+        return copy.copy(obj)
+
+    def resolve_many(self, model, codes, loader):
+        """Resolve several codes at once.  Codes not found in the cache are
+        passed (normalised) to loader(codes) in a single call; it must return
+        a dict mapping each of them to an instance or None.
+
+        Returns a dict mapping every normalised code to an instance or None.
+        """
+        codes = set(normalize_code(c) for c in codes if c is not None)
+        resolved = {}
+        pending = []
+
+        if not self.enabled:
+            pending = list(codes)
+        else:
+            current_time = time.time()
+            with self._lock:
+                for code in codes:
+                    key = self.make_key(model, code)
+                    entry = self._entries.pop(key, None)
+                    if entry is not None and entry[0] > current_time:
+                        self._entries[key] = entry
+                        self.hits += 1
+                        resolved[code] = copy.copy(entry[1])
+                    else:
+                        self.misses += 1
+                        pending.append(code)
+
+        if pending:
+            loaded = loader(pending)
+            for code in pending:
+                obj = loaded.get(code)
+                if self.enabled:
+                    self._store(self.make_key(model, code), obj)
+                resolved[code] = copy.copy(obj)
+
+        return resolved
+
+    def _store(self, key, obj):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, obj)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, model=None):
+        """Drop all entries for model, or everything if no model is given."""
+        with self._lock:
+            if model is None:
+                self._entries.clear()
+                return
+            label = _model_label(model)
+            for key in [k for k in self._entries if k[0] == label]:
+                del self._entries[key]
+
+    def register(self, model):
+        """Invalidate the entries of model whenever one of its instances is
+        saved or deleted."""
+        uid = 'codecache-{}'.format(_model_label(model))
+        post_save.connect(self._on_change, sender=model,
+                          dispatch_uid=uid + '-save')
+        post_delete.connect(self._on_change, sender=model,
+                            dispatch_uid=uid + '-delete')
+
+    def _on_change(self, sender, **kwargs):
+        self.invalidate(sender)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+
+code_cache = CodeCache(
+    max_size=getattr(settings, 'CODE_CACHE_MAX_SIZE', DEFAULT_MAX_SIZE),
+    ttl=getattr(settings, 'CODE_CACHE_TTL', DEFAULT_TTL),
+)
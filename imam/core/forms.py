@@ -5,6 +5,7 @@ from django.forms.util import ErrorList
 from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext_lazy as _
 from locations.models import Location
+from .codecache import normalize_code
 from .models import Item, PatientGroup, Position, Program, ProgramReport
 
 PROGRAM_MAP = {'i': 'IPF', 'o': 'OTP', 'm': 'SFP'}
@@ -474,9 +475,18 @@ class OTPReportForm(ProgramReportForm):
 class ItemForm(HandlerForm):
     item_code = forms.CharField()
 
+    def __init__(self, *args, **kwargs):
+        # optional code -> Item mapping from Item.get_code_map(), used when
+        # several forms are validated for the same message
+        self.item_map = kwargs.pop('item_map', None)
+        super(ItemForm, self).__init__(*args, **kwargs)
+
     def clean_item_code(self):
         item_code = self.cleaned_data.get('item_code')
-        item = Item.get_by_code(item_code)
+        if self.item_map is None:
+            item = Item.get_by_code(item_code)
+        else:
+            item = self.item_map.get(normalize_code(item_code))
         if not item:
             raise forms.ValidationError(_(
                 '*Error in stock code* Please correct the stock codes entered in the SMS and resend.'))
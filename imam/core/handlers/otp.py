@@ -5,7 +5,7 @@ import reversion
 
 from .base import BaseHandler
 from ..forms import OTPReportForm
-from ..models import Program, ProgramReport
+from ..models import LocationProgramState, Program, ProgramReport
 from locations.models import Location
 
 
@@ -71,6 +71,8 @@ class OTPReportHandler(BaseHandler):
                 report.patients_at_period_start = \
                     prior_report.patients_at_period_end
             report.save()
+            LocationProgramState.register_data_arrival(report.program_id,
+                                                       report.site_id)
 
             summary = report.summary()
 
@@ -1,12 +1,13 @@
 from __future__ import unicode_literals
 from itertools import izip_longest
 from django.conf import settings
+from django.db import transaction
 from django.utils.translation import ugettext_lazy as _
 import reversion
 from unidecode import unidecode
 from .base import BaseHandler
 from ..forms import InventoryReportForm
-from ..models import InventoryLog, Location, StockOutReport, StockReport
+from ..models import Item, Location, StockOutReport, StockReport
 from ..utils import chunker
 # from messagebox.tasks import send_sms
 
@@ -36,9 +37,11 @@ class StockReportHandler(BaseHandler):
         sender = contact.worker
         site = parsed.get('site')
         report_data = []
+        item_map = Item.get_code_map(
+            [report.get('item_code') for report in parsed['reports']])
 
         for report in parsed['reports']:
-            form = self.form_class(data=report)
+            form = self.form_class(data=report, item_map=item_map)
 
             if form.is_valid():
                 report_data.append(form.save())
@@ -107,11 +110,9 @@ class StockReportHandler(BaseHandler):
 
             return response
 
-        with reversion.create_revision():
-            site_stock_outs = list(StockOutReport.objects.filter(site__pk=site.pk))
+        with transaction.atomic(), reversion.create_revision():
             report_items = set()
             exhausted_items = set()
-            inventory_logs = []
 
             for report in report_data:
                 report_items.add(report['item'])
@@ -119,30 +120,15 @@ class StockReportHandler(BaseHandler):
                 if report['current_stock'] <= 0:
                     exhausted_items.add(report['item'])
 
-                inventory_log = InventoryLog.objects.create(item=report['item'],
-                                                            last_quantity_received=report[
-                                                                'last_receipt'],
-                                                            current_holding=report['current_stock'])
-                inventory_logs.append(inventory_log)
+            stock_report = StockReport.create_with_logs(site, sender,
+                                                        report_data)
 
-            # clear pending stock alerts
+            # clear pending stock alerts and create stock alerts for
+            # exhausted items
             stocked_items = report_items - exhausted_items
-            for stock_out in site_stock_outs:
-                stock_out.remove(*stocked_items)
-
-            stock_report = StockReport.objects.create(reporter=sender, site=site)
-            stock_report.logs.add(*inventory_logs)
-
-            # create stock alerts for exhausted items
-            if exhausted_items:
-                stock_out = report = StockOutReport.create_stockout_report(site, sender, *exhausted_items)
-                # district_heads = site.parent.workers.filter(
-                #     position=DISTRICT_HEAD_POS)
-                # alert_message = _('Stock outs of {items} were reported at {site_name} with the site ID {site_id} on {date}').format(
-                #     items=stock_out.summary, site_name=site.name, site_id=site.hcid, date=stock_out.modified.strftime('%d/%m/%y'))
-
-                # recipients = [dh.mobile for dh in district_heads]
-                # send_sms.delay(alert_message, *recipients)
+            stock_out = StockOutReport.update_site_items(
+                site, sender, stocked_items, exhausted_items)
+            if stock_out is not None:
                 stock_out.generate_notification()
 
             # generate or clear any low stock alerts as necessary
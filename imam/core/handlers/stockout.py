@@ -6,7 +6,7 @@ from unidecode import unidecode
 from locations.models import Location
 from .base import BaseHandler
 from ..forms import ItemForm
-from ..models import StockOutReport
+from ..models import Item, StockOutReport
 
 # from messagebox.tasks import send_sms
 
@@ -39,9 +39,11 @@ class StockoutReportHandler(BaseHandler):
         items = []
         sender = contact.worker
         site = parsed.get('site')
+        item_map = Item.get_code_map(parsed['item_codes'])
 
         for code in parsed['item_codes']:
-            form = self.form_class(data={'item_code': code})
+            form = self.form_class(data={'item_code': code},
+                                   item_map=item_map)
 
             if form.is_valid():
                 items.append(form.save()['item'])
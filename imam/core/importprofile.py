@@ -0,0 +1,137 @@
+"""Measures how long each module takes to import while Django starts up.
+
+Run as a script (by the profile_startup management command) in a fresh
+interpreter, since modules which are already loaded cost nothing to import:
+
+    python -m core.importprofile [--urls] [--handlers] [--limit N]
+
+Only the standard library is imported before the import hook is installed so
+that everything Django, the settings and the installed apps load is measured.
+"""
+from __future__ import print_function, unicode_literals
+import __builtin__
+import sys
+import time
+from optparse import OptionParser
+
+
+def _package(globals):
+    """Returns the package relative imports in globals are resolved from."""
+    if not globals:
+        return None
+    package = globals.get('__package__')
+    if package:
+        return package
+    name = globals.get('__name__')
+    if not name:
+        return None
+    if '__path__' in globals:
+        return name
+    return name.rpartition('.')[0] or None
+
+
+class ImportTimer(object):
+    """Wraps __import__ to record, for each module loaded for the first time,
+    the time spent importing it including (cumulative) and excluding (own)
+    the modules it imports in turn."""
+
+    def __init__(self):
+        self.cumulative = {}
+        self.own = {}
+        self._stack = []
+        self._original_import = None
+
+    def install(self):
+        self._original_import = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def uninstall(self):
+        __builtin__.__import__ = self._original_import
+
+    def _import(self, name, globals=None, locals=None, fromlist=None,
+                level=-1):
+        loaded = set(sys.modules)
+        self._stack.append(0.0)
+        start = time.time()
+        try:
+            return self._original_import(name, globals, locals, fromlist,
+                                         level)
+        finally:
+            elapsed = time.time() - start
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            new_modules = set(m for m in sys.modules
+                              if m not in loaded and sys.modules[m] is not None)
+            module = self._requested(name, globals, fromlist, level,
+                                     new_modules)
+            if module is not None:
+                self.cumulative[module] = elapsed
+                self.own[module] = elapsed - children
+
+    @staticmethod
+    def _requested(name, globals, fromlist, level, new_modules):
+        """Returns the full name of the module which the import statement
+        loaded for the first time, if it did."""
+        candidates = []
+        package = _package(globals) if level != 0 else None
+        if package and level > 0:
+            if level > 1:
+                package = package.rsplit('.', level - 1)[0]
+            candidates.append('.'.join(filter(None, [package, name])))
+        else:
+            if package:
+                # implicit relative import (Python 2)
+                candidates.append('{}.{}'.format(package, name))
+            candidates.append(name)
+        # from package import submodule asks for the submodule first
+        candidates = ['{}.{}'.format(module, item) for module in candidates
+                      for item in fromlist or () if item != '*'] + candidates
+        for module in candidates:
+            if module in new_modules:
+                return module
+        return None
+
+    def top(self, limit):
+        return sorted(self.cumulative.items(), key=lambda item: item[1],
+                      reverse=True)[:limit]
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--urls', action='store_true', default=False,
+                      help='also import the root URLconf')
+    parser.add_option('--handlers', action='store_true', default=False,
+                      help='also import the RapidSMS handlers')
+    parser.add_option('--limit', type='int', default=30,
+                      help='number of modules to list [default: %default]')
+    options, args = parser.parse_args(argv)
+
+    timer = ImportTimer()
+    start = time.time()
+    timer.install()
+    try:
+        import django
+        django.setup()
+
+        from django.conf import settings
+        from importlib import import_module
+        if options.urls:
+            import_module(settings.ROOT_URLCONF)
+        if options.handlers:
+            for handler in getattr(settings, 'RAPIDSMS_HANDLERS', ()):
+                import_module(handler.rsplit('.', 1)[0])
+    finally:
+        timer.uninstall()
+    total = time.time() - start
+
+    print('{:>10} {:>10}  {}'.format('cumul. ms', 'own ms', 'module'))
+    for module, elapsed in timer.top(options.limit):
+        print('{:>10.1f} {:>10.1f}  {}'.format(
+            elapsed * 1000, timer.own[module] * 1000, module))
+    print('{} modules imported in {:.1f} ms'.format(len(timer.cumulative),
+                                                    total * 1000))
+
+
+if __name__ == '__main__':
+    main()
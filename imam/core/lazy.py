@@ -0,0 +1,60 @@
+"""Helpers for deferring imports of heavy, rarely used modules until they are
+first needed, so that web and Celery workers start quickly.
+"""
+from __future__ import unicode_literals
+import re
+from importlib import import_module
+
+from django.core.urlresolvers import (RegexURLResolver, get_resolver,
+                                      set_urlconf)
+from django.utils import six
+from django.utils.functional import lazy
+
+
+class LazyURLConfView(object):
+    """View serving requests with the URLconf module urlconf, which is only
+    imported when the first such request comes in (a regular include() gets
+    imported together with the root URLconf).
+
+    The pattern of the view captures the rest of the path as path, e.g.
+    url(r'^api/(?P<path>.*)$', LazyURLConfView('app.api.urls')), which the
+    patterns of urlconf match as if it was included there.  While a request
+    is being handled, reverse() uses them (mounted at the same prefix)
+    instead of the root URLconf.
+    """
+
+    def __init__(self, urlconf):
+        self.urlconf = urlconf
+        self._urlconfs = {}
+
+    def _mounted(self, prefix):
+        # a URLconf of its own for each prefix, so that get_resolver() caches
+        # its resolver
+        if prefix not in self._urlconfs:
+            self._urlconfs[prefix] = (
+                RegexURLResolver(r'^' + re.escape(prefix), self.urlconf),)
+        return self._urlconfs[prefix]
+
+    def __call__(self, request, path, *args, **kwargs):
+        prefix = request.path_info[1:len(request.path_info) - len(path)]
+        urlconf = self._mounted(prefix)
+        set_urlconf(urlconf)
+        try:
+            match = get_resolver(urlconf).resolve(request.path_info)
+            return match.func(request, *match.args, **match.kwargs)
+        finally:
+            set_urlconf(getattr(request, 'urlconf', None))
+
+
+def lazy_action(module_name, action_name):
+    """Returns an admin action which imports action_name from module_name only
+    when it is first run, or its (translated) description first shown."""
+    def load():
+        return getattr(import_module(module_name), action_name)
+
+    def action(modeladmin, request, queryset):
+        return load()(modeladmin, request, queryset)
+    action.__name__ = str(action_name)
+    action.short_description = lazy(
+        lambda: load().short_description, six.text_type)()
+    return action
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import core
+
+
+class Command(BaseCommand):
+    help = """Report the modules which take longest to import at startup"""
+    option_list = BaseCommand.option_list + (
+        make_option('--urls', action='store_true', dest='urls', default=False,
+                    help='Also import the URLconf, as the web workers do'),
+        make_option('--handlers', action='store_true', dest='handlers',
+                    default=False,
+                    help='Also import the RapidSMS handlers, as the message '
+                         'workers do'),
+        make_option('--limit', type='int', dest='limit', default=30,
+                    help='Number of modules to list'),
+    )
+
+    def handle(self, *args, **options):
+        # profile in a new interpreter, everything is loaded already in this
+        # one
+        project_dir = os.path.dirname(os.path.dirname(
+            os.path.abspath(core.__file__)))
+        argv = [sys.executable, '-m', 'core.importprofile',
+                '--limit', str(options['limit'])]
+        if options['urls']:
+            argv.append('--urls')
+        if options['handlers']:
+            argv.append('--handlers')
+
+        env = dict(os.environ)
+        env['DJANGO_SETTINGS_MODULE'] = settings.SETTINGS_MODULE
+        env['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [project_dir, env.get('PYTHONPATH')]))
+
+        process = subprocess.Popen(argv, cwd=project_dir, env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.stdout.write(output)
+        if process.returncode:
+            raise CommandError('Profiling failed')
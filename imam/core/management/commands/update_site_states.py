@@ -1,10 +1,20 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 from core.models import LocationProgramState
 
 class Command(BaseCommand):
     help = """Update the site state for all sites"""
+    option_list = BaseCommand.option_list + (
+        make_option('--due', action='store_true', dest='due', default=False,
+                    help='Only update the sites whose state may have changed '
+                         'with the passage of time since it was last saved'),
+    )
 
     def handle(self, *args, **options):
-        LocationProgramState.update_all()
+        if options['due']:
+            LocationProgramState.update_due()
+        else:
+            LocationProgramState.update_all()
 
         
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.utils.timezone import now
+
+
+def fill_report_dates(apps, schema_editor):
+    LocationProgramState = apps.get_model('core', 'LocationProgramState')
+    ProgramReport = apps.get_model('core', 'ProgramReport')
+    ranges = ProgramReport.objects.order_by().values(
+        'site', 'program').annotate(first_created=models.Min('created'),
+                                    last_created=models.Max('created'))
+    for row in ranges:
+        LocationProgramState.objects.filter(
+            site_id=row['site'], program_id=row['program']).update(
+            first_report_created=row['first_created'],
+            last_report_created=row['last_created'])
+    # have the first run of update_due() re-evaluate every instance
+    LocationProgramState.objects.update(next_state_check=now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20141002_1228'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='locationprogramstate',
+            name='first_report_created',
+            field=models.DateTimeField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='locationprogramstate',
+            name='last_report_created',
+            field=models.DateTimeField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='locationprogramstate',
+            name='next_state_check',
+            field=models.DateTimeField(default=None, null=True, db_index=True,
+                                       blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_report_dates),
+    ]
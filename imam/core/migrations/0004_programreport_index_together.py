@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_locationprogramstate_report_dates'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='programreport',
+            index_together=set([('report_date', 'program', 'site')]),
+        ),
+    ]
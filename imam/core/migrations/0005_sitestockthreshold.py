@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django_extensions.db.fields
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0004_weeklyprogramtotal'),
+        ('core', '0004_programreport_index_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteStockThreshold',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('minimum_rutf_stock', models.FloatField(default=0.0)),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(default=django.utils.timezone.now, editable=False, blank=True)),
+                ('site', models.OneToOneField(related_name='stock_threshold', to='locations.Location')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -1,18 +1,26 @@
 from __future__ import unicode_literals
+import operator
 from datetime import datetime, timedelta, date
 
 from dateutil.relativedelta import relativedelta
+from django.apps import apps
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
-from django.utils.timezone import localtime, now, utc
+from django.db import (IntegrityError, connections, models, router,
+                       transaction)
+from django.db.models import Q
+from django.utils.timezone import now, utc
 from django.utils.translation import ugettext as _
 from django_extensions.db import fields
-from rapidsms.models import Contact
+from rapidsms.models import Connection, Contact
 import reversion
 
+from messagebox import schedule
 from messagebox.tasks import send_sms
-from utils import iso_week_ends, iso_weeks_in
+from . import recipients
+from .codecache import code_cache, normalize_code
+from .signals import site_states_rebuilt
+from utils import chunker, iso_week_ends, iso_weeks_in
 
 
 class Agency(models.Model):
@@ -47,6 +55,10 @@ class Item(models.Model):
 
     @classmethod
     def get_by_code(cls, code):
+        return code_cache.resolve(cls, code, cls._lookup_code)
+
+    @classmethod
+    def _lookup_code(cls, code):
         obj = None
 
         try:
@@ -59,13 +71,43 @@ class Item(models.Model):
 
         return obj
 
+    @classmethod
+    def get_code_map(cls, codes):
+        """Resolves all the given codes (primary or alternative) using at
+        most one query.  Returns a dict mapping each normalised code to the
+        matching Item or None."""
+        return code_cache.resolve_many(cls, codes, cls._lookup_codes)
+
+    @classmethod
+    def _lookup_codes(cls, codes):
+        if not codes:
+            return {}
+
+        query = models.Q()
+        for code in codes:
+            query |= models.Q(code__iexact=code) | models.Q(
+                alt_code__iexact=code)
+
+        by_code = {}
+        by_alt_code = {}
+        for item in cls.objects.filter(query):
+            by_code[normalize_code(item.code)] = item
+            if item.alt_code:
+                by_alt_code[normalize_code(item.alt_code)] = item
+
+        # primary codes take precedence over alternative ones, as in
+        # _lookup_code()
+        return dict((code, by_code.get(code, by_alt_code.get(code)))
+                    for code in codes)
+
     @classmethod
     def get_by_codes(cls, *codes):
         items = []
         invalid_codes = []
+        code_map = cls.get_code_map(codes)
 
         for code in codes:
-            item = cls.get_by_code(code)
+            item = code_map.get(normalize_code(code))
 
             if item is not None:
                 items.append(item)
@@ -109,6 +151,10 @@ class PatientGroup(models.Model):
 
     @classmethod
     def get_by_code(cls, code):
+        return code_cache.resolve(cls, code, cls._lookup_code)
+
+    @classmethod
+    def _lookup_code(cls, code):
         obj = None
 
         try:
@@ -141,6 +187,10 @@ class Position(models.Model):
     @classmethod
     def get_by_code(cls, code):
         """Attempts to find the Position instance matching given code"""
+        return code_cache.resolve(cls, code, cls._lookup_code)
+
+    @classmethod
+    def _lookup_code(cls, code):
         obj = None
 
         try:
@@ -202,6 +252,10 @@ class Program(models.Model):
 
     @classmethod
     def get_by_code(cls, code):
+        return code_cache.resolve(cls, code, cls._lookup_code)
+
+    @classmethod
+    def _lookup_code(cls, code):
         obj = None
 
         try:
@@ -257,6 +311,20 @@ class LocationProgramState(models.Model):
     last_report_date = models.DateTimeField(blank=True, null=True, default=None)
     current_state = models.CharField(default='OUT', max_length=20,
                                      choices=LOCATION_STATES)
+    # Creation dates of the oldest and newest ProgramReport for this site and
+    # program, kept up to date whenever a report is saved or deleted so that
+    # current_state can be computed without querying the reports.
+    first_report_created = models.DateTimeField(blank=True, null=True,
+                                                default=None)
+    last_report_created = models.DateTimeField(blank=True, null=True,
+                                               default=None)
+    # When current_state may next change merely because time has passed (an
+    # 8 or 16 week boundary); None if it cannot.  See update_due().
+    next_state_check = models.DateTimeField(blank=True, null=True,
+                                            default=None, db_index=True)
+
+    # number of rows inserted or updated per query by the bulk methods
+    BULK_CHUNK_SIZE = 500
 
     class Meta:
         unique_together = (('site', 'program'),)
@@ -282,6 +350,78 @@ class LocationProgramState(models.Model):
             if hasattr(self, 'current_state'):
                 self.update_current_state()
 
+    def save(self, *args, **kwargs):
+        if self.pk is None and self.last_report_created is None:
+            self.load_report_dates()
+        self.next_state_check = self.get_next_state_check()
+        return super(LocationProgramState, self).save(*args, **kwargs)
+
+    def load_report_dates(self):
+        """Sets first_report_created and last_report_created from the
+        ProgramReport objects for this site and program."""
+        dates = ProgramReport.objects.filter(
+            site_id=self.site_id, program_id=self.program_id).aggregate(
+            first_created=models.Min('created'),
+            last_created=models.Max('created'))
+        self.first_report_created = dates['first_created']
+        self.last_report_created = dates['last_created']
+
+    def get_next_state_check(self, current_time=None):
+        """Returns the earliest 8 or 16 week boundary after current_time (by
+        default now) at which current_state changes without any new data, or
+        None if there is no such boundary."""
+        if current_time is None:
+            current_time = now()
+        boundaries = []
+        if self.last_report_created:
+            boundaries.append(self.last_report_created +
+                              relativedelta(weeks=8))
+            boundaries.append(self.last_report_created +
+                              relativedelta(weeks=16))
+        if self.last_report_date and (self.training_date or
+                                      self.last_report_created):
+            boundaries.append(self.last_report_date + relativedelta(weeks=8))
+        upcoming = [b for b in boundaries if b > current_time]
+        return min(upcoming) if upcoming else None
+
+    @classmethod
+    def register_report_change(cls, site_id, program_id, created=None):
+        """Update the stored report dates and current_state of the instance for
+        a specific site and program (if there is one) after one of its program
+        reports has been saved or deleted.  If created is given, it is the
+        creation date of a newly saved report and no query for the other
+        reports is needed.
+        """
+        try:
+            spc_instance = cls.objects.get(site_id=site_id,
+                                           program_id=program_id)
+        except cls.DoesNotExist:
+            return
+        if created is None:
+            spc_instance.load_report_dates()
+        else:
+            if spc_instance.first_report_created is None or \
+                    created < spc_instance.first_report_created:
+                spc_instance.first_report_created = created
+            if spc_instance.last_report_created is None or \
+                    created > spc_instance.last_report_created:
+                spc_instance.last_report_created = created
+        spc_instance.update_current_state()
+        spc_instance.save()
+
+    @classmethod
+    def update_due(cls):
+        """Re-evaluate current_state only for the instances for which an 8 or
+        16 week boundary has passed since they were last evaluated.  This is
+        meant to be run periodically; see core.tasks.update_due_site_states.
+        """
+        current_time = now()
+        for spc_instance in cls.objects.filter(
+                next_state_check__lte=current_time).iterator():
+            spc_instance.update_current_state()
+            spc_instance.save(update_fields=['current_state',
+                                             'next_state_check'])
+
     @classmethod
     def register_data_arrival(cls, program_id, site_id):
         """Update state based on data related to a specific program arriving
@@ -302,6 +442,7 @@ class LocationProgramState(models.Model):
         spc_instance.save()
 
     @classmethod
+    @transaction.atomic
     def reset_all(cls):
         """This method should:
         * delete all instances of LocationProgramState (i.e. irrespective of
@@ -312,23 +453,27 @@ class LocationProgramState(models.Model):
               last_report_date for each instance of LocationProgramState it
               creates, based on creation dates of the instance(s) of
               ProgramReport associated with it
+
+        The creation dates are computed for all site-program combinations with
+        a single aggregate query and the instances are inserted in chunks.
         """
         cls.objects.all().delete()
-        site_program_combinations = ProgramReport.objects.values(
-            'site', 'program').order_by('site', 'program').distinct()
-        for spc in site_program_combinations:
-            spc_instance_reports = ProgramReport.objects.filter(
-                site=spc['site'], program=spc['program']).order_by('created')
-            training_date = spc_instance_reports[0].created
-            last_report_date = spc_instance_reports.reverse()[0].created
-            lps = cls.objects.create(site_id=spc['site'],
-                                     program_id=spc['program'],
-                                     training_date=training_date,
-                                     last_report_date=last_report_date)
-            lps.update_current_state()
-            lps.save()
+        current_time = now()
+        report_ranges = cls._report_ranges()
+        for chunk in chunker(sorted(report_ranges.items()),
+                             cls.BULK_CHUNK_SIZE):
+            cls.objects.bulk_create([
+                cls._new_instance(site_id, program_id, report_range,
+                                  current_time,
+                                  training_date=report_range[0],
+                                  last_report_date=report_range[1])
+                for (site_id, program_id), report_range in chunk
+            ])
+        cls._apply_report_ranges(report_ranges, current_time)
+        site_states_rebuilt.send(sender=cls)
 
     @classmethod
+    @transaction.atomic
     def update_all(cls):
         """This method should:
         * create new instances of LocationProgramState for combinations of
@@ -348,30 +493,102 @@ class LocationProgramState(models.Model):
           reports associated with them)
         * update or set last_report_date or training_date even for the
           instances of LocationProgramState it creates
+
+        Missing instances are inserted in chunks and only the changed values
+        of current_state are written back, with one UPDATE per state and
+        chunk.
         """
-        site_program_combinations = ProgramReport.objects.values(
-            'site', 'program').order_by('site', 'program').distinct()
-        for spc in site_program_combinations:
-            spc_instance = cls.objects.get_or_create(
-                site_id=spc['site'], program_id=spc['program'])[0]
-            spc_instance.update_current_state()
-            spc_instance.save()
+        current_time = now()
+        report_ranges = cls._report_ranges()
+        existing = set(cls.objects.values_list('site_id', 'program_id'))
+        missing = sorted(pair for pair in report_ranges if pair not in existing)
+        for chunk in chunker(missing, cls.BULK_CHUNK_SIZE):
+            cls.objects.bulk_create([
+                cls._new_instance(site_id, program_id,
+                                  report_ranges[(site_id, program_id)],
+                                  current_time)
+                for site_id, program_id in chunk
+            ])
+        cls._apply_report_ranges(report_ranges, current_time)
+        site_states_rebuilt.send(sender=cls)
+
+    @classmethod
+    def _new_instance(cls, site_id, program_id, report_range, current_time,
+                      **kwargs):
+        """Returns an unsaved instance for bulk_create() with the report dates
+        and next_state_check already filled in (bulk_create() does not call
+        save())."""
+        lps = cls(site_id=site_id, program_id=program_id,
+                  first_report_created=report_range[0],
+                  last_report_created=report_range[1], **kwargs)
+        lps.next_state_check = lps.get_next_state_check(current_time)
+        return lps
+
+    @classmethod
+    def _report_ranges(cls):
+        """Returns a dict mapping each (site_id, program_id) combination found
+        in ProgramReport to the creation dates of its oldest and newest
+        report."""
+        rows = ProgramReport.objects.order_by().values(
+            'site', 'program').annotate(first_created=models.Min('created'),
+                                        last_created=models.Max('created'))
+        return dict(
+            ((row['site'], row['program']),
+             (row['first_created'], row['last_created']))
+            for row in rows
+        )
+
+    @classmethod
+    def _apply_report_ranges(cls, report_ranges, current_time):
+        """Stores the report dates from report_ranges in every instance with
+        reports, runs update_current_state() on it and saves whatever has
+        changed.  Changes of current_state alone are saved with one UPDATE
+        per state and chunk; the other changes (only expected when the
+        stored dates got out of sync) are saved one instance at a time."""
+        changed_states = {}
+        for lps in cls.objects.all().iterator():
+            report_range = report_ranges.get((lps.site_id, lps.program_id))
+            if report_range is None:
+                continue
+            previous = (lps.current_state, lps.first_report_created,
+                        lps.last_report_created, lps.next_state_check)
+            lps.first_report_created, lps.last_report_created = report_range
+            lps.update_current_state()
+            lps.next_state_check = lps.get_next_state_check(current_time)
+            if previous[1:] != (lps.first_report_created,
+                                lps.last_report_created,
+                                lps.next_state_check):
+                cls.objects.filter(pk=lps.pk).update(
+                    current_state=lps.current_state,
+                    first_report_created=lps.first_report_created,
+                    last_report_created=lps.last_report_created,
+                    next_state_check=lps.next_state_check)
+            elif lps.current_state != previous[0]:
+                changed_states.setdefault(lps.current_state, []).append(
+                    lps.pk)
+
+        for state, pks in changed_states.items():
+            for chunk in chunker(pks, cls.BULK_CHUNK_SIZE):
+                cls.objects.filter(pk__in=chunk).update(current_state=state)
 
     def update_current_state(self):
         """Computes the value of current_state based on relevant instances of
         ProgramReport and/or taking into account current values of training_date
         and last_report_date.
 
+        The creation date of the newest report is taken from
+        last_report_created rather than queried for.
+
         N.B. this method does not call save() so one must do that explicitly to
         actually store the state update.
         """
-        data = ProgramReport.objects.filter(
-            program_id=self.program.pk,
-            site_id=self.site.pk).order_by('created')
-        if data.count() == 0:
+        last_report_create_date = self.last_report_created
+        current_time = utc.localize(datetime.utcnow())
+        eight_week_bound = current_time - relativedelta(weeks=8)
+        sixteen_week_bound = current_time - relativedelta(weeks=16)
+
+        if last_report_create_date is None:
             if self.training_date:
-                current_time = utc.localize(datetime.utcnow())
-                eight_week_bound = current_time - relativedelta(weeks=8)
                 if self.last_report_date \
                         and self.last_report_date > eight_week_bound:
                     self.current_state = 'ACTIVE-BAD'
@@ -379,26 +596,20 @@ class LocationProgramState(models.Model):
                     self.current_state = 'INACTIVE-TRAINED'
             else:
                 self.current_state = 'OUT'
+        elif last_report_create_date > eight_week_bound:
+            self.current_state = 'ACTIVE'
+        elif last_report_create_date > sixteen_week_bound:
+            if self.last_report_date \
+                    and self.last_report_date > eight_week_bound:
+                self.current_state = 'ACTIVE-BAD'
+            else:
+                self.current_state = 'INACTIVE-NEW'
         else:
-            last_report_create_date = data.reverse()[0].created
-            current_time = utc.localize(datetime.utcnow())
-            eight_week_bound = current_time - relativedelta(weeks=8)
-            sixteen_week_bound = current_time - relativedelta(weeks=16)
-
-            if last_report_create_date > eight_week_bound:
-                self.current_state = 'ACTIVE'
-            elif last_report_create_date > sixteen_week_bound:
-                if self.last_report_date \
-                        and self.last_report_date > eight_week_bound:
-                    self.current_state = 'ACTIVE-BAD'
-                else:
-                    self.current_state = 'INACTIVE-NEW'
+            if self.last_report_date \
+                    and self.last_report_date > eight_week_bound:
+                self.current_state = 'ACTIVE-BAD'
             else:
-                if self.last_report_date \
-                        and self.last_report_date > eight_week_bound:
-                    self.current_state = 'ACTIVE-BAD'
-                else:
-                    self.current_state = 'INACTIVE'
+                self.current_state = 'INACTIVE'
 
 
 class Personnel(models.Model):
@@ -475,6 +686,9 @@ class ProgramReport(Report):
 
     class Meta:
         ordering = ('-report_date', '-created', '-pk')
+        # used by the dashboard chart, which sums reports by date for a
+        # program and a set of sites
+        index_together = (('report_date', 'program', 'site'),)
 
     def __unicode__(self):
         return "%s, %s: %s" % (
@@ -541,6 +755,13 @@ class ProgramReport(Report):
         return super(ProgramReport, self).clean()
 
     def save(self, *args, **kwargs):
+        self.set_computed_fields()
+        return super(ProgramReport, self).save(*args, **kwargs)
+
+    def set_computed_fields(self):
+        """Fills in report_date (if missing) and patients_at_period_end.
+        Called by save(), and must be called on reports which are inserted
+        without it (e.g. with bulk_create())."""
         if not self.report_date:
             self.report_date = iso_week_ends(self.period_number)
 
@@ -559,7 +780,6 @@ class ProgramReport(Report):
             ) - \
             (self.patients_cured or 0) - \
             (self.unresponsive_patients or 0)
-        return super(ProgramReport, self).save(*args, **kwargs)
 
     @property
     def period(self):
@@ -629,6 +849,67 @@ class ProgramReport(Report):
 reversion.register(ProgramReport)
 
 
+def _program_report_pre_save(sender, instance, **kwargs):
+    # remember the site and program of the report before this save, in case
+    # it is moved to another one
+    instance._previous_site_program = None
+    if instance.pk is not None:
+        instance._previous_site_program = ProgramReport.objects.filter(
+            pk=instance.pk).values_list('site_id', 'program_id').first()
+
+
+def _program_report_saved(sender, instance, created, raw=False, **kwargs):
+    # Raw saves are not skipped as reversion reverts reports with them; the
+    # dates are then reloaded, the report may have had another creation date.
+    LocationProgramState.register_report_change(
+        instance.site_id, instance.program_id,
+        created=instance.created if created and not raw else None)
+    previous = getattr(instance, '_previous_site_program', None)
+    if previous and previous != (instance.site_id, instance.program_id):
+        LocationProgramState.register_report_change(*previous)
+
+
+def _program_report_deleted(sender, instance, **kwargs):
+    LocationProgramState.register_report_change(instance.site_id,
+                                                instance.program_id)
+
+
+models.signals.pre_save.connect(_program_report_pre_save,
+                                sender=ProgramReport,
+                                dispatch_uid='program-report-pre-save-state')
+models.signals.post_save.connect(_program_report_saved, sender=ProgramReport,
+                                 dispatch_uid='program-report-saved-state')
+models.signals.post_delete.connect(_program_report_deleted,
+                                   sender=ProgramReport,
+                                   dispatch_uid='program-report-deleted-state')
+
+for _model in (Item, PatientGroup, Position, Program):
+    code_cache.register(_model)
+
+
+def insert_with_ids(model, objects):
+    """Inserts objects and sets their primary keys, which bulk_create() does
+    not do, so that rows referring to them can be inserted in bulk as well.
+    On PostgreSQL the keys are taken from the table's sequence up front,
+    elsewhere the objects are saved one at a time."""
+    if not objects:
+        return
+    connection = connections[router.db_for_write(model)]
+    if connection.vendor != 'postgresql':
+        for obj in objects:
+            obj.save(force_insert=True)
+        return
+
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+        'FROM generate_series(1, %s)',
+        [model._meta.db_table, model._meta.pk.column, len(objects)])
+    for obj, (pk,) in zip(objects, cursor.fetchall()):
+        obj.pk = pk
+    model.objects.bulk_create(objects)
+
+
 class StockOutReport(Report):
     """Model class for stock out reports"""
     items = models.ManyToManyField(Item)
@@ -654,50 +935,68 @@ class StockOutReport(Report):
 
         return report
 
+    @classmethod
+    @transaction.atomic
+    def update_site_items(cls, site, reporter, stocked_items, exhausted_items):
+        """Removes stocked_items from the stock out reports of site, deleting
+        the reports left without items, and adds exhausted_items to its
+        latest one (as create_stockout_report does).  The item changes take a
+        single delete and a single insert.
+
+        Returns the report exhausted_items were added to, or None."""
+        stocked_ids = set(item.pk for item in stocked_items)
+        exhausted_ids = set(item.pk for item in exhausted_items)
+        reports = list(cls.objects.filter(site__pk=site.pk))
+        Through = cls.items.through
+        report = None
+
+        if exhausted_ids:
+            LowStockAlert.objects.filter(site__pk=site.pk,
+                                         item__pk__in=exhausted_ids).delete()
+            if reports:
+                report = reports[0]
+                report.reporter = reporter
+            else:
+                report = cls(site=site, reporter=reporter)
+            report.save()
+
+        deleted = []
+        if reports and stocked_ids:
+            deleted.append(Q(stockoutreport__in=reports, item__in=stocked_ids))
+        if report is not None and reports:
+            # inserted again below, so that no row is duplicated
+            deleted.append(Q(stockoutreport=report, item__in=exhausted_ids))
+        if deleted:
+            Through.objects.filter(reduce(operator.or_, deleted)).delete()
+        if report is not None:
+            Through.objects.bulk_create([
+                Through(stockoutreport_id=report.pk, item_id=item_id)
+                for item_id in exhausted_ids])
+
+        emptied = [other.pk for other in reports if other != report]
+        if stocked_ids and emptied:
+            cls.objects.filter(pk__in=emptied, items__isnull=True).delete()
+
+        return report
+
     @property
     def summary(self):
         return ', '.join(self.items.values_list('code', flat=True))
 
     def generate_notification(self):
-        # we're interested in state and LGA level staff
-        location_codes = ['adm1', 'adm2']
-        parent_locs = self.site.get_ancestors().filter(
-            loc_type__code__in=location_codes)
-
         alert_message = _(
             'Stock outs of {items} were reported at {site_name} with the site '
             'ID {site_id} on {date}').format(
             items=self.summary, site_name=self.site.name,
             site_id=self.site.hcid, date=self.modified.strftime('%d/%m/%y'))
 
-        phone_numbers = set()
-
-        for loc in parent_locs:
-            phone_numbers.update(
-                [worker.mobile for worker in loc.workers.all()])
-
-        # if the alert is received after 8.00AM and before 8.00PM, dispatch
-        # immediately, else schedule for the next day
-        current_timestamp = localtime(now())
-        lower_timestamp_bound = current_timestamp.replace(hour=8, minute=0,
-                                                          second=0,
-                                                          microsecond=0)
-        upper_timestamp_bound = current_timestamp.replace(hour=20, minute=0,
-                                                          second=0,
-                                                          microsecond=0)
-
-        args = list()
-        args.append(alert_message)
-        args.extend(phone_numbers)
-
-        if lower_timestamp_bound <= current_timestamp <= upper_timestamp_bound:
-            send_sms.delay(*args)
-        elif current_timestamp > upper_timestamp_bound:
-            dispatch_timestamp = lower_timestamp_bound + timedelta(days=1)
-            send_sms.apply_async(args=args, eta=dispatch_timestamp)
-        else:
-            dispatch_timestamp = lower_timestamp_bound
-            send_sms.apply_async(args=args, eta=dispatch_timestamp)
+        # state and LGA level staff
+        phone_numbers = recipients.get(self.site_id)
+
+        # dispatch immediately during the day (8.00AM to 8.00PM), else hold
+        # until the next morning
+        if phone_numbers and not schedule.hold(alert_message, phone_numbers):
+            send_sms.delay(alert_message, *phone_numbers)
 
     @transaction.atomic
     def remove(self, *items):
@@ -731,43 +1030,66 @@ class StockReport(Report):
 
         return logs
 
+    @classmethod
+    @transaction.atomic
+    def create_with_logs(cls, site, reporter, entries):
+        """Creates a report of site with an inventory log for each of entries,
+        dicts with the item, last_receipt and current_stock, in a constant
+        number of statements.  The logs are returned as the logs_cache
+        attribute of the report."""
+        logs = [InventoryLog(item=entry['item'],
+                             last_quantity_received=entry['last_receipt'],
+                             current_holding=entry['current_stock'])
+                for entry in entries]
+        insert_with_ids(InventoryLog, logs)
+        report = cls.objects.create(site=site, reporter=reporter)
+        Through = cls.logs.through
+        Through.objects.bulk_create([
+            Through(stockreport_id=report.pk, inventorylog_id=log.pk)
+            for log in logs])
+        report.logs_cache = logs
+
+        return report
+
     @transaction.atomic
-    def check_for_low_stock(self):
+    def check_for_low_stock(self, logs=None):
+        """Creates or clears the low RUTF stock alert of the site.  logs
+        defaults to the inventory logs of the report (logs_cache if it was
+        created with create_with_logs)."""
         item = Item.get_by_code('RUTF')
-        rutf_logs = self.logs.filter(item__code=item.code)
+        if item is None:
+            return
+        if logs is None:
+            logs = getattr(self, 'logs_cache', None)
+        if logs is None:
+            rutf_logs = list(self.logs.filter(item__code=item.code))
+        else:
+            rutf_logs = [log for log in logs if log.item_id == item.pk]
+        if not rutf_logs:
+            return
 
+        minimum_stock = SiteStockThreshold.minimum_for(self.site_id)
         for log in rutf_logs:
-            minimum_stock = get_total_minimum_rutf_stock(self.site)
             if (log.current_holding <= minimum_stock) and (minimum_stock > 0):
-                # generate low stock alert if no existing low stock or stock
-                # alerts exist
-                stockout = None
-                try:
-                    stockout = StockOutReport.objects.get(site__pk=self.site.pk)
-                except StockOutReport.DoesNotExist:
-                    pass
-
                 # if a stock out alert exists for the specified item, don't
                 # bother creating a low stock alert
-                if stockout and stockout.items.filter(code=item.code).exists():
+                if StockOutReport.items.through.objects.filter(
+                        stockoutreport__site__pk=self.site.pk,
+                        item__pk=item.pk).exists():
                     continue
 
                 alert, newobj = LowStockAlert.objects.get_or_create(
                     site=self.site,
-                    item=item
+                    item=item,
+                    defaults={'created': self.created}
                 )
-                alert.created = self.created
-                alert.save()
+                if not newobj:
+                    alert.created = self.created
+                    alert.save()
             elif log.current_holding >= minimum_stock:
                 # clear any existing low stock alerts
-                alert = None
-                try:
-                    alert = LowStockAlert.objects.get(site=self.site, item=item)
-                except LowStockAlert.DoesNotExist:
-                    pass
-
-                if alert:
-                    alert.delete()
+                LowStockAlert.objects.filter(site__pk=self.site.pk,
+                                             item__pk=item.pk).delete()
 
 
 class LowStockAlert(models.Model):
@@ -780,45 +1102,27 @@ class LowStockAlert(models.Model):
         return "%s: %s (%s)" % (self.site.name, self.item.code, self.created)
 
     def generate_notification(self):
-        # we're interested in state and LGA level staff
-        location_codes = ['adm1', 'adm2']
-        parent_locs = self.site.get_ancestors().filter(
-            loc_type__code__in=location_codes)
-
         alert_message = _(
             'The site {site_name} with the site ID {site_id} reported low '
             'stock of {item} on {date}').format(
             site_name=self.site.name, site_id=self.site.hcid,
             date=self.modified.strftime('%d/%m/%y'), item=self.item.code)
 
-        phone_numbers = set()
-
-        for loc in parent_locs:
-            phone_numbers.update(
-                [worker.mobile for worker in loc.workers.all()])
-
-        # if the alert is received after 8.00AM and before 8.00PM, dispatch
-        # immediately, else schedule for the next day
-        current_timestamp = localtime(now())
-        lower_timestamp_bound = current_timestamp.replace(hour=8, minute=0,
-                                                          second=0,
-                                                          microsecond=0)
-        upper_timestamp_bound = current_timestamp.replace(hour=20, minute=0,
-                                                          second=0,
-                                                          microsecond=0)
-
-        args = list()
-        args.append(alert_message)
-        args.extend(phone_numbers)
-
-        if lower_timestamp_bound <= current_timestamp <= upper_timestamp_bound:
-            send_sms.delay(*args)
-        elif current_timestamp > upper_timestamp_bound:
-            dispatch_timestamp = lower_timestamp_bound + timedelta(days=1)
-            send_sms.apply_async(args=args, eta=dispatch_timestamp)
-        else:
-            dispatch_timestamp = lower_timestamp_bound
-            send_sms.apply_async(args=args, eta=dispatch_timestamp)
+        # state and LGA level staff
+        phone_numbers = recipients.get(self.site_id)
+
+        # dispatch immediately during the day (8.00AM to 8.00PM), else hold
+        # until the next morning
+        if phone_numbers and not schedule.hold(alert_message, phone_numbers):
+            send_sms.delay(alert_message, *phone_numbers)
+
+
+# the minimum RUTF stock of a site is this many times its average admissions
+# (Atot) in the four reports before the latest one, summed over the programs
+# and patient groups treated with RUTF
+MINIMUM_STOCK_MULTIPLIER = 1.5
+NON_RUTF_GROUP_CODE = '05'
+NON_RUTF_PROGRAM_CODE = 'SFP'
 
 
 def get_minimum_rutf_stock(site, program, group):
@@ -830,7 +1134,7 @@ def get_minimum_rutf_stock(site, program, group):
     if qs.count() == 0:
         return 0.0
 
-    multiplier = 1.5
+    multiplier = MINIMUM_STOCK_MULTIPLIER
 
     atots = []
 
@@ -844,8 +1148,10 @@ def get_minimum_rutf_stock(site, program, group):
 
 
 def get_total_minimum_rutf_stock(site):
-    groups = PatientGroup.objects.exclude(code='05')
-    programs = Program.objects.exclude(code='SFP')
+    """Computes the minimum RUTF stock of site from its program reports.  Use
+    SiteStockThreshold.minimum_for, which stores it, rather than this."""
+    groups = PatientGroup.objects.exclude(code=NON_RUTF_GROUP_CODE)
+    programs = Program.objects.exclude(code=NON_RUTF_PROGRAM_CODE)
 
     total_minimum = 0.0
 
@@ -854,3 +1160,177 @@ def get_total_minimum_rutf_stock(site):
             total_minimum += get_minimum_rutf_stock(site, program, group)
 
     return total_minimum
+
+
+class SiteStockThreshold(models.Model):
+    """The minimum RUTF stock of a site (see get_total_minimum_rutf_stock),
+    kept up to date whenever one of its program reports is saved or deleted
+    so that checking a stock report for low stock takes a single lookup."""
+    site = models.OneToOneField('locations.Location',
+                                related_name='stock_threshold')
+    minimum_rutf_stock = models.FloatField(default=0.0)
+    modified = fields.ModificationDateTimeField()
+
+    # the reports of each site, program and group are numbered from the
+    # latest one and the 2nd to 5th are averaged, in a single query
+    MINIMUM_SQL = """
+        SELECT site_id, SUM(minimum) FROM (
+            SELECT site_id, ABS(AVG(atot)) * %s AS minimum FROM (
+                SELECT report.site_id, report.program_id, report.group_id,
+                    COALESCE(report.new_marasmic_patients, 0) +
+                    COALESCE(report.new_oedema_patients, 0) +
+                    COALESCE(report.new_relapsed_patients, 0) AS atot,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY report.site_id, report.program_id,
+                            report.group_id
+                        ORDER BY report.report_date DESC,
+                            report.created DESC, report.id DESC
+                    ) AS position
+                FROM {report} report
+                JOIN {program} program ON program.id = report.program_id
+                JOIN {group} patient_group
+                    ON patient_group.id = report.group_id
+                WHERE program.code <> %s AND patient_group.code <> %s
+                    {sites}
+            ) ranked
+            WHERE position BETWEEN 2 AND 5
+            GROUP BY site_id, program_id, group_id
+        ) minimums
+        GROUP BY site_id
+    """
+
+    def __unicode__(self):
+        return "%s: %s" % (self.site_id, self.minimum_rutf_stock)
+
+    @classmethod
+    def compute(cls, site_ids=None):
+        """Returns the minimum RUTF stock of the given sites (all sites with
+        program reports by default) as a dict of site ids to minimums.
+        Sites without enough reports are left out."""
+        connection = connections[router.db_for_read(ProgramReport)]
+        if connection.vendor != 'postgresql':
+            return cls._compute_by_site(site_ids)
+
+        params = [MINIMUM_STOCK_MULTIPLIER, NON_RUTF_PROGRAM_CODE,
+                  NON_RUTF_GROUP_CODE]
+        sites = ''
+        if site_ids is not None:
+            if not site_ids:
+                return {}
+            sites = 'AND report.site_id IN ({})'.format(
+                ', '.join(['%s'] * len(site_ids)))
+            params.extend(site_ids)
+        sql = cls.MINIMUM_SQL.format(
+            report=connection.ops.quote_name(ProgramReport._meta.db_table),
+            program=connection.ops.quote_name(Program._meta.db_table),
+            group=connection.ops.quote_name(PatientGroup._meta.db_table),
+            sites=sites)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return dict((site_id, float(minimum))
+                    for site_id, minimum in cursor.fetchall())
+
+    @classmethod
+    def _compute_by_site(cls, site_ids=None):
+        # without window functions (outside PostgreSQL)
+        Location = apps.get_model('locations', 'Location')
+        if site_ids is None:
+            site_ids = ProgramReport.objects.order_by().values_list(
+                'site_id', flat=True).distinct()
+        minimums = {}
+        for site in Location.objects.filter(pk__in=list(site_ids)):
+            minimum = get_total_minimum_rutf_stock(site)
+            if minimum:
+                minimums[site.pk] = minimum
+        return minimums
+
+    @classmethod
+    @transaction.atomic
+    def refresh(cls, site_ids=None):
+        """Recomputes and stores the minimum RUTF stock of the given sites (of
+        all the sites with program reports, dropping the others, by default).
+        Returns the minimums computed, as compute() does."""
+        # the stored rows are locked before computing, so that concurrent
+        # refreshes of a site store their minimums in turn
+        stored = cls.objects.select_for_update()
+        if site_ids is not None:
+            stored = stored.filter(site_id__in=site_ids)
+        current = dict(stored.values_list('site_id', 'minimum_rutf_stock'))
+        minimums = cls.compute(site_ids)
+        if site_ids is None:
+            site_ids = minimums.keys()
+            cls.objects.filter(
+                site_id__in=set(current) - set(site_ids)).delete()
+
+        missing = []
+        for site_id in set(site_ids):
+            minimum = minimums.get(site_id, 0.0)
+            if site_id not in current:
+                missing.append(cls(site_id=site_id,
+                                   minimum_rutf_stock=minimum))
+            elif current[site_id] != minimum:
+                cls.objects.filter(site_id=site_id).update(
+                    minimum_rutf_stock=minimum, modified=now())
+        if missing:
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(missing)
+            except IntegrityError:
+                # stored meanwhile by a concurrent refresh
+                for threshold in missing:
+                    cls.objects.update_or_create(
+                        site_id=threshold.site_id, defaults={
+                            'minimum_rutf_stock':
+                                threshold.minimum_rutf_stock})
+        return minimums
+
+    @classmethod
+    def minimum_for(cls, site_id):
+        """Returns the minimum RUTF stock of a site, computing and storing it
+        if it was not yet."""
+        minimum = cls.objects.filter(site_id=site_id).values_list(
+            'minimum_rutf_stock', flat=True).first()
+        if minimum is None:
+            minimum = cls.refresh([site_id]).get(site_id, 0.0)
+        return minimum
+
+
+def _stock_threshold_report_saved(sender, instance, **kwargs):
+    # Raw saves are not skipped as reversion reverts reports with them.
+    site_ids = [instance.site_id]
+    previous = getattr(instance, '_previous_site_program', None)
+    if previous and previous[0] != instance.site_id:
+        site_ids.append(previous[0])
+    SiteStockThreshold.refresh(site_ids)
+
+
+def _stock_threshold_report_deleted(sender, instance, **kwargs):
+    # recomputed on next use: the site may be being deleted as well
+    SiteStockThreshold.objects.filter(site_id=instance.site_id).delete()
+
+
+models.signals.post_save.connect(_stock_threshold_report_saved,
+                                 sender=ProgramReport,
+                                 dispatch_uid='stock-threshold-report-saved')
+models.signals.post_delete.connect(_stock_threshold_report_deleted,
+                                   sender=ProgramReport,
+                                   dispatch_uid='stock-threshold-report-deleted')
+
+models.signals.pre_save.connect(recipients.personnel_pre_save,
+                                sender=Personnel,
+                                dispatch_uid='recipients-personnel-pre-save')
+models.signals.post_save.connect(recipients.personnel_changed,
+                                 sender=Personnel,
+                                 dispatch_uid='recipients-personnel-saved')
+models.signals.post_delete.connect(recipients.personnel_changed,
+                                   sender=Personnel,
+                                   dispatch_uid='recipients-personnel-deleted')
+models.signals.pre_save.connect(recipients.connection_pre_save,
+                                sender=Connection,
+                                dispatch_uid='recipients-connection-pre-save')
+models.signals.post_save.connect(recipients.connection_changed,
+                                 sender=Connection,
+                                 dispatch_uid='recipients-connection-saved')
+models.signals.post_delete.connect(recipients.connection_changed,
+                                   sender=Connection,
+                                   dispatch_uid='recipients-connection-deleted')
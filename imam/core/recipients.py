@@ -0,0 +1,165 @@
+"""Index of the phone numbers the stock alerts of a site are escalated to,
+i.e. those of the workers at the state (adm1) and LGA (adm2) locations above
+the site.
+
+Entries are cached per site, so that the recipients of an alert take a single
+cache lookup, and computed for a site on a cache miss (in a few queries,
+whatever the number of workers).  They are dropped whenever a worker or a
+connection of an escalation location changes, or when a location is saved
+(for the sites below it, whose ancestors may have changed), once the change
+is committed.  Changes made without signals (e.g. queryset updates of the
+location tree) must be followed by a call to invalidate().
+"""
+from __future__ import unicode_literals
+import operator
+from collections import defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+
+from .utils import on_commit
+
+
+ESCALATION_LEVELS = ('adm1', 'adm2')
+DEFAULT_TIMEOUT = 24 * 3600  # seconds
+
+
+def _cache():
+    return caches[getattr(settings, 'ESCALATION_RECIPIENTS_CACHE', 'default')]
+
+
+def make_key(site_id):
+    return 'escalation-recipients:{}'.format(site_id)
+
+
+def compute(site_ids=None):
+    """Returns a dict of site ids to the sorted list of the phone numbers of
+    their escalation recipients, for the given sites (all sites by
+    default)."""
+    Location = apps.get_model('locations', 'Location')
+    LocationType = apps.get_model('locations', 'LocationType')
+    Personnel = apps.get_model('core', 'Personnel')
+
+    escalation = list(Location.objects.filter(
+        loc_type__code__in=ESCALATION_LEVELS).values_list(
+        'pk', 'tree_id', 'lft', 'rght'))
+    if site_ids is None:
+        sites = Location.objects.filter(
+            loc_type=LocationType.get_site_type())
+    else:
+        sites = Location.objects.filter(pk__in=site_ids)
+
+    ancestors = {}
+    for pk, tree_id, lft, rght in sites.values_list('pk', 'tree_id', 'lft',
+                                                    'rght'):
+        ancestors[pk] = [loc_pk for loc_pk, loc_tree_id, loc_lft, loc_rght
+                         in escalation
+                         if loc_tree_id == tree_id and loc_lft < lft and
+                         loc_rght > rght]
+
+    numbers = defaultdict(set)
+    location_ids = set(pk for pks in ancestors.values() for pk in pks)
+    if location_ids:
+        workers = Personnel.objects.filter(
+            site__pk__in=location_ids).select_related(
+            'contact').prefetch_related('contact__connection_set')
+        for worker in workers:
+            # the default connection of the worker, as in Personnel.mobile
+            connections = worker.contact.connection_set.all()
+            if connections:
+                numbers[worker.site_id].add(connections[0].identity)
+
+    return dict((pk, sorted(set().union(*[numbers[loc_pk]
+                                          for loc_pk in pks])))
+                for pk, pks in ancestors.items())
+
+
+def get(site_id):
+    """Returns the phone numbers of the escalation recipients of a site."""
+    cache = _cache()
+    key = make_key(site_id)
+    recipients = cache.get(key)
+    if recipients is None:
+        recipients = compute([site_id]).get(site_id, [])
+        cache.set(key, recipients, _timeout())
+    return recipients
+
+
+def rebuild():
+    """Computes and caches the recipients of every site."""
+    index = compute()
+    _cache().set_many(dict((make_key(pk), recipients)
+                           for pk, recipients in index.items()), _timeout())
+    return index
+
+
+def invalidate(location_ids=None, escalation_only=False):
+    """Drops the cached recipients of the sites at or below the given
+    locations (of every site by default) once the current transaction is
+    committed, so that they are not cached again from the data it replaces.
+    With escalation_only, locations which are not at an escalation level are
+    left out, as changes to their workers do not affect any recipients."""
+    Location = apps.get_model('locations', 'Location')
+    sites = Location.objects.all()
+    if location_ids is not None:
+        locations = Location.objects.filter(pk__in=location_ids)
+        if escalation_only:
+            locations = locations.filter(loc_type__code__in=ESCALATION_LEVELS)
+        subtrees = [Q(tree_id=tree_id, lft__gte=lft, rght__lte=rght)
+                    for tree_id, lft, rght in locations.values_list(
+                        'tree_id', 'lft', 'rght')]
+        if not subtrees:
+            return
+        sites = sites.filter(reduce(operator.or_, subtrees))
+    keys = [make_key(pk) for pk in sites.values_list('pk', flat=True)]
+    on_commit(lambda: _cache().delete_many(keys))
+
+
+def _timeout():
+    return getattr(settings, 'ESCALATION_RECIPIENTS_CACHE_TIMEOUT',
+                   DEFAULT_TIMEOUT)
+
+
+# signal receivers, connected in core.models and locations.models
+
+def personnel_pre_save(sender, instance, raw=False, **kwargs):
+    # remember where the worker was, in case it is moved
+    instance._recipients_site_id = None
+    if instance.pk is not None and not raw:
+        instance._recipients_site_id = sender.objects.filter(
+            pk=instance.pk).values_list('site_id', flat=True).first()
+
+
+def personnel_changed(sender, instance, **kwargs):
+    location_ids = set([instance.site_id,
+                        getattr(instance, '_recipients_site_id', None)])
+    location_ids.discard(None)
+    invalidate(location_ids, escalation_only=True)
+
+
+def connection_pre_save(sender, instance, raw=False, **kwargs):
+    # remember whose connection it was, in case it is moved
+    instance._recipients_contact_id = None
+    if instance.pk is not None and not raw:
+        instance._recipients_contact_id = sender.objects.filter(
+            pk=instance.pk).values_list('contact_id', flat=True).first()
+
+
+def connection_changed(sender, instance, **kwargs):
+    Personnel = apps.get_model('core', 'Personnel')
+    contact_ids = set([instance.contact_id,
+                       getattr(instance, '_recipients_contact_id', None)])
+    contact_ids.discard(None)
+    if not contact_ids:
+        return
+    invalidate(list(Personnel.objects.filter(
+        contact__pk__in=contact_ids).values_list('site_id', flat=True)),
+        escalation_only=True)
+
+
+def location_saved(sender, instance, raw=False, **kwargs):
+    # the sites below the location may have new ancestors
+    if not raw:
+        invalidate([instance.pk])
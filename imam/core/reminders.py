@@ -0,0 +1,101 @@
+"""Weekly reminders of the pending stock alerts.
+
+Rather than one SMS per alert and recipient, every recipient gets a digest of
+the alerts of all the sites it is an escalation recipient of (see
+core.recipients), split into as few messages as the SMS length allows.
+Recipients getting identical digests share the same outbox messages, which
+the outbox dispatcher coalesces and paces (see messagebox.outbox); digests
+built outside the sending window are held until it opens (see
+messagebox.schedule).
+"""
+from __future__ import unicode_literals
+from collections import defaultdict, OrderedDict
+
+from django.conf import settings
+from django.utils.translation import ugettext as _
+
+from messagebox import outbox, schedule
+from messagebox.tasks import dispatch_outbound
+from . import recipients
+from .models import LowStockAlert, StockOutReport
+
+DEFAULT_MAX_LENGTH = 160  # characters, one SMS
+
+SEPARATOR = '; '
+ELLIPSIS = '...'
+
+
+def alert_lines():
+    """Returns a list of (site id, line) for every pending alert, ordered by
+    site."""
+    lines = []
+    stock_outs = StockOutReport.objects.select_related(
+        'site').prefetch_related('items')
+    for stock_out in stock_outs:
+        lines.append((stock_out.site, _(
+            '{site_name} ({site_id}) out of {items} since {date}').format(
+            site_name=stock_out.site.name, site_id=stock_out.site.hcid,
+            items=', '.join(sorted(item.code
+                                   for item in stock_out.items.all())),
+            date=stock_out.modified.strftime('%d/%m/%y'))))
+    for alert in LowStockAlert.objects.select_related('site', 'item'):
+        lines.append((alert.site, _(
+            '{site_name} ({site_id}) low on {item} since {date}').format(
+            site_name=alert.site.name, site_id=alert.site.hcid,
+            item=alert.item.code, date=alert.modified.strftime('%d/%m/%y'))))
+    lines.sort(key=lambda entry: (entry[0].name, entry[0].pk))
+    return [(site.pk, line) for site, line in lines]
+
+
+def pack(lines, max_length=DEFAULT_MAX_LENGTH):
+    """Joins lines into as few messages of at most max_length characters as
+    possible, each starting with the reminder header.  Lines too long for a
+    message of their own are truncated."""
+    header = _('Stock alert reminder: ')
+    room = max_length - len(header)
+    messages = []
+    current = []
+    size = 0
+    for line in lines:
+        if len(line) > room:
+            line = line[:room - len(ELLIPSIS)] + ELLIPSIS
+        added = len(line) + (len(SEPARATOR) if current else 0)
+        if current and size + added > room:
+            messages.append(header + SEPARATOR.join(current))
+            current, size = [], 0
+            added = len(line)
+        current.append(line)
+        size += added
+    if current:
+        messages.append(header + SEPARATOR.join(current))
+    return messages
+
+
+def build_digests(max_length=None):
+    """Returns an ordered dict of each digest message to the list of phone
+    numbers it is for."""
+    if max_length is None:
+        max_length = getattr(settings, 'REMINDER_MAX_LENGTH',
+                             DEFAULT_MAX_LENGTH)
+    by_recipient = defaultdict(list)
+    for site_id, line in alert_lines():
+        for phone_number in recipients.get(site_id):
+            by_recipient[phone_number].append(line)
+
+    digests = OrderedDict()
+    for phone_number in sorted(by_recipient):
+        for message in pack(by_recipient[phone_number], max_length):
+            digests.setdefault(message, []).append(phone_number)
+    return digests
+
+
+def send_digests():
+    """Queues the digests in the outbox, or holds them until the sending
+    window opens.  Returns the number of messages queued."""
+    queued = 0
+    for message, phone_numbers in build_digests().items():
+        if not schedule.hold(message, phone_numbers):
+            queued += outbox.enqueue(message, phone_numbers)
+    if queued:
+        dispatch_outbound.delay()
+    return queued
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+# Sent by LocationProgramState.update_all() and reset_all() after they have
+# rewritten site states with queryset updates, which do not send post_save.
+site_states_rebuilt = Signal()
+
+# Sent by locations.models.WeeklyProgramTotal.rebuild(), after the program
+# reports have been loaded in bulk or the locations moved.
+weekly_totals_rebuilt = Signal()
@@ -1,11 +1,13 @@
 from celery import task
-from .models import LowStockAlert, StockOutReport
+from .models import LocationProgramState
+from .reminders import send_digests
 
 
 @task
 def reminders():
-    for alert in LowStockAlert.objects.all():
-        alert.generate_notification()
+    send_digests()
 
-    for stockout in StockOutReport.objects.all():
-        stockout.generate_notification()
+
+@task
+def update_due_site_states():
+    LocationProgramState.update_due()
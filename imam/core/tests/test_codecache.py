@@ -0,0 +1,103 @@
+from __future__ import unicode_literals
+
+import mock
+from model_mommy import mommy
+
+import django.test
+
+import core.codecache
+import core.models
+
+
+class CodeCacheTest(django.test.SimpleTestCase):
+    def setUp(self):
+        self.cache = core.codecache.CodeCache(max_size=3, ttl=60)
+        self.loader = mock.Mock(side_effect=lambda code: 'obj-%s' % code)
+
+    def test_second_lookup_is_a_hit(self):
+        self.cache.resolve(core.models.Item, 'rutf', self.loader)
+        self.cache.resolve(core.models.Item, 'rutf', self.loader)
+        self.assertEqual(self.loader.call_count, 1)
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_keys_are_case_insensitive(self):
+        self.cache.resolve(core.models.Item, 'rutf', self.loader)
+        self.assertEqual(
+            self.cache.resolve(core.models.Item, ' RUTF ', self.loader),
+            'obj-RUTF')
+        self.assertEqual(self.loader.call_count, 1)
+
+    def test_loader_gets_the_normalised_code(self):
+        self.cache.resolve(core.models.Item, ' rutf', self.loader)
+        self.loader.assert_called_once_with('RUTF')
+
+    def test_keys_are_per_model(self):
+        self.cache.resolve(core.models.Item, 'x', self.loader)
+        self.cache.resolve(core.models.Program, 'x', self.loader)
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_misses_are_cached(self):
+        loader = mock.Mock(return_value=None)
+        self.assertIsNone(
+            self.cache.resolve(core.models.Item, 'nope', loader))
+        self.assertIsNone(
+            self.cache.resolve(core.models.Item, 'nope', loader))
+        self.assertEqual(loader.call_count, 1)
+
+    def test_entries_expire(self):
+        with mock.patch('core.codecache.time') as mock_time:
+            mock_time.time.return_value = 1000
+            self.cache.resolve(core.models.Item, 'a', self.loader)
+            mock_time.time.return_value = 1061
+            self.cache.resolve(core.models.Item, 'a', self.loader)
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_least_recently_used_entry_evicted(self):
+        for code in ('a', 'b', 'c'):
+            self.cache.resolve(core.models.Item, code, self.loader)
+        self.cache.resolve(core.models.Item, 'a', self.loader)
+        self.cache.resolve(core.models.Item, 'd', self.loader)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertEqual(self.cache.stats()['size'], 3)
+        # 'b' was the least recently used entry
+        self.cache.resolve(core.models.Item, 'b', self.loader)
+        self.assertEqual(self.loader.call_count, 5)
+
+    def test_invalidate_only_drops_given_model(self):
+        self.cache.resolve(core.models.Item, 'a', self.loader)
+        self.cache.resolve(core.models.Program, 'a', self.loader)
+        self.cache.invalidate(core.models.Item)
+        self.assertEqual(self.cache.stats()['size'], 1)
+
+    def test_disabled_cache_always_calls_loader(self):
+        cache = core.codecache.CodeCache(max_size=3, ttl=0)
+        cache.resolve(core.models.Item, 'a', self.loader)
+        cache.resolve(core.models.Item, 'a', self.loader)
+        self.assertEqual(self.loader.call_count, 2)
+
+
+class CodeCacheInvalidationTest(django.test.TestCase):
+    def setUp(self):
+        core.codecache.code_cache.invalidate()
+
+    def test_saving_an_item_invalidates_cached_lookups(self):
+        self.assertIsNone(core.models.Item.get_by_code('RUTF'))
+        item = mommy.make(core.models.Item, code='RUTF')
+        self.assertEqual(core.models.Item.get_by_code('rutf'), item)
+
+        item.alt_code = 'PLMP'
+        item.save()
+        self.assertEqual(core.models.Item.get_by_code('plmp'), item)
+
+    def test_padded_code_is_resolved(self):
+        item = mommy.make(core.models.Item, code='RUTF')
+        self.assertEqual(core.models.Item.get_by_code(' rutf'), item)
+        self.assertEqual(core.models.Item.get_by_code('RUTF'), item)
+
+    def test_deleting_a_program_invalidates_cached_lookups(self):
+        program = mommy.make(core.models.Program, code='OTP')
+        self.assertEqual(core.models.Program.get_by_code('otp'), program)
+        program.delete()
+        self.assertIsNone(core.models.Program.get_by_code('otp'))
@@ -5,14 +5,21 @@ __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 
 
 import mock
+from model_mommy import mommy
 
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rapidsms.tests.harness import RapidTest
 
 
+from locations.models import Location, LocationType
 from ..handlers.base import BaseHandler
 from ..handlers.registration import RegistrationHandler
+from ..handlers.stock import StockReportHandler
 from ..handlers.stockout import StockoutReportHandler
+from ..models import Item, LowStockAlert, Personnel, StockOutReport, \
+    StockReport
 
 
 class BaseHandlerTest(RapidTest):
@@ -63,3 +70,76 @@ class StockoutHandlerTest(RapidTest):
         responses = StockoutReportHandler.test(text=text)
         self.assertTrue(responses)
         self.assertEqual(responses[0], control_response)
+
+
+class StockReportHandlerTest(RapidTest):
+    # statements run by process_command for one stock report, whatever the
+    # number of items in it
+    QUERY_BUDGET = 30
+
+    def setUp(self):
+        site_type = mommy.make(LocationType, code='adm6')
+        self.site = mommy.make(Location, loc_type=site_type)
+        self.worker = mommy.make(Personnel, site=self.site)
+        self.items = [mommy.make(Item, code=code)
+                      for code in ('RUTF', 'F75', 'F100', 'RESOMAL')]
+        self.handler = StockReportHandler(mock.MagicMock(), mock.MagicMock())
+
+    def process(self, *stocks):
+        """Processes a report of the given current stocks of self.items and
+        returns the number of statements it took"""
+        report_data = [{'item': item, 'last_receipt': 10,
+                        'current_stock': stock}
+                       for item, stock in zip(self.items, stocks)]
+        with mock.patch('core.models.send_sms'), \
+                CaptureQueriesContext(connection) as queries:
+            self.handler.process_command(self.worker, None, report_data)
+        return len(queries)
+
+    def test_report_creates_logs(self):
+        self.process(5, 6, 7)
+
+        report = StockReport.objects.get()
+        self.assertEqual(report.site, self.site)
+        self.assertEqual(
+            sorted(report.logs.values_list('item__code', 'current_holding')),
+            [('F100', 7), ('F75', 6), ('RUTF', 5)])
+
+    def test_exhausted_items_are_stocked_out(self):
+        self.process(0, 0, 5)
+
+        stock_out = StockOutReport.objects.get()
+        self.assertEqual(set(stock_out.items.all()), set(self.items[:2]))
+
+        self.process(5, 0, 0)
+
+        stock_out = StockOutReport.objects.get()
+        self.assertEqual(set(stock_out.items.all()),
+                         set([self.items[1], self.items[2]]))
+
+    def test_stock_out_is_deleted_once_restocked(self):
+        self.process(0, 5)
+        self.process(5, 5)
+
+        self.assertFalse(StockOutReport.objects.exists())
+
+    def test_stock_out_clears_low_stock_alert(self):
+        mommy.make(LowStockAlert, site=self.site, item=self.items[0])
+
+        self.process(0)
+
+        self.assertFalse(LowStockAlert.objects.exists())
+
+    def test_statements_within_budget(self):
+        self.process(5)  # warms the caches
+
+        for stocks in [(5,), (5, 6, 7, 8), (0,), (0, 0, 0, 0), (5, 0, 5, 0),
+                       (5, 5, 5, 5)]:
+            self.assertLessEqual(self.process(*stocks), self.QUERY_BUDGET)
+
+    def test_statements_do_not_depend_on_the_number_of_items(self):
+        self.process(5)  # warms the caches
+        self.assertEqual(self.process(5), self.process(5, 6, 7, 8))
+
+        self.process(0)  # creates the stock out report
+        self.assertEqual(self.process(0), self.process(0, 0, 0, 0))
@@ -0,0 +1,88 @@
+from __future__ import unicode_literals
+
+import mock
+
+import django.test
+from django.conf.urls import url
+from django.core.urlresolvers import Resolver404, reverse
+from django.http import HttpResponse
+
+import core.importprofile
+import core.lazy
+
+
+class LazyActionTest(django.test.SimpleTestCase):
+    def test_module_is_imported_when_action_is_run(self):
+        module = mock.Mock()
+        with mock.patch('core.lazy.import_module',
+                        return_value=module) as import_module:
+            action = core.lazy.lazy_action('some.actions', 'export_it')
+            self.assertFalse(import_module.called)
+            self.assertEqual(action.__name__, 'export_it')
+
+            action('modeladmin', 'request', 'queryset')
+        import_module.assert_called_once_with('some.actions')
+        module.export_it.assert_called_once_with('modeladmin', 'request',
+                                                 'queryset')
+
+    def test_description_is_that_of_the_action(self):
+        module = mock.Mock()
+        module.export_it.short_description = 'Exporter'
+        with mock.patch('core.lazy.import_module',
+                        return_value=module) as import_module:
+            action = core.lazy.lazy_action('some.actions', 'export_it')
+            self.assertFalse(import_module.called)
+            self.assertEqual(action.short_description, 'Exporter')
+
+
+def item_view(request, pk):
+    return HttpResponse(reverse('lazy-item', args=[pk]))
+
+
+class LazyURLConfViewTest(django.test.SimpleTestCase):
+    def setUp(self):
+        self.view = core.lazy.LazyURLConfView([
+            url(r'^items/(\d+)/$', item_view, name='lazy-item')])
+
+    def get(self, path, rest):
+        request = django.test.RequestFactory().get(path)
+        return self.view(request, path=rest)
+
+    def test_rest_of_the_path_is_resolved_and_reversed_under_the_prefix(self):
+        response = self.get('/things/api/items/3/', 'items/3/')
+        self.assertEqual(response.content, b'/things/api/items/3/')
+        response = self.get('/other/items/4/', 'items/4/')
+        self.assertEqual(response.content, b'/other/items/4/')
+
+    def test_unknown_path(self):
+        with self.assertRaises(Resolver404):
+            self.get('/things/api/nothing/', 'nothing/')
+
+
+class ImportTimerTest(django.test.SimpleTestCase):
+    def requested(self, name, fromlist=None, level=-1, new=(),
+                  module='core.admin'):
+        return core.importprofile.ImportTimer._requested(
+            name, {'__name__': module}, fromlist, level, set(new))
+
+    def test_time_goes_to_the_requested_module(self):
+        self.assertEqual(self.requested('a.b', new=['a', 'a.b', 'a.b.c.d']),
+                         'a.b')
+
+    def test_relative_imports_are_resolved(self):
+        self.assertEqual(self.requested('lazy', level=1, new=['core.lazy']),
+                         'core.lazy')
+        self.assertEqual(self.requested('lazy', new=['core.lazy']),
+                         'core.lazy')
+        self.assertEqual(self.requested('', fromlist=['utils'], level=2,
+                                        module='core.handlers.stock',
+                                        new=['core.utils']),
+                         'core.utils')
+
+    def test_submodules_imported_from_a_package(self):
+        self.assertEqual(self.requested('xml.dom', fromlist=['minidom'],
+                                        new=['xml.dom', 'xml.dom.minidom']),
+                         'xml.dom.minidom')
+
+    def test_nothing_recorded_for_loaded_modules(self):
+        self.assertIsNone(self.requested('json', new=['json.decoder']))
@@ -10,8 +10,10 @@ from model_mommy import mommy
 import django.db
 import django.utils.timezone
 import django.test
+import django.test.utils
 import django.forms.models
 
+import core.codecache
 import core.models
 import locations.models
 
@@ -407,6 +409,31 @@ class LocationProgramStateTest(django.test.TestCase):
         self._check_current_state_updater_called_for_all_instances(
             class_method=core.models.LocationProgramState.reset_all)
 
+    def _count_queries(self, class_method):
+        with django.test.utils.CaptureQueriesContext(
+                django.db.connection) as context:
+            class_method()
+        return len(context.captured_queries)
+
+    def test_bulk_methods_query_count_independent_of_combinations(self):
+        """update_all() and reset_all() should not issue queries per
+        program-site combination.
+        """
+        for class_method in (core.models.LocationProgramState.update_all,
+                             core.models.LocationProgramState.reset_all):
+            core.models.LocationProgramState.objects.all().delete()
+            core.models.ProgramReport.objects.all().delete()
+            mommy.make(core.models.ProgramReport, _quantity=2)
+            few = self._count_queries(class_method)
+            core.models.LocationProgramState.objects.all().delete()
+            mommy.make(core.models.ProgramReport, _quantity=8)
+            many = self._count_queries(class_method)
+            self.assertEqual(core.models.LocationProgramState.objects.filter(
+                current_state='ACTIVE').count(), 10)
+            self.assertEqual(few, many, '%s() issued %d queries for 2 '
+                                        'combinations but %d for 10.' % (
+                                 class_method.__name__, few, many))
+
     def _serialise_instances(self):
         """Return a list of instances turned into dictionaries."""
         result = core.models.LocationProgramState.objects.all()
@@ -961,3 +988,225 @@ class LocationProgramStateTest(django.test.TestCase):
             mommy.make(core.models.LocationProgramState, program=p0, site=l1)
             mommy.make(core.models.LocationProgramState, program=p1, site=l0)
             mommy.make(core.models.LocationProgramState, program=p1, site=l1)
+
+    def test_saving_program_report_updates_existing_instance(self):
+        weeks_ago_20 = self._current_state_date_with_delta(weeks_ago=20)
+        lps = self._prepare_lps_and_pr(pr_creation_dates=[weeks_ago_20],
+                                       lps_last_report_date=None)
+        lps.update_current_state()
+        lps.save()
+        self.assertEqual(lps.current_state, 'INACTIVE')
+        # a new report arrives; no query for the other reports is needed
+        pr = mommy.make(core.models.ProgramReport, site=lps.site,
+                        program=lps.program)
+        lps = core.models.LocationProgramState.objects.get(pk=lps.pk)
+        self.assertEqual(lps.current_state, 'ACTIVE')
+        self.assertEqual(lps.first_report_created, weeks_ago_20)
+        self.assertEqual(lps.last_report_created, pr.created)
+        self.assertEqual(
+            lps.next_state_check,
+            pr.created + dateutil.relativedelta.relativedelta(weeks=8))
+        # and is deleted again
+        pr.delete()
+        lps = core.models.LocationProgramState.objects.get(pk=lps.pk)
+        self.assertEqual(lps.current_state, 'INACTIVE')
+        self.assertEqual(lps.last_report_created, weeks_ago_20)
+        self.assertIsNone(lps.next_state_check)
+
+    def test_moving_program_report_updates_both_instances(self):
+        weeks_ago_20 = self._current_state_date_with_delta(weeks_ago=20)
+        old = self._prepare_lps_and_pr(pr_creation_dates=[weeks_ago_20],
+                                       lps_last_report_date=None)
+        new = mommy.make(core.models.LocationProgramState,
+                         program=old.program)
+        pr = core.models.ProgramReport.objects.get(site=old.site)
+
+        pr.site = new.site
+        pr.save()
+
+        old = core.models.LocationProgramState.objects.get(pk=old.pk)
+        self.assertIsNone(old.first_report_created)
+        self.assertIsNone(old.last_report_created)
+        new = core.models.LocationProgramState.objects.get(pk=new.pk)
+        self.assertEqual(new.first_report_created, weeks_ago_20)
+        self.assertEqual(new.last_report_created, weeks_ago_20)
+
+    def test_raw_save_of_program_report_updates_instance(self):
+        weeks_ago_20 = self._current_state_date_with_delta(weeks_ago=20)
+        lps = self._prepare_lps_and_pr(pr_creation_dates=[weeks_ago_20],
+                                       lps_last_report_date=None)
+        pr = core.models.ProgramReport.objects.get(site=lps.site)
+        weeks_ago_30 = self._current_state_date_with_delta(weeks_ago=30)
+        pr.created = weeks_ago_30
+
+        # as reversion does when reverting a report
+        pr.save_base(raw=True)
+
+        lps = core.models.LocationProgramState.objects.get(pk=lps.pk)
+        self.assertEqual(lps.first_report_created, weeks_ago_30)
+        self.assertEqual(lps.last_report_created, weeks_ago_30)
+
+    def test_saving_program_report_does_not_create_instances(self):
+        mommy.make(core.models.ProgramReport)
+        self.assertEqual(
+            core.models.LocationProgramState.objects.all().count(), 0)
+
+    def test_update_due_only_updates_instances_past_next_state_check(self):
+        lps_due = self._prepare_lps_and_pr(
+            pr_creation_dates=[self._current_state_date_with_delta(weeks_ago=9)],
+            lps_last_report_date=None)
+        lps_not_due = self._prepare_lps_and_pr(
+            pr_creation_dates=[self._current_state_date_with_delta(weeks_ago=1)],
+            lps_last_report_date=None)
+        past = self._current_state_date_with_delta(weeks_ago=1)
+        # make both states stale so that it shows which ones are re-evaluated
+        core.models.LocationProgramState.objects.filter(
+            pk__in=[lps_due.pk, lps_not_due.pk]).update(current_state='OUT')
+        core.models.LocationProgramState.objects.filter(
+            pk=lps_due.pk).update(next_state_check=past)
+        core.models.LocationProgramState.update_due()
+        lps_due = core.models.LocationProgramState.objects.get(pk=lps_due.pk)
+        self.assertEqual(lps_due.current_state, 'INACTIVE-NEW')
+        self.assertGreater(lps_due.next_state_check, past)
+        lps_not_due = core.models.LocationProgramState.objects.get(
+            pk=lps_not_due.pk)
+        self.assertEqual(lps_not_due.current_state, 'OUT')
+
+
+class ItemTest(django.test.TestCase):
+    def setUp(self):
+        core.codecache.code_cache.invalidate()
+
+    def test_get_by_codes_resolves_primary_and_alt_codes_in_one_query(self):
+        rutf = mommy.make(core.models.Item, code='RUTF', alt_code='PLMP')
+        f75 = mommy.make(core.models.Item, code='F75', alt_code=None)
+        with self.assertNumQueries(1):
+            items, invalid_codes = core.models.Item.get_by_codes(
+                'rutf', 'f75', 'plmp', 'xyz')
+        self.assertEqual(items, [rutf, f75, rutf])
+        self.assertEqual(invalid_codes, ['xyz'])
+
+    def test_get_by_codes_prefers_primary_codes(self):
+        primary = mommy.make(core.models.Item, code='ABC', alt_code=None)
+        mommy.make(core.models.Item, code='DEF', alt_code='ABC')
+        items, invalid_codes = core.models.Item.get_by_codes('abc')
+        self.assertEqual(items, [primary])
+
+    def test_get_by_codes_uses_cached_lookups(self):
+        mommy.make(core.models.Item, code='RUTF')
+        core.models.Item.get_by_codes('RUTF', 'XYZ')
+        with self.assertNumQueries(0):
+            items, invalid_codes = core.models.Item.get_by_codes('rutf', 'xyz')
+        self.assertEqual(len(items), 1)
+        self.assertEqual(invalid_codes, ['xyz'])
+
+
+class SiteStockThresholdTest(django.test.TestCase):
+    def setUp(self):
+        self.site = mommy.make(locations.models.Location)
+        self.programs = [mommy.make(core.models.Program, code=code)
+                         for code in ('OTP', 'SC', 'SFP')]
+        self.groups = [mommy.make(core.models.PatientGroup, code=code)
+                       for code in ('01', '02', '05')]
+
+    def make_reports(self, program, group, *atots):
+        """Makes a weekly report of program and group for each of atots, the
+        latest one first"""
+        latest = datetime.date(2015, 6, 28)
+        for weeks, atot in enumerate(atots):
+            mommy.make(core.models.ProgramReport, site=self.site,
+                       program=program, group=group,
+                       report_date=latest - datetime.timedelta(weeks=weeks),
+                       new_marasmic_patients=atot, new_oedema_patients=1,
+                       new_relapsed_patients=None)
+
+    def test_minimum_is_the_same_as_computed_from_reports(self):
+        for i, program in enumerate(self.programs):
+            for j, group in enumerate(self.groups):
+                self.make_reports(program, group,
+                                  *range(i + j, 3 * i + 2 * j + 7))
+
+        self.assertAlmostEqual(
+            core.models.SiteStockThreshold.compute([self.site.pk])[
+                self.site.pk],
+            core.models.get_total_minimum_rutf_stock(self.site))
+
+    def test_minimum_leaves_out_the_latest_report(self):
+        self.make_reports(self.programs[0], self.groups[0], 100, 2, 4)
+
+        # (2 + 1 + 4 + 1) / 2 * 1.5
+        self.assertAlmostEqual(
+            core.models.SiteStockThreshold.minimum_for(self.site.pk), 6.0)
+
+    def test_minimum_is_refreshed_when_a_report_is_saved(self):
+        self.make_reports(self.programs[0], self.groups[0], 3, 3)
+        self.assertAlmostEqual(
+            core.models.SiteStockThreshold.minimum_for(self.site.pk), 6.0)
+
+        report = core.models.ProgramReport.objects.earliest('report_date')
+        report.new_marasmic_patients = 7
+        report.save()
+
+        self.assertAlmostEqual(
+            core.models.SiteStockThreshold.minimum_for(self.site.pk), 12.0)
+
+    def test_minimum_is_recomputed_after_a_report_is_deleted(self):
+        self.make_reports(self.programs[0], self.groups[0], 3, 3)
+        core.models.ProgramReport.objects.earliest('report_date').delete()
+
+        self.assertEqual(
+            core.models.SiteStockThreshold.minimum_for(self.site.pk), 0.0)
+
+    def test_minimum_is_a_single_lookup_once_stored(self):
+        self.make_reports(self.programs[0], self.groups[0], 3, 3, 3)
+
+        with self.assertNumQueries(1):
+            core.models.SiteStockThreshold.minimum_for(self.site.pk)
+
+    def test_minimum_of_both_sites_is_refreshed_when_a_report_moves(self):
+        self.make_reports(self.programs[0], self.groups[0], 3, 3)
+        other_site = mommy.make(locations.models.Location)
+        self.assertAlmostEqual(
+            core.models.SiteStockThreshold.minimum_for(self.site.pk), 6.0)
+
+        report = core.models.ProgramReport.objects.earliest('report_date')
+        report.site = other_site
+        report.save()
+
+        self.assertEqual(
+            core.models.SiteStockThreshold.minimum_for(self.site.pk), 0.0)
+        self.assertEqual(
+            core.models.SiteStockThreshold.minimum_for(other_site.pk), 0.0)
+        self.assertEqual(
+            core.models.SiteStockThreshold.objects.count(), 2)
+
+    def test_refresh_updates_rows_stored_meanwhile(self):
+        self.make_reports(self.programs[0], self.groups[0], 3, 3)
+        core.models.SiteStockThreshold.objects.all().delete()
+        compute = core.models.SiteStockThreshold.compute
+
+        def compute_concurrently(site_ids=None):
+            # as if another refresh had stored the site in between
+            core.models.SiteStockThreshold.objects.create(
+                site=self.site, minimum_rutf_stock=1.0)
+            return compute(site_ids)
+
+        with mock.patch.object(core.models.SiteStockThreshold, 'compute',
+                               side_effect=compute_concurrently):
+            core.models.SiteStockThreshold.refresh([self.site.pk])
+
+        self.assertEqual(
+            list(core.models.SiteStockThreshold.objects.values_list(
+                'site', 'minimum_rutf_stock')),
+            [(self.site.pk, 6.0)])
+
+    def test_refresh_stores_every_site_with_reports(self):
+        self.make_reports(self.programs[0], self.groups[0], 3, 3)
+        core.models.SiteStockThreshold.objects.all().delete()
+
+        core.models.SiteStockThreshold.refresh()
+
+        self.assertEqual(
+            list(core.models.SiteStockThreshold.objects.values_list(
+                'site', 'minimum_rutf_stock')),
+            [(self.site.pk, 6.0)])
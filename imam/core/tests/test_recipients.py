@@ -0,0 +1,115 @@
+from __future__ import unicode_literals
+
+from model_mommy import mommy
+from rapidsms.models import Connection
+
+import django.core.cache
+import django.db
+import django.test
+import django.test.utils
+
+import core.models
+import core.recipients
+import locations.models
+
+
+@django.test.utils.override_settings(
+    ESCALATION_RECIPIENTS_CACHE='recipients',
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'recipients': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'recipients-test',
+        },
+    })
+class EscalationRecipientsTest(django.test.TransactionTestCase):
+    # the cached recipients are dropped once changes are committed
+    def setUp(self):
+        django.core.cache.caches['recipients'].clear()
+        types = dict((code, mommy.make(locations.models.LocationType,
+                                       code=code))
+                     for code in ('adm1', 'adm2', 'adm6'))
+        self.state = mommy.make(locations.models.Location,
+                                loc_type=types['adm1'], parent=None)
+        self.lga = mommy.make(locations.models.Location,
+                              loc_type=types['adm2'], parent=self.state)
+        self.other_lga = mommy.make(locations.models.Location,
+                                    loc_type=types['adm2'], parent=self.state)
+        self.site = mommy.make(locations.models.Location,
+                               loc_type=types['adm6'], parent=self.lga)
+        self.make_worker(self.state, '+2340001')
+        self.make_worker(self.lga, '+2340002')
+        self.make_worker(self.other_lga, '+2340003')
+        self.make_worker(self.site, '+2340004')
+
+    def make_worker(self, location, identity):
+        worker = mommy.make(core.models.Personnel, site=location)
+        mommy.make(Connection, contact=worker.contact, identity=identity)
+        return worker
+
+    def test_recipients_are_the_state_and_lga_workers(self):
+        self.assertEqual(core.recipients.get(self.site.pk),
+                         ['+2340001', '+2340002'])
+
+    def test_recipients_are_cached(self):
+        core.recipients.get(self.site.pk)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(core.recipients.get(self.site.pk),
+                             ['+2340001', '+2340002'])
+
+    def test_new_worker_is_a_recipient(self):
+        core.recipients.get(self.site.pk)
+
+        self.make_worker(self.lga, '+2340005')
+
+        self.assertEqual(core.recipients.get(self.site.pk),
+                         ['+2340001', '+2340002', '+2340005'])
+
+    def test_recipients_are_dropped_once_the_change_is_committed(self):
+        core.recipients.get(self.site.pk)
+
+        with django.db.transaction.atomic():
+            self.make_worker(self.lga, '+2340005')
+            # cached again meanwhile, from the data before the change
+            self.assertEqual(core.recipients.get(self.site.pk),
+                             ['+2340001', '+2340002'])
+
+        self.assertEqual(core.recipients.get(self.site.pk),
+                         ['+2340001', '+2340002', '+2340005'])
+
+    def test_changed_connection_is_used(self):
+        core.recipients.get(self.site.pk)
+
+        connection = Connection.objects.get(identity='+2340002')
+        connection.identity = '+2340006'
+        connection.save()
+
+        self.assertEqual(core.recipients.get(self.site.pk),
+                         ['+2340001', '+2340006'])
+
+    def test_moved_worker_is_no_longer_a_recipient(self):
+        core.recipients.get(self.site.pk)
+
+        worker = core.models.Personnel.objects.get(site=self.lga)
+        worker.site = self.other_lga
+        worker.save()
+
+        self.assertEqual(core.recipients.get(self.site.pk), ['+2340001'])
+
+    def test_moved_site_gets_the_recipients_of_its_new_lga(self):
+        core.recipients.get(self.site.pk)
+
+        site = locations.models.Location.objects.get(pk=self.site.pk)
+        site.parent = locations.models.Location.objects.get(
+            pk=self.other_lga.pk)
+        site.save()
+
+        self.assertEqual(core.recipients.get(self.site.pk),
+                         ['+2340001', '+2340003'])
+
+    def test_rebuild_computes_every_site(self):
+        self.assertEqual(core.recipients.rebuild(),
+                         {self.site.pk: ['+2340001', '+2340002']})
@@ -0,0 +1,87 @@
+from __future__ import unicode_literals
+
+import mock
+from model_mommy import mommy
+
+import django.test
+from django.utils.timezone import now
+
+import core.models
+import core.reminders
+import locations.models
+from messagebox.models import OutboundMessage, ScheduledMessage
+
+
+class PackTest(django.test.SimpleTestCase):
+    def test_lines_share_messages(self):
+        messages = core.reminders.pack(['a' * 10, 'b' * 10, 'c' * 10], 80)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].endswith(
+            'a' * 10 + '; ' + 'b' * 10 + '; ' + 'c' * 10))
+
+    def test_messages_fit_max_length(self):
+        lines = ['line %d' % i * 3 for i in range(40)]
+        messages = core.reminders.pack(lines, 160)
+        self.assertTrue(len(messages) > 1)
+        for message in messages:
+            self.assertLessEqual(len(message), 160)
+        for line in lines:
+            self.assertEqual(
+                len([message for message in messages if line in message]), 1)
+
+    def test_long_line_is_truncated(self):
+        messages = core.reminders.pack(['x' * 500], 160)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(len(messages[0]), 160)
+        self.assertTrue(messages[0].endswith('...'))
+
+
+class DigestTest(django.test.TestCase):
+    def setUp(self):
+        self.sites = mommy.make(locations.models.Location, _quantity=3)
+        for site in self.sites:
+            mommy.make(core.models.LowStockAlert, site=site)
+        self.recipients = {
+            self.sites[0].pk: ['+2341', '+2342'],
+            self.sites[1].pk: ['+2341', '+2342'],
+            self.sites[2].pk: ['+2343'],
+        }
+        patcher = mock.patch('core.recipients.get',
+                             side_effect=self.recipients.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_digest_per_recipient(self):
+        digests = core.reminders.build_digests(max_length=1000)
+        self.assertEqual(len(digests), 2)
+        self.assertEqual(sorted(digests.values()),
+                         [['+2341', '+2342'], ['+2343']])
+        for message, phone_numbers in digests.items():
+            if phone_numbers == ['+2343']:
+                self.assertIn(self.sites[2].hcid, message)
+                self.assertNotIn(self.sites[0].hcid, message)
+            else:
+                self.assertIn(self.sites[0].hcid, message)
+                self.assertIn(self.sites[1].hcid, message)
+
+    @mock.patch('core.reminders.dispatch_outbound')
+    def test_digests_are_queued_in_the_outbox(self, dispatch_outbound):
+        with self.settings(REMINDER_MAX_LENGTH=1000, BULKSMS_BACKEND='bulk'):
+            with mock.patch('core.reminders.schedule.hold',
+                            return_value=False):
+                self.assertEqual(core.reminders.send_digests(), 3)
+
+        self.assertEqual(sorted(OutboundMessage.objects.values_list(
+            'identity', flat=True)), ['+2341', '+2342', '+2343'])
+        self.assertEqual(dispatch_outbound.delay.call_count, 1)
+
+    @mock.patch('core.reminders.dispatch_outbound')
+    def test_digests_are_held_outside_the_window(self, dispatch_outbound):
+        with self.settings(REMINDER_MAX_LENGTH=1000, BULKSMS_BACKEND='bulk'):
+            with mock.patch('core.reminders.schedule.next_opening',
+                            return_value=now()):
+                self.assertEqual(core.reminders.send_digests(), 0)
+
+        self.assertFalse(OutboundMessage.objects.exists())
+        self.assertEqual(ScheduledMessage.objects.count(), 3)
+        self.assertFalse(dispatch_outbound.delay.called)
@@ -3,8 +3,10 @@ Test code for utilities package
 """
 from __future__ import unicode_literals
 
-from core.utils import Totalizer, iso_week_ends, iso_normalize, iso_week_starts, has_53_weeks, iso_weeks_in
+from core.utils import Totalizer, iso_week_ends, iso_normalize, iso_week_starts, has_53_weeks, iso_weeks_in, on_commit
 
+import django.test
+from django.db import transaction
 import unittest
 import datetime
 import os
@@ -88,3 +90,43 @@ class TestMailQueue(unittest.TestCase):
         new_message.app = "SAM Reports"
         new_message.save()
         assert True  # always passes if it does not crash
+
+
+class OnCommitTest(django.test.TransactionTestCase):
+    def test_called_after_commit(self):
+        calls = []
+        with transaction.atomic():
+            on_commit(lambda: calls.append(1))
+            with transaction.atomic():
+                on_commit(lambda: calls.append(2))
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, [1, 2])
+
+    def test_dropped_on_rollback(self):
+        calls = []
+        try:
+            with transaction.atomic():
+                on_commit(lambda: calls.append(1))
+                raise ValueError
+        except ValueError:
+            pass
+        with transaction.atomic():
+            pass
+        self.assertEqual(calls, [])
+
+    def test_dropped_with_a_rolled_back_savepoint(self):
+        calls = []
+        with transaction.atomic():
+            on_commit(lambda: calls.append(1))
+            try:
+                with transaction.atomic():
+                    on_commit(lambda: calls.append(2))
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(calls, [1])
+
+    def test_called_right_away_outside_transactions(self):
+        calls = []
+        on_commit(lambda: calls.append(1))
+        self.assertEqual(calls, [1])
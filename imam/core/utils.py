@@ -1,6 +1,7 @@
 import numbers
 from datetime import date, timedelta
 from dateutil.relativedelta import relativedelta, SU, MO
+from django.db import transaction
 
 def iso_week_ends(week, year=None):
     "the date of the last day (Sunday) of the given ISO week in the given year (default=present or past year)"
@@ -31,6 +32,18 @@ def iso_weeks_in(year):
 def chunker(seq, size):
     return (seq[pos:pos + size] for pos in xrange(0, len(seq), size))
 
+
+def on_commit(func, using=None):
+    """Calls func once the current transaction is committed, or right away
+    outside of transactions; it is dropped if the transaction (or the
+    savepoint it was registered in) is rolled back.
+
+    Same as transaction.on_commit() in Django 1.9, through the database
+    engines of django-transaction-hooks (see DATABASES).
+    """
+    transaction.get_connection(using).on_commit(func)
+
+
 class Totalizer(dict):
 
     def __init__(self, iterable=[]):
@@ -0,0 +1,151 @@
+"""Compares the batched ORM engine with the COPY engine on a synthetic dump.
+
+From a Django shell on a PostgreSQL database with some sites, workers, groups,
+programs, items and connections:
+
+    from datamanager import benchmark
+    benchmark.run(rows=1000000, dump='program_reports')
+
+A file of the given number of random rows built from the existing reference
+data is imported and the table is then exported again, once with each engine.
+Everything is done in transactions which are rolled back, so the database is
+left unchanged.
+"""
+from __future__ import print_function, unicode_literals
+import csv
+import os
+import random
+import shutil
+import tempfile
+import time
+from calendar import timegm
+from datetime import datetime, timedelta
+
+from django.db import connection, transaction
+
+from . import datadump, importdumps, pgcopy
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _reference_data():
+    lookups = importdumps.Lookups()
+    data = dict((name, sorted(lookups.mapping(name)))
+                for name in ('sites', 'reporters', 'connections', 'groups',
+                             'programs', 'items'))
+    missing = [name for name, values in data.items() if not values]
+    if missing:
+        raise ValueError('No {} to build rows from'.format(
+            ', '.join(sorted(missing))))
+    return data
+
+
+def _program_report(data, timestamp):
+    return [random.choice(data['sites']), random.choice(data['reporters']),
+            timestamp, random.choice(data['groups']),
+            random.choice(data['programs']), 'w', random.randint(1, 52)] + [
+        random.randint(0, 50) for column in range(8)]
+
+
+def _stock_report(data, timestamp):
+    items = random.sample(data['items'], min(3, len(data['items'])))
+    return [random.choice(data['sites']), random.choice(data['reporters']),
+            timestamp, '; '.join('{} {} {}'.format(
+                code, random.randint(0, 500), random.randint(0, 500))
+                for code in items)]
+
+
+def _message(data, timestamp):
+    return [random.choice(data['connections']), 'benchmark',
+            random.choice('IO'), timestamp,
+            'REP {} {}'.format(random.randint(1, 99999),
+                               random.randint(1, 52))]
+
+
+DUMPS = {
+    'program_reports': (pgcopy.PROGRAM_REPORT_COLUMNS, _program_report),
+    'stock_reports': (pgcopy.STOCK_REPORT_COLUMNS, _stock_report),
+    'messages': (pgcopy.MESSAGE_COLUMNS, _message),
+}
+
+IMPORTS = {
+    'orm': {
+        'program_reports': lambda path: importdumps.import_program_report_dump(
+            path, refresh=False),
+        'stock_reports': importdumps.import_stock_report_dump,
+        'messages': importdumps.import_message_dump,
+    },
+    'copy': {
+        'program_reports': lambda path: pgcopy.import_program_report_dump(
+            path, refresh=False),
+        'stock_reports': pgcopy.import_stock_report_dump,
+        'messages': pgcopy.import_message_dump,
+    },
+}
+
+EXPORTS = {
+    'orm': datadump.DUMPS,
+    'copy': pgcopy.EXPORTS,
+}
+
+
+def write_rows(path, dump, rows, seed=0):
+    """Writes a dump file of rows random rows made of the existing reference
+    data."""
+    columns, make_row = DUMPS[dump]
+    data = _reference_data()
+    random.seed(seed)
+    start = timegm((datetime.utcnow() - timedelta(days=365)).utctimetuple())
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow([header for column, header in columns])
+        for n in xrange(rows):
+            row = make_row(data, start + n * 30)
+            writer.writerow([value.encode('utf-8')
+                             if isinstance(value, unicode) else value
+                             for value in row])
+
+
+def _timed(results, engine, operation, function, *args):
+    started = time.time()
+    rows = function(*args)[1 if operation == 'export' else 0]
+    elapsed = time.time() - started
+    results.append((engine, operation, rows, elapsed))
+
+
+def run(rows=1000000, dump='program_reports', seed=0):
+    if connection.vendor != 'postgresql':
+        raise ValueError('The benchmark requires PostgreSQL')
+
+    directory = tempfile.mkdtemp(prefix='dump-benchmark-')
+    cwd = os.getcwd()
+    results = []
+    try:
+        path = os.path.join(directory, 'source.csv')
+        print('Writing {} synthetic {} rows...'.format(rows, dump))
+        write_rows(path, dump, rows, seed)
+
+        # exports write to the current directory
+        os.chdir(directory)
+        for engine in ('orm', 'copy'):
+            try:
+                with transaction.atomic():
+                    _timed(results, engine, 'import',
+                           IMPORTS[engine][dump], path)
+                    _timed(results, engine, 'export', EXPORTS[engine][dump])
+                    raise _Rollback
+            except _Rollback:
+                pass
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+    print('{:<6} {:<8} {:>10} {:>10} {:>10}'.format(
+        'engine', 'step', 'rows', 'seconds', 'rows/s'))
+    for engine, operation, count, elapsed in results:
+        print('{:<6} {:<8} {:>10} {:>10.1f} {:>10.0f}'.format(
+            engine, operation, count, elapsed,
+            (count or 0) / elapsed if elapsed else 0))
+    return results
@@ -1,114 +1,141 @@
 from __future__ import unicode_literals
+import hashlib
+import json
+import multiprocessing
+import os
 from calendar import timegm
+from collections import OrderedDict
 from rapidsms.models import Connection
 from rapidsms.contrib.messagelog.models import Message
-from tablib import Dataset
 
 from core.models import Personnel, ProgramReport, StockReport, StockOutReport
+from django.db import connections
+from django.utils.timezone import now
 
+from . import pgcopy
+from .streaming import (DEFAULT_CHUNK_SIZE, export_csv, exported_snapshot,
+                        snapshot_transaction)
 
-def dump_connections():
+
+def _mobile(worker):
+    """The mobile number of worker (its default connection) from the
+    prefetched connections of its contact, or None."""
+    if worker is None:
+        return None
+    connections = worker.contact.connection_set.all()
+    return connections[0].identity if connections else None
+
+
+def _international(mobile):
+    return mobile is not None and mobile.startswith('+')
+
+
+def dump_connections(chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
     print('Running connection dump...')
-    dataset = Dataset()
-    dataset.headers = ['Identity', 'Backend']
+    queryset = Connection.objects.filter(
+        identity__startswith='+').select_related('backend')
 
-    for connection in Connection.objects.filter(identity__startswith='+'):
-        dataset.append([
+    def make_row(connection):
+        return [
             connection.identity,
             connection.backend.name
-        ])
-
-    with open('connections.csv', 'w') as f:
-        f.write(dataset.csv)
+        ]
 
-    print('Done')
+    return export_csv('connections.csv', ['Identity', 'Backend'], queryset,
+                      make_row, chunk_size, compress)
 
 
-def dump_personnel():
+def dump_personnel(chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
     print('Running worker dump...')
-    dataset = Dataset()
-    dataset.headers = ['Site ID', 'Name', 'Position', 'Email', 'Mobile']
+    queryset = Personnel.objects.select_related(
+        'site', 'position', 'contact').prefetch_related(
+        'contact__connection_set')
 
-    for worker in Personnel.objects.all():
-        if not worker.mobile.startswith('+'):
-            continue
+    def make_row(worker):
+        mobile = _mobile(worker)
+        if not _international(mobile):
+            return None
 
-        dataset.append([
+        return [
             worker.site.hcid,
             worker.name,
             worker.position.code,
             worker.email,
-            worker.mobile
-        ])
+            mobile
+        ]
 
-    with open('workers.csv', 'w') as f:
-        f.write(dataset.csv)
+    return export_csv('workers.csv', ['Site ID', 'Name', 'Position',
+                                      'Email', 'Mobile'], queryset, make_row,
+                      chunk_size, compress)
 
-    print('Done')
 
-
-def dump_stockouts():
+def dump_stockouts(chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
     print('Running stockout dump...')
-    dataset = Dataset()
-    dataset.headers = ['Site ID', 'Mobile', 'Timestamp', 'Items']
+    queryset = StockOutReport.objects.order_by('created').select_related(
+        'site', 'reporter__contact').prefetch_related(
+        'reporter__contact__connection_set', 'items')
 
-    for stockout in StockOutReport.objects.order_by('created'):
-        if not stockout.reporter.mobile.startswith('+'):
-            continue
+    def make_row(stockout):
+        mobile = _mobile(stockout.reporter)
+        if not _international(mobile):
+            return None
 
-        dataset.append([
+        return [
             stockout.site.hcid,
-            stockout.reporter.mobile,
+            mobile,
             timegm(stockout.created.utctimetuple()),
-            stockout.summary
-        ])
-
-    with open('stockouts.csv', 'w') as f:
-        f.write(dataset.csv)
+            ', '.join(item.code for item in stockout.items.all())
+        ]
 
-    print('Done')
+    return export_csv('stockouts.csv', ['Site ID', 'Mobile', 'Timestamp',
+                                        'Items'], queryset, make_row,
+                      chunk_size, compress)
 
 
-def dump_stock_reports():
+def dump_stock_reports(chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
     print('Running stock report dump...')
-    dataset = Dataset()
-    dataset.headers = ['Site ID', 'Mobile', 'Timestamp', 'Items']
+    queryset = StockReport.objects.order_by('created').select_related(
+        'site', 'reporter__contact').prefetch_related(
+        'reporter__contact__connection_set', 'logs__item')
 
-    for stock_report in StockReport.objects.order_by('created'):
-        if not stock_report.reporter.mobile.startswith('+'):
-            continue
+    def make_row(stock_report):
+        mobile = _mobile(stock_report.reporter)
+        if not _international(mobile):
+            return None
 
         summary = '; '.join(['{} {} {}'.format(log.item.code, log.last_quantity_received, log.current_holding) for log in stock_report.logs.all()])
 
-        dataset.append([
+        return [
             stock_report.site.hcid,
-            stock_report.reporter.mobile,
+            mobile,
             timegm(stock_report.created.utctimetuple()),
             summary
-        ])
+        ]
 
-    with open('stock_reports.csv', 'w') as f:
-        f.write(dataset.csv)
+    return export_csv('stock_reports.csv', ['Site ID', 'Mobile',
+                                            'Timestamp', 'Items'], queryset,
+                      make_row, chunk_size, compress)
 
-    print('Done')
 
-
-def dump_program_reports():
+def dump_program_reports(chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
     print('Running program report dump...')
-    dataset = Dataset()
-    dataset.headers = ['Site ID', 'Mobile', 'Timestamp', 'Group', 'Program', 'Period code', 'Period number', 'Atot', 'Arel', 'Tin', 'Tout', 'Dead', 'DefT', 'Dcur', 'Dmed']
+    headers = ['Site ID', 'Mobile', 'Timestamp', 'Group', 'Program', 'Period code', 'Period number', 'Atot', 'Arel', 'Tin', 'Tout', 'Dead', 'DefT', 'Dcur', 'Dmed']
+    queryset = ProgramReport.objects.order_by('created').select_related(
+        'site', 'group', 'program', 'reporter__contact').prefetch_related(
+        'reporter__contact__connection_set')
 
-    for report in ProgramReport.objects.select_related('group', 'program').order_by('created'):
-        if not report.reporter.mobile.startswith('+'):
-            continue
+    def make_row(report):
+        mobile = _mobile(report.reporter)
+        if not _international(mobile):
+            return None
 
-        dataset.append([
+        return [
             report.site.hcid,
-            report.reporter.mobile,
+            mobile,
             timegm(report.created.utctimetuple()),
             report.group.code,
             report.program.code,
-            report.period_code,
+            'w',  # weekly, the only type of period left
             report.period_number,
             report.new_marasmic_patients,
             report.readmitted_patients,
@@ -118,41 +145,118 @@ def dump_program_reports():
             report.unconfirmed_patient_defaults,
             report.patients_cured,
             report.unresponsive_patients
-        ])
-
-    with open('program_reports.csv', 'w') as f:
-        f.write(dataset.csv)
+        ]
 
-    print('Done')
+    return export_csv('program_reports.csv', headers, queryset, make_row,
+                      chunk_size, compress)
 
 
-def dump_messages():
+def dump_messages(chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
     print('Running message dump...')
-    dataset = Dataset()
-    dataset.headers = ['Connection', 'Backend', 'Direction', 'Timestamp', 'Text']
+    queryset = Message.objects.filter(
+        connection__identity__startswith='+').order_by(
+        'date', 'pk').select_related('connection__backend')
 
-    for message in Message.objects.all():
-        if not message.connection.identity.startswith('+'):
-            continue
-
-        dataset.append([
+    def make_row(message):
+        return [
             message.connection.identity,
             message.connection.backend.name,
             message.direction,
             timegm(message.date.utctimetuple()),
             message.text
-        ])
-
-    with open('messages.csv', 'w') as f:
-        f.write(dataset.csv)
-
-    print('Done')
-
-
-def run():
-    dump_connections()
-    dump_messages()
-    dump_personnel()
-    dump_stockouts()
-    dump_stock_reports()
-    dump_program_reports()
+        ]
+
+    return export_csv('messages.csv', ['Connection', 'Backend', 'Direction',
+                                       'Timestamp', 'Text'], queryset,
+                      make_row, chunk_size, compress)
+
+
+# in order of (usual) size, so that the largest dumps start first
+DUMPS = OrderedDict([
+    ('messages', dump_messages),
+    ('program_reports', dump_program_reports),
+    ('stock_reports', dump_stock_reports),
+    ('stockouts', dump_stockouts),
+    ('personnel', dump_personnel),
+    ('connections', dump_connections),
+])
+
+MANIFEST = 'manifest.json'
+
+
+def _checksum(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _dump(args):
+    """Runs one dump reading from snapshot and returns its manifest entry."""
+    name, chunk_size, compress, engine, snapshot = args
+    dump = DUMPS[name]
+    if engine == 'copy':
+        dump = pgcopy.EXPORTS.get(name, dump)
+    with snapshot_transaction(snapshot):
+        filename, rows = dump(chunk_size, compress)
+    return OrderedDict([
+        ('dump', name),
+        ('file', filename),
+        ('rows', rows),
+        ('bytes', os.path.getsize(filename)),
+        ('sha256', _checksum(filename)),
+    ])
+
+
+def _dump_in_worker(args):
+    try:
+        return _dump(args)
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+def run(chunk_size=DEFAULT_CHUNK_SIZE, compress=False, processes=1,
+        engine='orm'):
+    """Writes all the dumps and a manifest listing their files, row counts
+    and checksums.  All dumps read from the same snapshot of the database (on
+    PostgreSQL), so they are consistent with each other.
+
+    With processes > 1 the dumps run concurrently in that many worker
+    processes, each with its own database connection.  With engine 'copy'
+    the dumps which pgcopy supports are written with COPY (PostgreSQL only).
+    """
+    started = now()
+    tasks = [(name, chunk_size, compress, engine) for name in DUMPS]
+
+    if processes > 1:
+        # workers are forked now, before the snapshot connection is opened,
+        # so that none of them inherits a connection in use
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(processes)
+        try:
+            with exported_snapshot() as snapshot:
+                files = pool.map(_dump_in_worker,
+                                 [task + (snapshot,) for task in tasks],
+                                 chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        with exported_snapshot() as snapshot:
+            files = [_dump(task + (snapshot,)) for task in tasks]
+
+    manifest = OrderedDict([
+        ('started', started.isoformat()),
+        ('finished', now().isoformat()),
+        ('snapshot', snapshot),
+        ('engine', engine),
+        ('files', files),
+    ])
+    with open(MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print('Wrote {}'.format(MANIFEST))
+    return manifest
@@ -1,12 +1,37 @@
+"""Loading of the CSV files written by datadump.
+
+The program report, stock report, stockout and message dumps are loaded in
+batches: codes, identities and mobile numbers are resolved from maps built
+once per import, the rows of a batch are inserted with bulk_create() in one
+transaction and many-to-many links are inserted directly into their
+through-tables.  Rows which cannot be imported are written, with the reason,
+to a <name>.rejects.csv file next to the source file.
+
+Imports can be interrupted and run again: the progress through the file is
+saved with each batch, along with a checksum of the part of the file read,
+and rows which are in the database already (by their natural key) are
+skipped.  Rows are matched by count: a file with two rows of the same key
+(e.g. two stock reports of a site sent in the same second) imports the
+second one if the database has only one.
+"""
 from __future__ import unicode_literals
 import csv
+import hashlib
+import os
+from collections import Counter
 from datetime import datetime
+from django.db import transaction
 from django.utils.timezone import utc
 from rapidsms.models import Backend, Connection, Contact
 from rapidsms.contrib.messagelog.models import Message
 
-from locations.models import Location
-from core.models import Item, InventoryLog, PatientGroup, Personnel, Position, Program, ProgramReport, StockOutReport, StockReport
+from locations.models import Location, WeeklyProgramTotal
+from core.codecache import normalize_code
+from .models import ImportProgress
+from core.models import Item, InventoryLog, LocationProgramState, PatientGroup, Personnel, Position, Program, ProgramReport, SiteStockThreshold, StockOutReport, StockReport, insert_with_ids
+
+
+BATCH_SIZE = 1000
 
 
 def import_connection_dump(sourcefile):
@@ -50,116 +75,428 @@ def import_personnel_dump(sourcefile):
     print('Done')
 
 
-def import_stockout_dump(sourcefile):
-    with open(sourcefile) as f:
-        reader = csv.DictReader(f)
-
-        for row in reader:
-            site = Location.get_by_code(row['Site ID'])
-            reporter = Connection.objects.get(identity=row['Mobile']).contact.worker
-            created = utc.localize(datetime.utcfromtimestamp(int(row['Timestamp'])))
-            modified = created
-
-            stockout = StockOutReport.objects.create(site=site,
-                reporter=reporter, created=created, modified=modified)
-
-            items = []
-            for item_code in row['Items'].split(','):
-                items.append(Item.get_by_code(item_code.strip()))
-
-            stockout.items.add(*items)
-
-    print('Done')
-
-
-def import_program_report_dump(sourcefile):
-    with open(sourcefile) as f:
-        reader = csv.DictReader(f)
-
-        for row in reader:
-            site = Location.get_by_code(row['Site ID'])
-
-            if not site:
-                print(row)
-                continue
-
-            reporter = Connection.objects.get(identity=row['Mobile']).contact.worker
-            created = utc.localize(datetime.utcfromtimestamp(int(row['Timestamp'])))
-            modified = created
-            group = PatientGroup.get_by_code(row['Group'])
-            program = Program.get_by_code(row['Program'])
-            period_code = row['Period code']
-            period_number = row['Period number']
-            atot = int(row['Atot'])
-            tin = int(row['Tin'])
-            tout = int(row['Tout'])
-            dead = int(row['Dead'])
-            deft = int(row['DefT'])
-            dcur = int(row['Dcur'])
-            dmed = int(row['Dmed'])
-
-            ProgramReport.objects.create(site=site,
-                reporter=reporter,
-                created=created,
-                modified=modified,
-                group=group,
-                program=program,
-                period_number=period_number,
-                period_code=period_code,
-                new_marasmic_patients=atot,
-                patients_transferred_in=tin,
-                patients_transferred_out=tout,
-                patient_deaths=dead,
-                unconfirmed_patient_defaults=deft,
-                patients_cured=dcur,
-                unresponsive_patients=dmed)
-
-    print('Done')
-
-
-def import_message_dump(sourcefile):
-    with open(sourcefile) as f:
-        reader = csv.DictReader(f)
-
-        for row in reader:
-            connection = Connection.objects.get(identity=row['Connection'])
-            direction = row['Direction']
-            timestamp = utc.localize(datetime.utcfromtimestamp(int(row['Timestamp'])))
-            text = row['Text']
-
-            Message.objects.create(connection=connection,
-                direction=direction, date=timestamp,
-                text=text)
-    
-    print('Done')
-
-
-def import_stock_report_dump(sourcefile):
-    with open(sourcefile) as f:
-        reader = csv.DictReader(f)
-
-        for row in reader:
-            site = Location.get_by_code(row['Site ID'])
-
-            if not site:
-                print(row)
-                continue
-
-            reporter = Connection.objects.get(identity=row['Mobile']).contact.worker
-            created = utc.localize(datetime.utcfromtimestamp(int(row['Timestamp'])))
-            logs = []
-            for chunk in row['Items'].split(';'):
-                bits = chunk.split()
-                item = Item.get_by_code(bits[0])
-                received = int(bits[1])
-                holding = int(bits[2])
-            
-                logs.append(InventoryLog.objects.create(item=item,
-                    last_quantity_received=received,
-                    current_holding=holding))
-
-            report = StockReport.objects.create(site=site, reporter=reporter,
-                created=created)
-            report.logs.add(*logs)
-
-    print('Done')
+class RejectedRow(Exception):
+    pass
+
+
+class Rejects(object):
+    """Writes the rows which could not be imported to a CSV file named after
+    the source file, with the reason in an extra Reason column.  The file is
+    only created if there are any."""
+
+    def __init__(self, sourcefile, append=False):
+        self.filename = '{}.rejects.csv'.format(
+            os.path.splitext(sourcefile)[0])
+        self.append = append and os.path.exists(self.filename)
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def add(self, fieldnames, row, reason):
+        if self._writer is None:
+            self._file = open(self.filename, 'ab' if self.append else 'wb')
+            self._writer = csv.DictWriter(self._file,
+                                          list(fieldnames) + ['Reason'])
+            if not self.append:
+                self._writer.writeheader()
+        row = dict(row, Reason='{}'.format(reason).encode('utf-8'))
+        self._writer.writerow(row)
+        self.count += 1
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class Lookups(object):
+    """Maps of codes, identities and mobile numbers to primary keys, each
+    loaded with a single query when first used.  Codes are normalised (see
+    normalize_code()), identities and mobile numbers are matched exactly."""
+
+    def __init__(self):
+        self._maps = {}
+
+    def mapping(self, name):
+        """Returns the map of the given name: sites, reporters, connections,
+        groups, programs or items."""
+        if name not in self._maps:
+            self._maps[name] = getattr(self, '_load_' + name)()
+        return self._maps[name]
+
+    def site(self, hcid):
+        return self._required('sites', normalize_code(hcid), 'site', hcid)
+
+    def reporter(self, mobile):
+        return self._required('reporters', mobile, 'reporter', mobile)
+
+    def connection(self, identity):
+        return self._required('connections', identity, 'connection',
+                              identity)
+
+    def group(self, code):
+        return self._required('groups', normalize_code(code), 'group', code)
+
+    def program(self, code):
+        return self._required('programs', normalize_code(code), 'program',
+                              code)
+
+    def item(self, code):
+        return self._required('items', normalize_code(code), 'item', code)
+
+    def _required(self, name, key, description, value):
+        try:
+            return self.mapping(name)[key]
+        except KeyError:
+            raise RejectedRow('Unknown {} {!r}'.format(description, value))
+
+    @staticmethod
+    def _load_sites():
+        return dict((normalize_code(code), pk) for code, pk in
+                    Location.objects.exclude(hcid=None).values_list('hcid',
+                                                                    'pk'))
+
+    @staticmethod
+    def _load_reporters():
+        return dict(Personnel.objects.exclude(contact__connection=None)
+                    .values_list('contact__connection__identity', 'pk'))
+
+    @staticmethod
+    def _load_connections():
+        return dict(Connection.objects.values_list('identity', 'pk'))
+
+    @staticmethod
+    def _load_groups():
+        return dict((normalize_code(code), pk) for code, pk in
+                    PatientGroup.objects.values_list('code', 'pk'))
+
+    @staticmethod
+    def _load_programs():
+        return dict((normalize_code(code), pk) for code, pk in
+                    Program.objects.values_list('code', 'pk'))
+
+    @staticmethod
+    def _load_items():
+        # primary codes take precedence over alternative ones, as in
+        # Item.get_by_code()
+        items = {}
+        values = Item.objects.values_list('code', 'alt_code', 'pk')
+        for code, alt_code, pk in values:
+            if alt_code:
+                items[normalize_code(alt_code)] = pk
+        for code, alt_code, pk in values:
+            items[normalize_code(code)] = pk
+        return items
+
+
+def _decode(row):
+    return dict((key, value.decode('utf-8') if isinstance(value, bytes)
+                 else value) for key, value in row.items())
+
+
+def _timestamp(value):
+    return utc.localize(datetime.utcfromtimestamp(int(value)))
+
+
+def _integer(row, column):
+    try:
+        return int(row[column])
+    except (TypeError, ValueError):
+        raise RejectedRow('Invalid {} {!r}'.format(column, row[column]))
+
+
+def _fingerprint(sourcefile, offset):
+    """Returns the sha256 of the first offset bytes of sourcefile."""
+    digest = hashlib.sha256()
+    with open(sourcefile, 'rb') as f:
+        remaining = offset
+        while remaining:
+            data = f.read(min(remaining, 1 << 20))
+            if not data:
+                break
+            digest.update(data)
+            remaining -= len(data)
+    return digest
+
+
+def _read(sourcefile, offset=0, digest=None):
+    """Yields the rows of sourcefile which start at or after offset (in
+    bytes), each with the offset at which the next row starts and the sha256
+    of the file up to there, after the list of column names.  digest is the
+    sha256 of the first offset bytes."""
+    if digest is None:
+        digest = _fingerprint(sourcefile, offset)
+    with open(sourcefile, 'rb') as f:
+        def lines():
+            for line in iter(f.readline, b''):
+                digest.update(line)
+                yield line
+
+        header = f.readline()
+        fieldnames = next(csv.reader([header]), [])
+        yield fieldnames
+        if offset:
+            f.seek(offset)
+        else:
+            digest.update(header)
+        # the csv reader only pulls the lines it needs for each row, so the
+        # position of the file is always the end of the last row read
+        for values in csv.reader(lines()):
+            if values:
+                yield dict(zip(fieldnames, values)), f.tell(), \
+                    digest.hexdigest()
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class NaturalKey(object):
+    """The fields which identify a row of model independently of its primary
+    key, used to skip rows which have been imported already.  Existing rows
+    are looked up for each batch by the values of narrow_by (an indexed
+    field) and the range of the values of range_by in the batch.
+    instance(obj) returns the instance of model from what the loader builds
+    for a row."""
+
+    def __init__(self, model, fields, narrow_by, range_by,
+                 instance=lambda obj: obj):
+        self.model = model
+        self.fields = fields
+        self.narrow_by = narrow_by
+        self.range_by = range_by
+        self.instance = instance
+
+    def of(self, obj):
+        instance = self.instance(obj)
+        return tuple(getattr(instance, field) for field in self.fields)
+
+    def existing(self, objects):
+        """Returns how many rows of each key of objects are in the
+        database."""
+        instances = [self.instance(obj) for obj in objects]
+        values = [getattr(instance, self.range_by) for instance in instances]
+        return Counter(self.model.objects.filter(**{
+            self.narrow_by + '__in': set(getattr(instance, self.narrow_by)
+                                         for instance in instances),
+            self.range_by + '__range': (min(values), max(values)),
+        }).values_list(*self.fields))
+
+
+def _load(sourcefile, dump, make_object, insert, natural_key, batch_size,
+          resume=True):
+    """Imports sourcefile batch by batch.  make_object(row, lookups) returns
+    what to insert for a row or raises RejectedRow; insert(objects) inserts
+    the objects of a batch and is run in a transaction.  Rows matching the
+    natural key of a row already in the database are skipped, as many times
+    as there are such rows.
+
+    The progress of the import (see ImportProgress) is saved with every
+    batch, and unless resume is False the import starts after the last row
+    saved, provided the file read so far has not changed since.  Returns the
+    number of rows imported and rejected.
+    """
+    progress, created = ImportProgress.objects.get_or_create(
+        sourcefile=os.path.abspath(sourcefile), dump=dump)
+    digest = None
+    if resume and 0 < progress.offset <= os.path.getsize(sourcefile):
+        digest = _fingerprint(sourcefile, progress.offset)
+        if digest.hexdigest() != progress.fingerprint:
+            print('{} has changed, starting over'.format(sourcefile))
+            digest = None
+    if digest is None:
+        progress.reset()
+    elif progress.rows:
+        print('Resuming after row {}'.format(progress.rows))
+
+    lookups = Lookups()
+    rejects = Rejects(sourcefile, append=progress.rows > 0)
+    imported = rejected = 0
+    try:
+        rows = _read(sourcefile, progress.offset, digest)
+        fieldnames = next(rows)
+        # rows of the previous batch with the same key as rows of the next
+        # one are in the database by then (every dump is sorted by time, so
+        # equal keys are only split across consecutive batches)
+        seen = Counter()
+        for batch in _batches(rows, batch_size):
+            objects = []
+            for row, offset, fingerprint in batch:
+                try:
+                    objects.append(make_object(_decode(row), lookups))
+                except (RejectedRow, KeyError, ValueError) as e:
+                    rejects.add(fieldnames, row, e)
+                    rejected += 1
+            rejects.flush()
+
+            existing = natural_key.existing(objects) if objects \
+                else Counter()
+            seen = Counter(dict((key, count) for key, count in seen.items()
+                                if key in existing))
+            new_objects = []
+            for obj in objects:
+                key = natural_key.of(obj)
+                seen[key] += 1
+                if seen[key] > existing[key]:
+                    new_objects.append(obj)
+
+            with transaction.atomic():
+                if new_objects:
+                    insert(new_objects)
+                progress.offset, progress.fingerprint = batch[-1][1:]
+                progress.rows += len(batch)
+                progress.imported += len(new_objects)
+                progress.duplicates += len(objects) - len(new_objects)
+                progress.rejected += len(batch) - len(objects)
+                progress.save()
+            imported += len(new_objects)
+    finally:
+        rejects.close()
+
+    print('Done, {} rows imported, {} already imported, {} rejected{} '
+          '({} rows in the file so far)'.format(
+              progress.imported, progress.duplicates, progress.rejected,
+              ' (see {})'.format(rejects.filename)
+              if progress.rejected else '', progress.rows))
+    return imported, rejected
+
+
+def refresh_program_report_data():
+    """Brings the data derived from program reports up to date, as
+    bulk_create() does not send the signals which maintain it.  Rebuilding
+    the weekly totals also drops the cached dashboard charts."""
+    LocationProgramState.update_all()
+    WeeklyProgramTotal.rebuild()
+    SiteStockThreshold.refresh()
+
+
+def _stockout(row, lookups):
+    item_ids = [lookups.item(code.strip())
+                for code in row['Items'].split(',') if code.strip()]
+    created = _timestamp(row['Timestamp'])
+    report = StockOutReport(site_id=lookups.site(row['Site ID']),
+                            reporter_id=lookups.reporter(row['Mobile']),
+                            created=created, modified=created)
+    return report, item_ids
+
+
+def _insert_stockouts(rows):
+    insert_with_ids(StockOutReport, [report for report, item_ids in rows])
+    Through = StockOutReport.items.through
+    Through.objects.bulk_create([
+        Through(stockoutreport_id=report.pk, item_id=item_id)
+        for report, item_ids in rows
+        for item_id in set(item_ids)
+    ])
+
+
+STOCKOUT_KEY = NaturalKey(StockOutReport, ('site_id', 'created'),
+                          'site_id', 'created',
+                          instance=lambda obj: obj[0])
+
+
+def import_stockout_dump(sourcefile, batch_size=BATCH_SIZE, resume=True):
+    return _load(sourcefile, 'stockouts', _stockout, _insert_stockouts,
+                 STOCKOUT_KEY, batch_size, resume)
+
+
+def _program_report(row, lookups):
+    created = _timestamp(row['Timestamp'])
+    report = ProgramReport(
+        site_id=lookups.site(row['Site ID']),
+        reporter_id=lookups.reporter(row['Mobile']),
+        created=created,
+        modified=created,
+        group_id=lookups.group(row['Group']),
+        program_id=lookups.program(row['Program']),
+        period_number=_integer(row, 'Period number'),
+        new_marasmic_patients=_integer(row, 'Atot'),
+        patients_transferred_in=_integer(row, 'Tin'),
+        patients_transferred_out=_integer(row, 'Tout'),
+        patient_deaths=_integer(row, 'Dead'),
+        unconfirmed_patient_defaults=_integer(row, 'DefT'),
+        patients_cured=_integer(row, 'Dcur'),
+        unresponsive_patients=_integer(row, 'Dmed'))
+    report.set_computed_fields()
+    return report
+
+
+PROGRAM_REPORT_KEY = NaturalKey(
+    ProgramReport, ('site_id', 'program_id', 'group_id', 'period_number',
+                    'created'), 'site_id', 'created')
+
+
+def import_program_report_dump(sourcefile, batch_size=BATCH_SIZE,
+                               refresh=True, resume=True):
+    result = _load(sourcefile, 'program_reports', _program_report,
+                   ProgramReport.objects.bulk_create, PROGRAM_REPORT_KEY,
+                   batch_size, resume)
+    if refresh:
+        refresh_program_report_data()
+    return result
+
+
+def _message(row, lookups):
+    return Message(connection_id=lookups.connection(row['Connection']),
+                   direction=row['Direction'],
+                   date=_timestamp(row['Timestamp']),
+                   text=row['Text'])
+
+
+MESSAGE_KEY = NaturalKey(Message, ('connection_id', 'date', 'direction',
+                                    'text'), 'connection_id', 'date')
+
+
+def import_message_dump(sourcefile, batch_size=BATCH_SIZE, resume=True):
+    return _load(sourcefile, 'messages', _message,
+                 Message.objects.bulk_create, MESSAGE_KEY, batch_size, resume)
+
+
+def _stock_report(row, lookups):
+    logs = []
+    for chunk in row['Items'].split(';'):
+        bits = chunk.split()
+        if not bits:
+            continue
+        if len(bits) != 3:
+            raise RejectedRow('Invalid item {!r}'.format(chunk))
+        logs.append(InventoryLog(item_id=lookups.item(bits[0]),
+                                 last_quantity_received=int(bits[1]),
+                                 current_holding=int(bits[2])))
+
+    report = StockReport(site_id=lookups.site(row['Site ID']),
+                         reporter_id=lookups.reporter(row['Mobile']),
+                         created=_timestamp(row['Timestamp']))
+    return report, logs
+
+
+def _insert_stock_reports(rows):
+    insert_with_ids(InventoryLog, [log for report, logs in rows
+                                    for log in logs])
+    insert_with_ids(StockReport, [report for report, logs in rows])
+    Through = StockReport.logs.through
+    Through.objects.bulk_create([
+        Through(stockreport_id=report.pk, inventorylog_id=log.pk)
+        for report, logs in rows
+        for log in logs
+    ])
+
+
+STOCK_REPORT_KEY = NaturalKey(StockReport, ('site_id', 'created'),
+                              'site_id', 'created',
+                              instance=lambda obj: obj[0])
+
+
+def import_stock_report_dump(sourcefile, batch_size=BATCH_SIZE, resume=True):
+    return _load(sourcefile, 'stock_reports', _stock_report,
+                 _insert_stock_reports, STOCK_REPORT_KEY, batch_size, resume)
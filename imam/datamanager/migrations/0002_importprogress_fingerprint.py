@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datamanager', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importprogress',
+            name='fingerprint',
+            field=models.CharField(max_length=64, blank=True),
+            preserve_default=True,
+        ),
+    ]
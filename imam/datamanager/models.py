@@ -1,3 +1,30 @@
+from __future__ import unicode_literals
 from django.db import models
+from django_extensions.db import fields
 
-# Create your models here.
+
+class ImportProgress(models.Model):
+    """How far the import of a dump file has got.  It is updated in the same
+    transaction as each batch of rows, so an interrupted import can carry on
+    from the row after the last batch that was committed."""
+    sourcefile = models.CharField(max_length=255)
+    dump = models.CharField(max_length=32)
+    offset = models.BigIntegerField(default=0)  # bytes read from the file
+    fingerprint = models.CharField(max_length=64, blank=True)  # their sha256
+    rows = models.PositiveIntegerField(default=0)  # rows read from the file
+    imported = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)
+    rejected = models.PositiveIntegerField(default=0)
+    created = fields.CreationDateTimeField()
+    modified = fields.ModificationDateTimeField()
+
+    class Meta:
+        unique_together = (('sourcefile', 'dump'),)
+
+    def __unicode__(self):
+        return '{} ({}): {} rows'.format(self.sourcefile, self.dump, self.rows)
+
+    def reset(self):
+        self.offset = self.rows = self.imported = self.duplicates = \
+            self.rejected = 0
+        self.fingerprint = ''
@@ -0,0 +1,476 @@
+"""PostgreSQL COPY engine for the program report, stock report and message
+dumps.
+
+Exports run the whole dump as a single COPY ... TO STDOUT.  Imports COPY the
+file into a temporary staging table, resolve sites, reporters, groups,
+programs, items and connections by joining it with temporary tables holding
+the same maps as the batched loader in importdumps (so both accept the same
+rows), and then insert into the real tables with INSERT ... SELECT.  Rows
+which cannot be imported are written to the same rejects file as with the
+batched loader.
+
+The staging and map tables are dropped at the end of the transaction each
+import runs in.  The columns of the files must be in the order datadump
+writes them.
+"""
+from __future__ import print_function, unicode_literals
+import csv
+import io
+import time
+
+from django.db import connection, transaction
+from django.db.utils import NotSupportedError
+from rapidsms.models import Backend, Connection
+from rapidsms.contrib.messagelog.models import Message
+
+from core.models import (InventoryLog, Item, PatientGroup, Personnel, Program,
+                         ProgramReport, StockReport)
+from core.utils import iso_week_ends
+from locations.models import Location
+from .importdumps import Lookups, Rejects, refresh_program_report_data
+from .streaming import open_output
+
+
+INTEGER = r"'^\s*[-+]?[0-9]+\s*$'"
+
+# the mobile number of a worker is the identity of the first connection of
+# its contact (see Personnel.mobile)
+DEFAULT_CONNECTION = '''
+    JOIN {personnel} worker ON worker.id = report.reporter_id
+    JOIN LATERAL (
+        SELECT identity FROM {connection}
+        WHERE contact_id = worker.contact_id ORDER BY id LIMIT 1
+    ) mobile ON true'''
+
+
+def _tables():
+    return dict(
+        (name, model._meta.db_table) for name, model in (
+            ('backend', Backend),
+            ('connection', Connection),
+            ('group', PatientGroup),
+            ('inventorylog', InventoryLog),
+            ('item', Item),
+            ('location', Location),
+            ('message', Message),
+            ('personnel', Personnel),
+            ('program', Program),
+            ('programreport', ProgramReport),
+            ('stockreport', StockReport),
+            ('stockreport_logs', StockReport.logs.through),
+        )
+    )
+
+
+def _sql(sql, **kwargs):
+    return sql.format(**dict(_tables(), **kwargs))
+
+
+def _check_database():
+    if connection.vendor != 'postgresql':
+        raise NotSupportedError('The COPY engine requires PostgreSQL')
+
+
+def _copy_out(sql, filename, compress):
+    _check_database()
+    started = time.time()
+    f, filename = open_output(filename, compress)
+    with f:
+        cursor = connection.cursor()
+        cursor.copy_expert('COPY ({}) TO STDOUT WITH CSV HEADER'.format(sql),
+                           f)
+        # psycopg2 only reports the number of rows copied in recent versions
+        rows = cursor.rowcount if cursor.rowcount >= 0 else None
+    print('{}: done, {} rows written in {:.1f}s'.format(
+        filename, rows, time.time() - started))
+    return filename, rows
+
+
+def dump_program_reports(chunk_size=None, compress=False):
+    print('Running program report dump (COPY)...')
+    return _copy_out(_sql('''
+        SELECT site.hcid AS "Site ID",
+               mobile.identity AS "Mobile",
+               floor(extract(epoch FROM report.created))::bigint
+                   AS "Timestamp",
+               grp.code AS "Group",
+               program.code AS "Program",
+               'w' AS "Period code",
+               report.period_number AS "Period number",
+               report.new_marasmic_patients AS "Atot",
+               report.readmitted_patients AS "Arel",
+               report.patients_transferred_in AS "Tin",
+               report.patients_transferred_out AS "Tout",
+               report.patient_deaths AS "Dead",
+               report.unconfirmed_patient_defaults AS "DefT",
+               report.patients_cured AS "Dcur",
+               report.unresponsive_patients AS "Dmed"
+        FROM {programreport} report
+        JOIN {location} site ON site.id = report.site_id
+        JOIN {group} grp ON grp.id = report.group_id
+        JOIN {program} program ON program.id = report.program_id''' +
+        DEFAULT_CONNECTION + '''
+        WHERE mobile.identity LIKE '+%'
+        ORDER BY report.created'''), 'program_reports.csv', compress)
+
+
+def dump_stock_reports(chunk_size=None, compress=False):
+    print('Running stock report dump (COPY)...')
+    return _copy_out(_sql('''
+        SELECT site.hcid AS "Site ID",
+               mobile.identity AS "Mobile",
+               floor(extract(epoch FROM report.created))::bigint
+                   AS "Timestamp",
+               coalesce(logs.summary, '') AS "Items"
+        FROM {stockreport} report
+        JOIN {location} site ON site.id = report.site_id''' +
+        DEFAULT_CONNECTION + '''
+        LEFT JOIN LATERAL (
+            SELECT string_agg(item.code || ' ' ||
+                              log.last_quantity_received || ' ' ||
+                              log.current_holding, '; '
+                              ORDER BY log.id) AS summary
+            FROM {stockreport_logs} link
+            JOIN {inventorylog} log ON log.id = link.inventorylog_id
+            JOIN {item} item ON item.id = log.item_id
+            WHERE link.stockreport_id = report.id
+        ) logs ON true
+        WHERE mobile.identity LIKE '+%'
+        ORDER BY report.created'''), 'stock_reports.csv', compress)
+
+
+def dump_messages(chunk_size=None, compress=False):
+    print('Running message dump (COPY)...')
+    return _copy_out(_sql('''
+        SELECT conn.identity AS "Connection",
+               backend.name AS "Backend",
+               message.direction AS "Direction",
+               floor(extract(epoch FROM message.date))::bigint
+                   AS "Timestamp",
+               message.text AS "Text"
+        FROM {message} message
+        JOIN {connection} conn ON conn.id = message.connection_id
+        JOIN {backend} backend ON backend.id = conn.backend_id
+        WHERE conn.identity LIKE '+%'
+        ORDER BY message.date, message.id'''), 'messages.csv', compress)
+
+
+EXPORTS = {
+    'program_reports': dump_program_reports,
+    'stock_reports': dump_stock_reports,
+    'messages': dump_messages,
+}
+
+
+def _copy_in(cursor, table, columns, f):
+    cursor.copy_expert('COPY {} ({}) FROM STDIN WITH CSV HEADER'.format(
+        table, ', '.join(columns)), f)
+
+
+def _create_map(cursor, lookups, name):
+    """Creates the temporary table dump_map_<name> holding the lookup map of
+    that name."""
+    table = 'dump_map_{}'.format(name)
+    cursor.execute('CREATE TEMPORARY TABLE {} (key text PRIMARY KEY, '
+                   'id integer NOT NULL) ON COMMIT DROP'.format(table))
+    data = io.BytesIO()
+    writer = csv.writer(data)
+    writer.writerow(['key', 'id'])
+    for key, pk in lookups.mapping(name).items():
+        writer.writerow([key.encode('utf-8'), pk])
+    data.seek(0)
+    _copy_in(cursor, table, ['key', 'id'], data)
+    cursor.execute('ANALYZE {}'.format(table))
+
+
+def _stage(cursor, sourcefile, columns):
+    """Copies sourcefile into the temporary table dump_rows, with one text
+    column for each of columns and the line number of each row."""
+    cursor.execute('CREATE TEMPORARY TABLE dump_rows ('
+                   'line serial PRIMARY KEY, {}) ON COMMIT DROP'.format(
+                       ', '.join('{} text'.format(c) for c in columns)))
+    with open(sourcefile, 'rb') as f:
+        _copy_in(cursor, 'dump_rows', columns, f)
+    cursor.execute('ANALYZE dump_rows')
+
+
+def _invalid_integers(columns):
+    """CASE branches rejecting the rows in which any of columns (pairs of
+    staging column and CSV header) is not an integer."""
+    return ''.join(
+        "\n            WHEN NOT coalesce(src.{0} ~ {1}, false) "
+        "THEN 'Invalid {2} ' || quote_nullable(src.{0})".format(
+            column, INTEGER, header) for column, header in columns)
+
+
+def _reject(cursor, sourcefile, columns):
+    """Writes the rows of dump_rows with a reason in dump_resolved to the
+    rejects file of sourcefile.  Returns their number."""
+    cursor.execute('SELECT count(*) FROM dump_resolved '
+                   'WHERE reason IS NOT NULL')
+    count = cursor.fetchone()[0]
+    if count:
+        rejects = Rejects(sourcefile)
+        with open(rejects.filename, 'wb') as f:
+            cursor.copy_expert('''
+                COPY (SELECT {}, resolved.reason AS "Reason"
+                      FROM dump_rows src
+                      JOIN dump_resolved resolved USING (line)
+                      WHERE resolved.reason IS NOT NULL
+                      ORDER BY src.line)
+                TO STDOUT WITH CSV HEADER'''.format(', '.join(
+                    'src.{} AS "{}"'.format(column, header)
+                    for column, header in columns)), f)
+        print('{} rows rejected (see {})'.format(count, rejects.filename))
+    return count
+
+
+PROGRAM_REPORT_COLUMNS = (
+    ('site', 'Site ID'),
+    ('mobile', 'Mobile'),
+    ('ts', 'Timestamp'),
+    ('grp', 'Group'),
+    ('program', 'Program'),
+    ('period_code', 'Period code'),
+    ('period_number', 'Period number'),
+    ('atot', 'Atot'),
+    ('arel', 'Arel'),
+    ('tin', 'Tin'),
+    ('tout', 'Tout'),
+    ('dead', 'Dead'),
+    ('deft', 'DefT'),
+    ('dcur', 'Dcur'),
+    ('dmed', 'Dmed'),
+)
+
+
+@transaction.atomic
+def import_program_report_dump(sourcefile, refresh=True):
+    _check_database()
+    cursor = connection.cursor()
+    lookups = Lookups()
+    for name in ('sites', 'reporters', 'groups', 'programs'):
+        _create_map(cursor, lookups, name)
+    _stage(cursor, sourcefile, [c for c, h in PROGRAM_REPORT_COLUMNS])
+
+    counts = ('period_number', 'atot', 'tin', 'tout', 'dead', 'deft', 'dcur',
+              'dmed')
+    cursor.execute('''
+        CREATE TEMPORARY TABLE dump_resolved ON COMMIT DROP AS
+        SELECT src.line, site.id AS site_id, reporter.id AS reporter_id,
+               grp.id AS group_id, program.id AS program_id,
+               CASE WHEN src.period_number ~ {integer}
+               THEN src.period_number::integer END AS period_number,
+               CASE
+            WHEN site.id IS NULL
+            THEN 'Unknown site ' || quote_nullable(src.site)
+            WHEN reporter.id IS NULL
+            THEN 'Unknown reporter ' || quote_nullable(src.mobile)
+            WHEN grp.id IS NULL
+            THEN 'Unknown group ' || quote_nullable(src.grp)
+            WHEN program.id IS NULL
+            THEN 'Unknown program ' || quote_nullable(src.program){invalid}
+               END AS reason
+        FROM dump_rows src
+        LEFT JOIN dump_map_sites site ON site.key = upper(btrim(src.site))
+        LEFT JOIN dump_map_reporters reporter ON reporter.key = src.mobile
+        LEFT JOIN dump_map_groups grp ON grp.key = upper(btrim(src.grp))
+        LEFT JOIN dump_map_programs program
+            ON program.key = upper(btrim(src.program))'''.format(
+        integer=INTEGER, invalid=_invalid_integers([('ts', 'Timestamp')] + [
+            (c, h) for c, h in PROGRAM_REPORT_COLUMNS if c in counts])))
+
+    # report_date is computed in Python (see ProgramReport.save()) for each
+    # distinct period number; the numbers are cast in dump_resolved, as a
+    # join may cast those of rejected rows before they are filtered out
+    cursor.execute('''
+        SELECT DISTINCT period_number FROM dump_resolved
+        WHERE reason IS NULL''')
+    report_dates = io.BytesIO()
+    writer = csv.writer(report_dates)
+    writer.writerow(['period_number', 'report_date'])
+    for (period_number,) in cursor.fetchall():
+        writer.writerow([period_number,
+                         iso_week_ends(period_number).isoformat()])
+    report_dates.seek(0)
+    cursor.execute('CREATE TEMPORARY TABLE dump_report_dates ('
+                   'period_number integer PRIMARY KEY, report_date date) '
+                   'ON COMMIT DROP')
+    _copy_in(cursor, 'dump_report_dates', ['period_number', 'report_date'],
+             report_dates)
+
+    cursor.execute(_sql('''
+        INSERT INTO {programreport} (
+            site_id, reporter_id, created, modified, group_id, program_id,
+            period_number, report_date, new_marasmic_patients,
+            patients_transferred_in, patients_transferred_out, patient_deaths,
+            unconfirmed_patient_defaults, patients_cured,
+            unresponsive_patients, patients_at_period_end)
+        SELECT resolved.site_id, resolved.reporter_id,
+               to_timestamp(src.ts::bigint), now(), resolved.group_id,
+               resolved.program_id, period.period_number, period.report_date,
+               src.atot::integer, src.tin::integer, src.tout::integer,
+               src.dead::integer, src.deft::integer, src.dcur::integer,
+               src.dmed::integer,
+               src.atot::integer + src.tin::integer - src.tout::integer -
+               src.dead::integer - src.deft::integer - src.dcur::integer -
+               src.dmed::integer
+        FROM dump_rows src
+        JOIN dump_resolved resolved USING (line)
+        JOIN dump_report_dates period
+            ON period.period_number = resolved.period_number
+        WHERE resolved.reason IS NULL
+        ORDER BY src.line'''))
+    imported = cursor.rowcount
+    rejected = _reject(cursor, sourcefile, PROGRAM_REPORT_COLUMNS)
+    print('Done, {} rows imported'.format(imported))
+
+    if refresh:
+        refresh_program_report_data()
+    return imported, rejected
+
+
+STOCK_REPORT_COLUMNS = (
+    ('site', 'Site ID'),
+    ('mobile', 'Mobile'),
+    ('ts', 'Timestamp'),
+    ('items', 'Items'),
+)
+
+
+@transaction.atomic
+def import_stock_report_dump(sourcefile):
+    _check_database()
+    cursor = connection.cursor()
+    lookups = Lookups()
+    for name in ('sites', 'reporters', 'items'):
+        _create_map(cursor, lookups, name)
+    _stage(cursor, sourcefile, [c for c, h in STOCK_REPORT_COLUMNS])
+
+    # one row per "<item> <received> <holding>" entry of the Items column
+    cursor.execute(r'''
+        CREATE TEMPORARY TABLE dump_logs ON COMMIT DROP AS
+        SELECT entry.line, entry.n, entry.bits, item.id AS item_id,
+               CASE
+            WHEN array_length(entry.bits, 1) <> 3
+                OR NOT entry.bits[2] ~ {0} OR NOT entry.bits[3] ~ {0}
+            THEN 'Invalid item ' || quote_literal(entry.chunk)
+            WHEN item.id IS NULL
+            THEN 'Unknown item ' || quote_literal(entry.bits[1])
+               END AS reason,
+               NULL::integer AS log_id
+        FROM (
+            SELECT src.line, chunk.n, chunk.chunk,
+                   regexp_split_to_array(btrim(chunk.chunk), '\s+') AS bits
+            FROM dump_rows src,
+                 unnest(string_to_array(coalesce(src.items, ''), ';'))
+                     WITH ORDINALITY AS chunk(chunk, n)
+            WHERE btrim(chunk.chunk) <> ''
+        ) entry
+        LEFT JOIN dump_map_items item ON item.key = upper(entry.bits[1])
+        '''.format(INTEGER))
+    cursor.execute('CREATE INDEX ON dump_logs (line)')
+
+    cursor.execute('''
+        CREATE TEMPORARY TABLE dump_resolved ON COMMIT DROP AS
+        SELECT src.line, site.id AS site_id, reporter.id AS reporter_id,
+               CASE
+            WHEN site.id IS NULL
+            THEN 'Unknown site ' || quote_nullable(src.site)
+            WHEN reporter.id IS NULL
+            THEN 'Unknown reporter ' || quote_nullable(src.mobile){}
+            ELSE invalid.reason
+               END AS reason,
+               NULL::integer AS report_id
+        FROM dump_rows src
+        LEFT JOIN dump_map_sites site ON site.key = upper(btrim(src.site))
+        LEFT JOIN dump_map_reporters reporter ON reporter.key = src.mobile
+        LEFT JOIN (
+            SELECT DISTINCT ON (line) line, reason FROM dump_logs
+            WHERE reason IS NOT NULL ORDER BY line, n
+        ) invalid USING (line)'''.format(
+        _invalid_integers([('ts', 'Timestamp')])))
+
+    # take the keys of the new rows from their sequences up front so that
+    # the links between them can be inserted in bulk as well
+    cursor.execute(_sql('''
+        UPDATE dump_resolved
+        SET report_id = nextval(pg_get_serial_sequence('{stockreport}', 'id'))
+        WHERE reason IS NULL'''))
+    cursor.execute(_sql('''
+        UPDATE dump_logs log
+        SET log_id = nextval(pg_get_serial_sequence('{inventorylog}', 'id'))
+        FROM dump_resolved resolved
+        WHERE resolved.line = log.line AND resolved.report_id IS NOT NULL'''))
+
+    cursor.execute(_sql('''
+        INSERT INTO {inventorylog} (id, item_id, last_quantity_received,
+                                    current_holding, created, modified)
+        SELECT log_id, item_id, bits[2]::integer, bits[3]::integer, now(),
+               now()
+        FROM dump_logs WHERE log_id IS NOT NULL ORDER BY log_id'''))
+    cursor.execute(_sql('''
+        INSERT INTO {stockreport} (id, site_id, reporter_id, created,
+                                   modified)
+        SELECT resolved.report_id, resolved.site_id, resolved.reporter_id,
+               to_timestamp(src.ts::bigint), now()
+        FROM dump_rows src JOIN dump_resolved resolved USING (line)
+        WHERE resolved.report_id IS NOT NULL
+        ORDER BY resolved.report_id'''))
+    imported = cursor.rowcount
+    cursor.execute(_sql('''
+        INSERT INTO {stockreport_logs} (stockreport_id, inventorylog_id)
+        SELECT resolved.report_id, log.log_id
+        FROM dump_logs log JOIN dump_resolved resolved USING (line)
+        WHERE log.log_id IS NOT NULL'''))
+
+    rejected = _reject(cursor, sourcefile, STOCK_REPORT_COLUMNS)
+    print('Done, {} rows imported'.format(imported))
+    return imported, rejected
+
+
+MESSAGE_COLUMNS = (
+    ('connection', 'Connection'),
+    ('backend', 'Backend'),
+    ('direction', 'Direction'),
+    ('ts', 'Timestamp'),
+    ('text', 'Text'),
+)
+
+
+@transaction.atomic
+def import_message_dump(sourcefile):
+    _check_database()
+    cursor = connection.cursor()
+    _create_map(cursor, Lookups(), 'connections')
+    _stage(cursor, sourcefile, [c for c, h in MESSAGE_COLUMNS])
+
+    cursor.execute('''
+        CREATE TEMPORARY TABLE dump_resolved ON COMMIT DROP AS
+        SELECT src.line, conn.id AS connection_id,
+               CASE
+            WHEN conn.id IS NULL
+            THEN 'Unknown connection ' || quote_nullable(src.connection){}
+               END AS reason
+        FROM dump_rows src
+        LEFT JOIN dump_map_connections conn ON conn.key = src.connection
+        '''.format(_invalid_integers([('ts', 'Timestamp')])))
+
+    cursor.execute(_sql('''
+        INSERT INTO {message} (connection_id, direction, date, text)
+        SELECT resolved.connection_id, src.direction,
+               to_timestamp(src.ts::bigint), coalesce(src.text, '')
+        FROM dump_rows src JOIN dump_resolved resolved USING (line)
+        WHERE resolved.reason IS NULL
+        ORDER BY src.line'''))
+    imported = cursor.rowcount
+    rejected = _reject(cursor, sourcefile, MESSAGE_COLUMNS)
+    print('Done, {} rows imported'.format(imported))
+    return imported, rejected
+
+
+IMPORTS = {
+    'program_reports': import_program_report_dump,
+    'stock_reports': import_stock_report_dump,
+    'messages': import_message_dump,
+}
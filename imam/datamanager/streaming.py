@@ -0,0 +1,166 @@
+"""Streaming CSV export of large querysets.
+
+Rows are read in fixed-size chunks: the primary keys come from a server-side
+cursor (on PostgreSQL) and each chunk of instances is then loaded with the
+select_related/prefetch_related lookups of the queryset, so relations cost a
+few queries per chunk rather than one per row.  Rows are written to the CSV
+file (optionally gzip-compressed) as soon as their chunk has been loaded, so
+memory use does not grow with the size of the table.
+"""
+from __future__ import print_function, unicode_literals
+import csv
+import gzip
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+
+DEFAULT_CHUNK_SIZE = 2000
+DEFAULT_PROGRESS_INTERVAL = 10  # seconds
+
+
+def iter_pks(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the primary keys of queryset, in its order, as lists of at most
+    chunk_size."""
+    pks = queryset.prefetch_related(None).values_list('pk', flat=True)
+    connection = connections[queryset.db]
+
+    if connection.vendor != 'postgresql':
+        chunk = []
+        for pk in pks.iterator():
+            chunk.append(pk)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+
+    # named (server-side) cursors only live within a transaction, which also
+    # means every chunk is read from the same snapshot
+    sql, params = pks.query.sql_with_params()
+    with transaction.atomic(using=queryset.db):
+        cursor = connection.connection.cursor(
+            name=str('export_{}'.format(uuid.uuid4().hex)))
+        cursor.itersize = chunk_size
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [row[0] for row in rows]
+        finally:
+            cursor.close()
+
+
+def iter_chunks(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the instances of queryset, in its order, as lists of at most
+    chunk_size with the related objects of the queryset already loaded."""
+    for pks in iter_pks(queryset, chunk_size):
+        objects = dict((obj.pk, obj)
+                       for obj in queryset.order_by().filter(pk__in=pks))
+        yield [objects[pk] for pk in pks if pk in objects]
+
+
+@contextmanager
+def exported_snapshot(using=DEFAULT_DB_ALIAS):
+    """Opens a repeatable read transaction on a new connection and yields the
+    id of its snapshot, which other connections can read from (see
+    snapshot_transaction) until the block exits.  Yields None if the database
+    is not PostgreSQL."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        yield None
+        return
+
+    raw_connection = connection.get_new_connection(
+        connection.get_connection_params())
+    try:
+        cursor = raw_connection.cursor()
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cursor.execute('SELECT pg_export_snapshot()')
+        yield cursor.fetchone()[0]
+    finally:
+        raw_connection.rollback()
+        raw_connection.close()
+
+
+@contextmanager
+def snapshot_transaction(snapshot, using=DEFAULT_DB_ALIAS):
+    """Runs the block in a transaction which reads from the exported snapshot,
+    or in a plain transaction if snapshot is None."""
+    with transaction.atomic(using=using):
+        if snapshot is not None:
+            cursor = connections[using].cursor()
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', [snapshot])
+        yield
+
+
+class Progress(object):
+    """Prints the number of rows exported so far and the rate at most every
+    interval seconds, and a summary when done."""
+
+    def __init__(self, label, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.label = label
+        self.interval = interval
+        self.read = 0
+        self.written = 0
+        self.started = self.reported = time.time()
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.read / elapsed if elapsed else 0.0
+
+    def add(self, read, written):
+        self.read += read
+        self.written += written
+        if time.time() - self.reported >= self.interval:
+            self.reported = time.time()
+            print('{}: {} rows written ({} read), {:.0f} rows/s'.format(
+                self.label, self.written, self.read, self.rate))
+
+    def done(self):
+        print('{}: done, {} rows written ({} read) in {:.1f}s, '
+              '{:.0f} rows/s'.format(self.label, self.written, self.read,
+                                     time.time() - self.started, self.rate))
+
+
+def open_output(filename, compress=False):
+    """Opens filename for writing, through gzip if compress is set (in which
+    case .gz is appended to filename).  Returns the file and its name."""
+    if compress:
+        filename += '.gz'
+        return gzip.open(filename, 'wb'), filename
+    return open(filename, 'wb'), filename
+
+
+def _encode(row):
+    return [value.encode('utf-8') if isinstance(value, unicode) else value
+            for value in row]
+
+
+def export_csv(filename, headers, queryset, make_row,
+               chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
+    """Writes a CSV file with the given headers and a row for every instance
+    of queryset.  make_row(instance) returns the list of values of the row,
+    or None to leave the instance out.
+
+    Returns the name of the file written and the number of rows in it.
+    """
+    f, filename = open_output(filename, compress)
+    progress = Progress(filename)
+    with f:
+        writer = csv.writer(f)
+        writer.writerow(_encode(headers))
+        for chunk in iter_chunks(queryset, chunk_size):
+            rows = [row for row in (make_row(obj) for obj in chunk)
+                    if row is not None]
+            writer.writerows(_encode(row) for row in rows)
+            progress.add(len(chunk), len(rows))
+    progress.done()
+    return filename, progress.written
@@ -0,0 +1,166 @@
+from __future__ import unicode_literals
+import csv
+import os
+import shutil
+import tempfile
+
+from model_mommy import mommy
+from rapidsms.models import Backend, Connection, Contact
+
+import django.test
+
+import core.models
+import locations.models
+from datamanager import importdumps
+from datamanager.models import ImportProgress
+
+PROGRAM_REPORT_HEADERS = [
+    'Site ID', 'Mobile', 'Timestamp', 'Group', 'Program', 'Period code',
+    'Period number', 'Atot', 'Arel', 'Tin', 'Tout', 'Dead', 'DefT', 'Dcur',
+    'Dmed']
+STOCK_REPORT_HEADERS = ['Site ID', 'Mobile', 'Timestamp', 'Items']
+
+
+class ImportDumpTest(django.test.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.site = mommy.make(locations.models.Location, hcid='SITE1')
+        self.group = mommy.make(core.models.PatientGroup, code='6-59M')
+        self.program = mommy.make(core.models.Program, code='OTP')
+        contact = mommy.make(Contact)
+        mommy.make(Connection, identity='+2348000000001', contact=contact,
+                   backend=mommy.make(Backend, name='test'))
+        self.reporter = mommy.make(core.models.Personnel, contact=contact,
+                                   site=self.site)
+
+    def write(self, name, headers, rows):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(headers)
+            writer.writerows(rows)
+        return path
+
+    def append(self, path, rows):
+        with open(path, 'ab') as f:
+            csv.writer(f).writerows(rows)
+
+    def program_report_row(self, timestamp=1420070400, period=1, site='site1',
+                           admissions=5):
+        return [site, '+2348000000001', timestamp, '6-59m', 'otp', 'w',
+                period, admissions, 0, 1, 2, 0, 0, 3, 0]
+
+
+class ProgramReportDumpTest(ImportDumpTest):
+    def test_dump_is_loaded(self):
+        path = self.write('program_reports.csv', PROGRAM_REPORT_HEADERS, [
+            self.program_report_row(),
+            self.program_report_row(period=2, timestamp=1420675200),
+        ])
+        self.assertEqual(importdumps.import_program_report_dump(
+            path, refresh=False), (2, 0))
+
+        report = core.models.ProgramReport.objects.get(period_number=1)
+        self.assertEqual(report.site, self.site)
+        self.assertEqual(report.reporter, self.reporter)
+        self.assertEqual(report.group, self.group)
+        self.assertEqual(report.program, self.program)
+        self.assertEqual(report.new_marasmic_patients, 5)
+        self.assertEqual(report.patients_transferred_in, 1)
+        self.assertEqual(report.patients_transferred_out, 2)
+        self.assertEqual(report.patients_cured, 3)
+        self.assertEqual(report.patients_at_period_end, 1)
+        self.assertIsNotNone(report.report_date)
+
+    def test_invalid_rows_are_rejected(self):
+        path = self.write('program_reports.csv', PROGRAM_REPORT_HEADERS, [
+            self.program_report_row(site='unknown'),
+            self.program_report_row(admissions='many'),
+            self.program_report_row(),
+        ])
+        self.assertEqual(importdumps.import_program_report_dump(
+            path, refresh=False), (1, 2))
+
+        with open(os.path.join(self.directory,
+                               'program_reports.rejects.csv')) as f:
+            reasons = [row['Reason'] for row in csv.DictReader(f)]
+        self.assertEqual(len(reasons), 2)
+        self.assertIn('Unknown site', reasons[0])
+        self.assertIn('Invalid Atot', reasons[1])
+
+
+class ResumeTest(ImportDumpTest):
+    def setUp(self):
+        super(ResumeTest, self).setUp()
+        mommy.make(core.models.Item, code='RUTF')
+        self.path = self.write('stock_reports.csv', STOCK_REPORT_HEADERS, [
+            ['SITE1', '+2348000000001', 1420070400, 'RUTF 10 5'],
+            ['SITE1', '+2348000000001', 1420675200, 'RUTF 0 3'],
+        ])
+
+    def load(self, **kwargs):
+        return importdumps.import_stock_report_dump(self.path, batch_size=1,
+                                                    **kwargs)
+
+    def test_import_resumes_after_the_rows_read(self):
+        self.assertEqual(self.load(), (2, 0))
+        # rows read before would be imported again if they were read
+        core.models.StockReport.objects.all().delete()
+        self.append(self.path, [
+            ['SITE1', '+2348000000001', 1421280000, 'RUTF 4 2']])
+
+        self.assertEqual(self.load(), (1, 0))
+        self.assertEqual(core.models.StockReport.objects.get().logs.get()
+                         .current_holding, 2)
+        progress = ImportProgress.objects.get()
+        self.assertEqual((progress.rows, progress.imported), (3, 3))
+        self.assertEqual(progress.offset, os.path.getsize(self.path))
+
+    def test_changed_file_is_imported_from_the_start(self):
+        self.assertEqual(self.load(), (2, 0))
+        self.write('stock_reports.csv', STOCK_REPORT_HEADERS, [
+            ['SITE1', '+2348000000001', 1420070400, 'RUTF 10 5'],
+            ['SITE1', '+2348000000001', 1420675201, 'RUTF 0 3'],
+            ['SITE1', '+2348000000001', 1421280000, 'RUTF 4 2'],
+        ])
+
+        self.assertEqual(self.load(), (2, 0))
+        self.assertEqual(core.models.StockReport.objects.count(), 4)
+        progress = ImportProgress.objects.get()
+        self.assertEqual((progress.rows, progress.imported,
+                          progress.duplicates), (3, 2, 1))
+
+    def test_import_can_start_over(self):
+        self.assertEqual(self.load(), (2, 0))
+        self.assertEqual(self.load(resume=False), (0, 0))
+        self.assertEqual(ImportProgress.objects.get().duplicates, 2)
+        self.assertEqual(core.models.StockReport.objects.count(), 2)
+
+
+class DuplicateRowTest(ImportDumpTest):
+    def setUp(self):
+        super(DuplicateRowTest, self).setUp()
+        mommy.make(core.models.Item, code='RUTF')
+        # two reports of a site in the same second
+        self.path = self.write('stock_reports.csv', STOCK_REPORT_HEADERS, [
+            ['SITE1', '+2348000000001', 1420070400, 'RUTF 10 5'],
+            ['SITE1', '+2348000000001', 1420070400, 'RUTF 0 3'],
+            ['SITE1', '+2348000000001', 1420070400, 'RUTF 1 1'],
+        ])
+
+    def test_rows_with_the_same_key_are_all_imported(self):
+        for batch_size in (1, 2, 3):
+            core.models.StockReport.objects.all().delete()
+            self.assertEqual(importdumps.import_stock_report_dump(
+                self.path, batch_size=batch_size, resume=False), (3, 0))
+
+    def test_only_rows_missing_from_the_database_are_imported(self):
+        core.models.StockReport.objects.create(
+            site=self.site, reporter=self.reporter,
+            created=importdumps._timestamp(1420070400))
+        self.assertEqual(importdumps.import_stock_report_dump(
+            self.path, batch_size=2), (2, 0))
+        self.assertEqual(importdumps.import_stock_report_dump(
+            self.path, resume=False), (0, 0))
+        self.assertEqual(core.models.StockReport.objects.count(), 3)
@@ -0,0 +1,30 @@
+from __future__ import unicode_literals
+import csv
+import os
+import unittest
+
+from django.db import connection
+
+import core.models
+from datamanager import pgcopy
+from .test_importdumps import ImportDumpTest, PROGRAM_REPORT_HEADERS
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql',
+                     "the COPY engine requires PostgreSQL")
+class ProgramReportCopyTest(ImportDumpTest):
+    def test_invalid_period_number_is_rejected(self):
+        path = self.write('program_reports.csv', PROGRAM_REPORT_HEADERS, [
+            self.program_report_row(period='W1'),
+            self.program_report_row(),
+        ])
+        self.assertEqual(pgcopy.import_program_report_dump(
+            path, refresh=False), (1, 1))
+
+        self.assertEqual(core.models.ProgramReport.objects.get()
+                         .period_number, 1)
+        with open(os.path.join(self.directory,
+                               'program_reports.rejects.csv')) as f:
+            rejects = list(csv.DictReader(f))
+        self.assertEqual(rejects[0]['Period number'], 'W1')
+        self.assertIn('Invalid Period number', rejects[0]['Reason'])
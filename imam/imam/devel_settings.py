@@ -221,6 +221,7 @@ INSTALLED_APPS = [
     "messagebox",
     "webapp",
     "mailqueue",
+    "datamanager",
     "compressor",
     "widget_tweaks",
     "django_filters",
@@ -245,6 +246,14 @@ RAPIDSMS_ROUTER = "rapidsms.router.celery.CeleryRouter"
 
 PAGE_SIZE = 25
 
+# A single development server can use a per-process cache (see
+# imam/settings.py for a shared one).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 DATETIME_FORMAT = '%H:%M:%S %d-%m-%Y'
 
 LOGIN_REDIRECT_URL = '/'
@@ -284,6 +293,20 @@ CELERYBEAT_SCHEDULE = {
         'task': 'core.tasks.reminders',
         'schedule': celery.schedules.crontab(hour=8, minute=0, day_of_week=1),
     },
+    'update-due-site-states': {
+        'task': 'core.tasks.update_due_site_states',
+        'schedule': celery.schedules.crontab(minute=0),
+    },
+    # send_sms starts a dispatcher itself, this only catches messages queued
+    # while one was finishing or left after a backend failure
+    'dispatch-outbound': {
+        'task': 'messagebox.tasks.dispatch_outbound',
+        'schedule': celery.schedules.crontab(),
+    },
+    'release-scheduled': {
+        'task': 'messagebox.tasks.release_scheduled',
+        'schedule': celery.schedules.crontab(),
+    },
 }
 
 # need to have CELERY_ALWAYS_EAGER True and BROKER_BACKEND as memory
@@ -310,7 +333,7 @@ WSGI_APPLICATION = None
 
 DATABASES = {  # Note: these settings may be overridden by dotenv_settings.py
                'default': {
-                   'ENGINE': 'django.contrib.gis.db.backends.postgis',
+                   'ENGINE': 'transaction_hooks.backends.postgis',
                    'NAME': 'imam_test',
                    'USER': 'imamd_db_user',
                    'PASSWORD': '12345678',
@@ -20,13 +20,15 @@ urlparse.uses_netloc.append('sqlite')
 
 _DEFAULT_ENV = 'DATABASE_URL'
 
+# the django-transaction-hooks engines add the on_commit() hook which
+# core.utils.on_commit relies on; it has none for mysqlgis and spatialite
 _SCHEMES = {
-    'postgres': 'django.db.backends.postgresql_psycopg2',
-    'postgis': 'django.contrib.gis.db.backends.postgis',
-    'mysql': 'django.db.backends.mysql',
+    'postgres': 'transaction_hooks.backends.postgresql_psycopg2',
+    'postgis': 'transaction_hooks.backends.postgis',
+    'mysql': 'transaction_hooks.backends.mysql',
     'mysqlgis': 'django.contrib.gis.db.backends.mysql',
     'spatialite': 'django.contrib.gis.db.backends.spatialite',
-    'sqlite': 'django.db.backends.sqlite3',
+    'sqlite': 'transaction_hooks.backends.sqlite3',
 }
 
 
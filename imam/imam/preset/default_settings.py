@@ -85,7 +85,7 @@ else:
 if DATABASES is NotImplemented:
     DATABASES = {
         'default': {
-            'ENGINE': 'django.db.backends.sqlite3',
+            'ENGINE': 'transaction_hooks.backends.sqlite3',
             'NAME': 'db.sqlite',
         }
     }
@@ -12,7 +12,7 @@ from staging_example import *  # get most settings from staging_example.py (whic
 # sqlite
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'transaction_hooks.backends.sqlite3',
         'NAME': 'db.sqlite',
     }
 }
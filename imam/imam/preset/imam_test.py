@@ -15,7 +15,7 @@ WSGI_APPLICATION = None
 
 DATABASES = {  # Note: these settings may be overridden by dotenv_settings.py
     'default': {
-        'ENGINE': 'django.contrib.gis.db.backends.postgis',
+        'ENGINE': 'transaction_hooks.backends.postgis',
         'NAME': 'imam_test',
         'USER': 'imamd_db_user',
         'PASSWORD': '12345678',
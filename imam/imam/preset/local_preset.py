@@ -17,7 +17,7 @@ from ..settings import *  # get most settings from ../settings.py
 # for example, choose a different database...
 #DATABASES = {
 #    'default': {
-#        'ENGINE': 'django.db.backends.sqlite3',
+#        'ENGINE': 'transaction_hooks.backends.sqlite3',
 #        'NAME': 'db.sqlite',
 #    }
 #}
@@ -48,7 +48,7 @@ BULKSMS_URL = 'http://127.0.0.1:13013/cgi-bin/sendsms'
 #postgres
 DATABASES = {  # Note: these settings may be overridden by dotenv_settings.py
     'default': {
-        'ENGINE': 'django.contrib.gis.db.backends.postgis',
+        'ENGINE': 'transaction_hooks.backends.postgis',
         'NAME': 'imam_test',
         'USER': 'imamd_db_user',
         'PASSWORD': '12345678',
@@ -24,7 +24,7 @@ MANAGERS = ADMINS
 #postgres
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'transaction_hooks.backends.postgresql_psycopg2',
         'NAME': 'formhub_dev',
         'USER': 'formhub_dev',
         'PASSWORD': '12345678',
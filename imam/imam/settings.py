@@ -187,15 +187,37 @@ INSTALLED_APPS = (
     "core",
     "messagebox",
     "webapp",
-    "mailqueue"
+    "mailqueue",
+    "datamanager",
 )
 
 TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
-RAPIDSMS_ROUTER = "rapidsms.router.db.DatabaseRouter"
+# stores incoming messages and processes those of each phone in order on the
+# Celery workers (see messagebox.inbound)
+RAPIDSMS_ROUTER = "messagebox.router.InboundRouter"
 
 PAGE_SIZE = 25
 
+# In-process cache of item/position/group/program/site code lookups (see
+# core.codecache); set either value to 0 to disable it.
+CODE_CACHE_MAX_SIZE = 2048
+CODE_CACHE_TTL = 600  # seconds
+
+# The dashboard chart data and the recipients of stock alerts are cached (see
+# webapp.chartcache and core.recipients) and invalidated by whichever process
+# saves a program report, a worker or a location, so the cache has to be
+# shared by the web, router and Celery processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get(
+            'DJANGO_CACHE_DIR', os.path.join(PROJECT_ROOT, '.cache')),
+    }
+}
+DASHBOARD_CHART_CACHE_TIMEOUT = 3600  # seconds
+ESCALATION_RECIPIENTS_CACHE_TIMEOUT = 24 * 3600  # seconds
+
 DATETIME_FORMAT = '%H:%M:%S %d-%m-%Y'
 
 LOGIN_REDIRECT_URL = '/'
@@ -227,11 +249,50 @@ djcelery.setup_loader()
 
 from celery.schedules import crontab
 
+# The weekly reminders send every recipient a digest of its pending stock
+# alerts (see core.reminders), through the outbox.
+REMINDER_MAX_LENGTH = 160  # characters
+
+# Bulk SMS are queued in messagebox.outbox and sent with the same text to up to
+# OUTBOUND_MAX_RECIPIENTS recipients at a time, at most OUTBOUND_RATE messages
+# per second.
+OUTBOUND_RATE = 10  # messages per second
+OUTBOUND_BATCH_SIZE = 500
+OUTBOUND_MAX_RECIPIENTS = 100
+OUTBOUND_MAX_ATTEMPTS = 3
+# messages claimed by a dispatcher which died are queued again after this long
+OUTBOUND_CLAIM_TIMEOUT = 600  # seconds
+
+# Alerts are only sent from ALERT_WINDOW_START to ALERT_WINDOW_END (hours, local
+# time); those raised outside are held and released to the outbox
+# SCHEDULE_RELEASE_BATCH_SIZE at a time every minute once the window opens.
+ALERT_WINDOW_START = 8
+ALERT_WINDOW_END = 20
+SCHEDULE_RELEASE_BATCH_SIZE = 300
+
 CELERYBEAT_SCHEDULE = {
     'reminders': {
         'task': 'core.tasks.reminders',
         'schedule': crontab(hour=8, minute=0, day_of_week=1),
     },
+    'update-due-site-states': {
+        'task': 'core.tasks.update_due_site_states',
+        'schedule': crontab(minute=0),
+    },
+    # send_sms starts a dispatcher itself, this only catches messages queued
+    # while one was finishing or left after a backend failure
+    'dispatch-outbound': {
+        'task': 'messagebox.tasks.dispatch_outbound',
+        'schedule': crontab(),
+    },
+    'release-scheduled': {
+        'task': 'messagebox.tasks.release_scheduled',
+        'schedule': crontab(),
+    },
+    'process-inbound-backlog': {
+        'task': 'messagebox.tasks.process_inbound_backlog',
+        'schedule': crontab(),
+    },
 }
 RAVEN_CONFIG = {
     'dsn': os.environ.get('RAVEN_DSN'),
@@ -0,0 +1,18 @@
+# encoding=utf-8
+"""URLconf of the map API, served through core.lazy.LazyURLConfView so that
+tastypie's GIS support is only imported when the map is first used."""
+from django.conf.urls import patterns, include, url
+from tastypie.api import Api
+from .gis import Adm1Resource, Adm2Resource, Adm3Resource, FacilitiesResource
+
+v1_api = Api(api_name='v1')
+v1_api.register(Adm1Resource())
+# v1_api.register(Adm2Resource())
+# v1_api.register(Adm3Resource())
+v1_api.register(FacilitiesResource())
+
+
+urlpatterns = patterns(
+    '',
+    url(r'^', include(v1_api.urls)),
+)
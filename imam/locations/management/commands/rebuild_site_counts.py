@@ -0,0 +1,20 @@
+"""
+The per-location site counts shown on the dashboard are kept up to date as site
+states and program reports change, but not when locations are moved within the
+tree (e.g. after rebuild_locations_tree), so they need to be rebuilt then.
+
+"""
+from __future__ import print_function, unicode_literals
+import datetime
+
+from django.core.management.base import BaseCommand
+from locations.models import LocationSiteCount
+
+
+class Command(BaseCommand):
+    help = """rebuild the per-location site counts"""
+
+    def handle(self, *args, **options):
+        print('{} UTC. rebuilding site counts...'.format(
+            datetime.datetime.utcnow()))
+        LocationSiteCount.rebuild()
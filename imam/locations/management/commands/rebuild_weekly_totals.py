@@ -0,0 +1,21 @@
+"""
+The weekly program report totals per location are kept up to date as reports
+are saved, reverted and deleted, but not when locations are moved within the
+tree (e.g. after rebuild_locations_tree) or reports are loaded in bulk, so they
+need to be rebuilt then.  The cached dashboard charts are dropped as well.
+
+"""
+from __future__ import print_function, unicode_literals
+import datetime
+
+from django.core.management.base import BaseCommand
+from locations.models import WeeklyProgramTotal
+
+
+class Command(BaseCommand):
+    help = """rebuild the weekly program report totals per location"""
+
+    def handle(self, *args, **options):
+        print('{} UTC. rebuilding weekly totals...'.format(
+            datetime.datetime.utcnow()))
+        WeeklyProgramTotal.rebuild()
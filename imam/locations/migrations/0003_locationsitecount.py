@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def fill_site_counts(apps, schema_editor):
+    from locations.models import LocationSiteCount
+    LocationSiteCount.rebuild(apps)
+
+
+def noop(apps, schema_editor):
+    # the rows go with the table (RunPython.noop is only in Django 1.8)
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_locationprogramstate_report_dates'),
+        ('locations', '0002_auto_20150408_1928'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationSiteCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('year', models.PositiveSmallIntegerField()),
+                ('active_count', models.PositiveIntegerField(default=0)),
+                ('inactive_count', models.PositiveIntegerField(default=0)),
+                ('reporting_count', models.PositiveIntegerField(default=0)),
+                ('first_reporting_count', models.PositiveIntegerField(default=0)),
+                ('location', models.ForeignKey(related_name='site_counts', to='locations.Location')),
+                ('program', models.ForeignKey(related_name='+', to='core.Program')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='locationsitecount',
+            unique_together=set([('location', 'program', 'year')]),
+        ),
+        migrations.RunPython(fill_site_counts, noop),
+    ]
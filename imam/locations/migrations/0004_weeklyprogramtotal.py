@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def fill_weekly_totals(apps, schema_editor):
+    from locations.models import WeeklyProgramTotal
+    WeeklyProgramTotal.rebuild(apps)
+
+
+def noop(apps, schema_editor):
+    # the rows go with the table (RunPython.noop is only in Django 1.8)
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_programreport_index_together'),
+        ('locations', '0003_locationsitecount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeeklyProgramTotal',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('report_date', models.DateField()),
+                ('report_count', models.PositiveIntegerField(default=0)),
+                ('patients_at_period_start', models.IntegerField(default=0)),
+                ('new_marasmic_patients', models.IntegerField(default=0)),
+                ('new_oedema_patients', models.IntegerField(default=0)),
+                ('new_relapsed_patients', models.IntegerField(default=0)),
+                ('hiv_positive_patients', models.IntegerField(default=0)),
+                ('readmitted_patients', models.IntegerField(default=0)),
+                ('patients_transferred_in', models.IntegerField(default=0)),
+                ('patients_transferred_out', models.IntegerField(default=0)),
+                ('patient_deaths', models.IntegerField(default=0)),
+                ('confirmed_patient_defaults', models.IntegerField(default=0)),
+                ('unconfirmed_patient_defaults', models.IntegerField(default=0)),
+                ('unresponsive_patients', models.IntegerField(default=0)),
+                ('patients_cured', models.IntegerField(default=0)),
+                ('patients_at_period_end', models.IntegerField(default=0)),
+                ('group', models.ForeignKey(related_name='+', to='core.PatientGroup')),
+                ('location', models.ForeignKey(related_name='weekly_totals', to='locations.Location')),
+                ('program', models.ForeignKey(related_name='+', to='core.Program')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='weeklyprogramtotal',
+            unique_together=set([('location', 'program', 'group', 'report_date')]),
+        ),
+        migrations.RunPython(fill_weekly_totals, noop),
+    ]
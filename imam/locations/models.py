@@ -1,15 +1,20 @@
 # encoding=utf-8
-from datetime import date
+from datetime import date, timedelta
 import logging
 
-from django.db import models
+from django.apps import apps
+from django.db import IntegrityError, models, transaction
 from mptt.models import MPTTModel, TreeForeignKey
 from django.contrib.gis.db import models as geomodels
 from django_extensions.db import fields as ext_fields
 from django.utils.encoding import smart_text, python_2_unicode_compatible
 from django.utils.translation import ugettext as _
 
+from core import recipients
+from core.codecache import code_cache
 from core.models import LocationProgramState, ProgramReport
+from core.signals import site_states_rebuilt, weekly_totals_rebuilt
+from core.utils import chunker, iso_normalize
 
 
 _logger = logging.getLogger(__name__)
@@ -114,6 +119,10 @@ class Location(MPTTModel):
 
     @classmethod
     def get_by_code(cls, code):
+        return code_cache.resolve(cls, code, cls._lookup_code)
+
+    @classmethod
+    def _lookup_code(cls, code):
         obj = None
 
         try:
@@ -141,40 +150,16 @@ class Location(MPTTModel):
         return sites
 
     def active_site_count(self, program, year):
-        sites = self.get_site_descendants()
-        if year is None or year == date.today().year:
-            return LocationProgramState.objects.filter(
-                program=program, site__in=sites,
-                current_state__startswith='ACTIVE'
-            ).count()
-        else:
-            return ProgramReport.objects.filter(
-                program=program, report_date__year=year, site__in=sites
-            ).order_by('site').distinct('site').count()
+        return LocationSiteCount.get_counts(self, [program], year)[
+            program.pk]['active_site_count']
 
     def inactive_site_count(self, program, year):
-        sites = self.get_site_descendants()
-        if year is None or year == date.today().year:
-            return LocationProgramState.objects.filter(
-                program=program, site__in=sites,
-                current_state__startswith='INACTIVE').count()
-        else:
-            return self.reporting_site_count(program,
-                                             year) - self.active_site_count(
-                program, year)
+        return LocationSiteCount.get_counts(self, [program], year)[
+            program.pk]['inactive_site_count']
 
     def reporting_site_count(self, program, year):
-        sites = self.get_site_descendants()
-        if year is None or year == 0 or year == date.today().year:
-            return LocationProgramState.objects.filter(
-                program=program, site__in=sites).exclude(
-                current_state='OUT').count()
-        else:
-            return ProgramReport.objects.filter(
-                program=program,
-                report_date__lte='{:04d}-12-31'.format(year),
-                site__in=sites
-            ).order_by('site').distinct('site').count()
+        return LocationSiteCount.get_counts(self, [program], year)[
+            program.pk]['reporting_site_count']
 
     @classmethod
     def get_location_choices(cls, type_code_exclude_list=None):
@@ -231,6 +216,425 @@ class Location(MPTTModel):
         )
 
 
+code_cache.register(Location)
+
+
+def _lock_site(site_id):
+    """Returns the location site_id (or None), locked until the end of the
+    transaction so that refreshes for the same site run one after the other
+    and each sees what the previous one stored."""
+    return Location.objects.select_for_update().filter(pk=site_id).first()
+
+
+def _create_missing(model, rows):
+    """Inserts rows, some of which may have been inserted meanwhile by a
+    refresh for another site with the same ancestors."""
+    if not rows:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(rows)
+    except IntegrityError:
+        unique = [model._meta.get_field(name).attname
+                  for name in model._meta.unique_together[0]]
+        for row in rows:
+            model.objects.get_or_create(**dict(
+                (attname, getattr(row, attname)) for attname in unique))
+
+
+class LocationSiteCount(models.Model):
+    """Number of sites at or below a location which are active, inactive or
+    reporting for a program, maintained for every location in the tree so that
+    the dashboard does not have to count sites on each request.
+
+    Rows with year CURRENT hold counts based on the current state of the sites
+    (LocationProgramState).  Rows for a calendar year hold the number of sites
+    which sent reports for that year (active_count) and the number of sites
+    which sent their first report for that year (first_reporting_count).
+    """
+    CURRENT = 0
+    COUNT_FIELDS = ('active_count', 'inactive_count', 'reporting_count',
+                    'first_reporting_count')
+
+    location = models.ForeignKey(Location, related_name='site_counts')
+    program = models.ForeignKey('core.Program', related_name='+')
+    year = models.PositiveSmallIntegerField()
+    active_count = models.PositiveIntegerField(default=0)
+    inactive_count = models.PositiveIntegerField(default=0)
+    reporting_count = models.PositiveIntegerField(default=0)
+    first_reporting_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('location', 'program', 'year'),)
+
+    @classmethod
+    def get_counts(cls, location, programs, year):
+        """Returns a dict mapping the pk of each of programs to a dict with the
+        active, inactive and reporting site counts for location in year, using
+        a single query.  The counts for the current year (or no year) are
+        those of the current site states; for other years they are based on
+        the dates of the program reports.
+        """
+        current = year in (None, cls.CURRENT) or year == date.today().year
+        rows = cls.objects.filter(location=location, program__in=programs)
+        if current:
+            rows = rows.filter(year=cls.CURRENT)
+        else:
+            rows = rows.filter(year__gt=cls.CURRENT, year__lte=year)
+
+        counts = dict(
+            (program.pk, {'active_site_count': 0, 'inactive_site_count': 0,
+                          'reporting_site_count': 0})
+            for program in programs)
+        for row in rows:
+            program_counts = counts.setdefault(
+                row.program_id, {'active_site_count': 0,
+                                 'inactive_site_count': 0,
+                                 'reporting_site_count': 0})
+            if current:
+                program_counts['active_site_count'] = row.active_count
+                program_counts['inactive_site_count'] = row.inactive_count
+                program_counts['reporting_site_count'] = row.reporting_count
+            else:
+                if row.year == year:
+                    program_counts['active_site_count'] = row.active_count
+                program_counts['reporting_site_count'] += \
+                    row.first_reporting_count
+        if not current:
+            for program_counts in counts.values():
+                program_counts['inactive_site_count'] = \
+                    program_counts['reporting_site_count'] - \
+                    program_counts['active_site_count']
+        return counts
+
+    @classmethod
+    def _site_contribution(cls, state, years):
+        """Returns a dict mapping years to the counts (in the order of
+        COUNT_FIELDS) contributed by a single site with the given current state
+        (None if it has none) and set of years it has reports for.
+        """
+        contribution = {}
+        if state is not None and state != 'OUT':
+            contribution[cls.CURRENT] = (int(state.startswith('ACTIVE')),
+                                         int(state.startswith('INACTIVE')),
+                                         1, 0)
+        if years:
+            first_year = min(years)
+            for year in years:
+                contribution[year] = (1, 0, 0, int(year == first_year))
+        return contribution
+
+    @classmethod
+    @transaction.atomic
+    def refresh(cls, site_id, program_id):
+        """Bring the counts for a site and all of its ancestors up to date
+        after the state or the reports of the site for a program have changed.
+
+        The rows of the site itself record what it currently contributes, so
+        only the difference needs to be added to the rows of its ancestors.
+        The site is locked first, so that concurrent refreshes for it do not
+        add the same difference twice.
+        """
+        site = _lock_site(site_id)
+        if site is None:
+            return
+
+        if site.is_site:
+            state = LocationProgramState.objects.filter(
+                site_id=site_id, program_id=program_id).values_list(
+                'current_state', flat=True).first()
+            years = set(d.year for d in ProgramReport.objects.filter(
+                site_id=site_id, program_id=program_id).dates(
+                'report_date', 'year'))
+            contribution = cls._site_contribution(state, years)
+        else:
+            contribution = {}
+
+        stored = dict(
+            (row.year, tuple(getattr(row, f) for f in cls.COUNT_FIELDS))
+            for row in cls.objects.filter(location_id=site_id,
+                                          program_id=program_id))
+        no_counts = (0,) * len(cls.COUNT_FIELDS)
+        deltas = {}
+        for year in set(contribution) | set(stored):
+            delta = tuple(
+                new - old
+                for new, old in zip(contribution.get(year, no_counts),
+                                    stored.get(year, no_counts)))
+            if any(delta):
+                deltas[year] = delta
+        if not deltas:
+            return
+
+        location_ids = list(site.get_ancestors(include_self=True).values_list(
+            'pk', flat=True))
+        existing = set(cls.objects.filter(
+            location_id__in=location_ids, program_id=program_id,
+            year__in=deltas.keys()).values_list('location_id', 'year'))
+        _create_missing(cls, [
+            cls(location_id=location_id, program_id=program_id, year=year)
+            for year in deltas for location_id in location_ids
+            if (location_id, year) not in existing
+        ])
+        for year, delta in deltas.items():
+            cls.objects.filter(
+                location_id__in=location_ids, program_id=program_id,
+                year=year).update(**dict(
+                    (field, models.F(field) + change)
+                    for field, change in zip(cls.COUNT_FIELDS, delta)
+                    if change))
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, registry=None):
+        """Recompute all the counts from scratch.  The models are taken from
+        registry if given (the historical models, in a migration)."""
+        registry = registry or apps
+        model = registry.get_model('locations', 'LocationSiteCount')
+        location_model = registry.get_model('locations', 'Location')
+        model.objects.all().delete()
+
+        parents = dict(location_model.objects.values_list('pk', 'parent_id'))
+        site_ids = set(location_model.objects.filter(
+            loc_type__code='adm6').values_list('pk', flat=True))
+        states = dict(
+            ((site_id, program_id), state)
+            for site_id, program_id, state
+            in registry.get_model(
+                'core', 'LocationProgramState').objects.values_list(
+                'site_id', 'program_id', 'current_state')
+            if site_id in site_ids)
+        years = {}
+        for site_id, program_id, report_date in registry.get_model(
+                'core', 'ProgramReport').objects.order_by().values_list(
+                'site_id', 'program_id', 'report_date').distinct():
+            if site_id in site_ids:
+                years.setdefault((site_id, program_id), set()).add(
+                    report_date.year)
+
+        totals = {}
+        for site_id, program_id in set(states) | set(years):
+            contribution = cls._site_contribution(
+                states.get((site_id, program_id)),
+                years.get((site_id, program_id)))
+            location_id = site_id
+            while location_id is not None:
+                for year, counts in contribution.items():
+                    total = totals.setdefault((location_id, program_id, year),
+                                              [0] * len(cls.COUNT_FIELDS))
+                    for i, count in enumerate(counts):
+                        total[i] += count
+                location_id = parents.get(location_id)
+
+        for chunk in chunker(sorted(totals.items()), 500):
+            model.objects.bulk_create([
+                model(location_id=location_id, program_id=program_id,
+                      year=year, **dict(zip(cls.COUNT_FIELDS, counts)))
+                for (location_id, program_id, year), counts in chunk
+            ])
+
+
+class WeeklyProgramTotal(models.Model):
+    """Sums of the program report figures of all the sites at or below a
+    location for a program, patient group and ISO week, maintained for every
+    location in the tree so that totals for any administrative level can be
+    read without going through the reports of each site.
+
+    The rows of a site itself hold the sums of its own reports.  report_date
+    is the last day (Sunday) of the week, as for ProgramReport.
+    """
+    SUMMED_FIELDS = (
+        'patients_at_period_start', 'new_marasmic_patients',
+        'new_oedema_patients', 'new_relapsed_patients',
+        'hiv_positive_patients', 'readmitted_patients',
+        'patients_transferred_in', 'patients_transferred_out',
+        'patient_deaths', 'confirmed_patient_defaults',
+        'unconfirmed_patient_defaults', 'unresponsive_patients',
+        'patients_cured', 'patients_at_period_end',
+    )
+    COUNT_FIELDS = ('report_count',) + SUMMED_FIELDS
+
+    location = models.ForeignKey(Location, related_name='weekly_totals')
+    program = models.ForeignKey('core.Program', related_name='+')
+    group = models.ForeignKey('core.PatientGroup', related_name='+')
+    report_date = models.DateField()
+    report_count = models.PositiveIntegerField(default=0)
+    patients_at_period_start = models.IntegerField(default=0)
+    new_marasmic_patients = models.IntegerField(default=0)
+    new_oedema_patients = models.IntegerField(default=0)
+    new_relapsed_patients = models.IntegerField(default=0)
+    hiv_positive_patients = models.IntegerField(default=0)
+    readmitted_patients = models.IntegerField(default=0)
+    patients_transferred_in = models.IntegerField(default=0)
+    patients_transferred_out = models.IntegerField(default=0)
+    patient_deaths = models.IntegerField(default=0)
+    confirmed_patient_defaults = models.IntegerField(default=0)
+    unconfirmed_patient_defaults = models.IntegerField(default=0)
+    unresponsive_patients = models.IntegerField(default=0)
+    patients_cured = models.IntegerField(default=0)
+    patients_at_period_end = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('location', 'program', 'group', 'report_date'),)
+
+    @classmethod
+    def _report_key(cls, report):
+        return (report.site_id, report.program_id, report.group_id,
+                iso_normalize(report.report_date))
+
+    @classmethod
+    def _aggregates(cls):
+        aggregates = dict((field, models.Sum(field))
+                          for field in cls.SUMMED_FIELDS)
+        aggregates['report_count'] = models.Count('pk')
+        return aggregates
+
+    @classmethod
+    @transaction.atomic
+    def refresh(cls, site_id, program_id, group_id, report_date):
+        """Bring the totals for a site and all of its ancestors up to date for
+        the week ending on report_date after a report of the site for that week
+        has been saved or deleted.
+
+        The rows of the site itself hold what it currently contributes, so only
+        the difference needs to be added to the rows of its ancestors.  The
+        site is locked first, so that concurrent refreshes for it do not add
+        the same difference twice.
+        """
+        site = _lock_site(site_id)
+        if site is None:
+            return
+
+        key = {'program_id': program_id, 'group_id': group_id,
+               'report_date': report_date}
+        no_counts = (0,) * len(cls.COUNT_FIELDS)
+        if site.is_site:
+            sums = ProgramReport.objects.filter(
+                site_id=site_id, program_id=program_id, group_id=group_id,
+                report_date__range=(report_date - timedelta(days=6),
+                                    report_date)).aggregate(
+                **cls._aggregates())
+            counts = tuple(sums[field] or 0 for field in cls.COUNT_FIELDS)
+        else:
+            counts = no_counts
+        stored = cls.objects.filter(location_id=site_id, **key).values_list(
+            *cls.COUNT_FIELDS).first() or no_counts
+        delta = tuple(new - old for new, old in zip(counts, stored))
+        if not any(delta):
+            return
+
+        location_ids = list(site.get_ancestors(include_self=True).values_list(
+            'pk', flat=True))
+        existing = set(cls.objects.filter(
+            location_id__in=location_ids, **key).values_list(
+            'location_id', flat=True))
+        _create_missing(cls, [
+            cls(location_id=location_id, **key)
+            for location_id in location_ids if location_id not in existing
+        ])
+        cls.objects.filter(location_id__in=location_ids, **key).update(**dict(
+            (field, models.F(field) + change)
+            for field, change in zip(cls.COUNT_FIELDS, delta) if change))
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, registry=None):
+        """Recompute all the totals from scratch.  The models are taken from
+        registry if given (the historical models, in a migration)."""
+        registry = registry or apps
+        model = registry.get_model('locations', 'WeeklyProgramTotal')
+        location_model = registry.get_model('locations', 'Location')
+        model.objects.all().delete()
+
+        parents = dict(location_model.objects.values_list('pk', 'parent_id'))
+        site_ids = set(location_model.objects.filter(
+            loc_type__code='adm6').values_list('pk', flat=True))
+        totals = {}
+        for row in registry.get_model(
+                'core', 'ProgramReport').objects.order_by().values(
+                'site', 'program', 'group', 'report_date').annotate(
+                **cls._aggregates()).iterator():
+            if row['site'] not in site_ids:
+                continue
+            report_date = iso_normalize(row['report_date'])
+            location_id = row['site']
+            while location_id is not None:
+                total = totals.setdefault(
+                    (location_id, row['program'], row['group'], report_date),
+                    [0] * len(cls.COUNT_FIELDS))
+                for i, field in enumerate(cls.COUNT_FIELDS):
+                    total[i] += row[field] or 0
+                location_id = parents.get(location_id)
+
+        for chunk in chunker(sorted(totals.items()), 500):
+            model.objects.bulk_create([
+                model(location_id=location_id, program_id=program_id,
+                      group_id=group_id, report_date=report_date,
+                      **dict(zip(cls.COUNT_FIELDS, counts)))
+                for (location_id, program_id, group_id, report_date), counts
+                in chunk
+            ])
+        weekly_totals_rebuilt.send(sender=cls)
+
+
+def _site_data_changed(sender, instance, **kwargs):
+    # Raw saves are not skipped as reversion reverts reports with them.
+    LocationSiteCount.refresh(instance.site_id, instance.program_id)
+    # a report moved to another site or program (see core.models)
+    previous = getattr(instance, '_previous_site_program', None)
+    if previous and previous != (instance.site_id, instance.program_id):
+        LocationSiteCount.refresh(*previous)
+
+
+def _site_states_rebuilt(sender, **kwargs):
+    LocationSiteCount.rebuild()
+
+
+for _model in (LocationProgramState, ProgramReport):
+    models.signals.post_save.connect(
+        _site_data_changed, sender=_model,
+        dispatch_uid='site-counts-{}-saved'.format(_model._meta.model_name))
+    models.signals.post_delete.connect(
+        _site_data_changed, sender=_model,
+        dispatch_uid='site-counts-{}-deleted'.format(_model._meta.model_name))
+site_states_rebuilt.connect(_site_states_rebuilt,
+                            dispatch_uid='site-counts-rebuilt')
+
+
+def _program_report_pre_save(sender, instance, **kwargs):
+    # remember which week the report counted towards before this save, in case
+    # it is moved to another site, program, group or week
+    instance._weekly_total_key = None
+    if instance.pk is not None:
+        previous = ProgramReport.objects.filter(pk=instance.pk).first()
+        if previous is not None:
+            instance._weekly_total_key = WeeklyProgramTotal._report_key(
+                previous)
+
+
+def _program_report_changed(sender, instance, **kwargs):
+    # Raw saves are not skipped as reversion reverts reports with them.
+    keys = set([WeeklyProgramTotal._report_key(instance)])
+    if getattr(instance, '_weekly_total_key', None):
+        keys.add(instance._weekly_total_key)
+    for key in keys:
+        WeeklyProgramTotal.refresh(*key)
+
+
+models.signals.pre_save.connect(_program_report_pre_save,
+                                sender=ProgramReport,
+                                dispatch_uid='weekly-totals-report-pre-save')
+models.signals.post_save.connect(_program_report_changed,
+                                 sender=ProgramReport,
+                                 dispatch_uid='weekly-totals-report-saved')
+models.signals.post_delete.connect(_program_report_changed,
+                                   sender=ProgramReport,
+                                   dispatch_uid='weekly-totals-report-deleted')
+
+models.signals.post_save.connect(recipients.location_saved, sender=Location,
+                                 dispatch_uid='recipients-location-saved')
+
+
 @python_2_unicode_compatible
 class Gadm(geomodels.Model):
     cc = geomodels.CharField(max_length=15, null=True, blank=True)
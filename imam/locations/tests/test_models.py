@@ -1,5 +1,7 @@
 __author__ = 'Tomasz J. Kotarba <tomasz@kotarba.net>'
 
+import datetime
+
 from model_mommy import mommy
 
 import django.db
@@ -7,6 +9,7 @@ import django.utils.timezone
 import django.test
 import django.forms.models
 
+import core.models
 import locations.models
 
 
@@ -22,3 +25,179 @@ class LocationTypeTest(django.test.TestCase):
             mommy.make(locations.models.LocationType, code='adm0', _quantity=1)
 
 
+
+
+class LocationSiteCountTest(django.test.TestCase):
+    def setUp(self):
+        country = mommy.make(locations.models.LocationType, code='adm0')
+        state = mommy.make(locations.models.LocationType, code='adm1')
+        site_type = mommy.make(locations.models.LocationType, code='adm6')
+        self.root = mommy.make(locations.models.Location, loc_type=country)
+        self.region = mommy.make(locations.models.Location, loc_type=state,
+                                 parent=self.root)
+        self.sites = mommy.make(locations.models.Location, loc_type=site_type,
+                                parent=self.region, _quantity=2)
+        self.program = mommy.make(core.models.Program)
+
+    def _counts(self, location, year):
+        return locations.models.LocationSiteCount.get_counts(
+            location, [self.program], year)[self.program.pk]
+
+    def _set_state(self, site, state):
+        lps = core.models.LocationProgramState.objects.get_or_create(
+            site=site, program=self.program)[0]
+        lps.current_state = state
+        lps.save()
+
+    def _serialise_counts(self):
+        return sorted(
+            django.forms.models.model_to_dict(row, exclude='id').items()
+            for row in locations.models.LocationSiteCount.objects.all())
+
+    def test_current_counts_follow_site_states(self):
+        self._set_state(self.sites[0], 'ACTIVE')
+        self._set_state(self.sites[1], 'INACTIVE-NEW')
+        expected = {'active_site_count': 1, 'inactive_site_count': 1,
+                    'reporting_site_count': 2}
+        for location in (self.root, self.region):
+            self.assertEqual(self._counts(location, None), expected)
+        self.assertEqual(self._counts(self.sites[0], None)['active_site_count'],
+                         1)
+
+        self._set_state(self.sites[0], 'OUT')
+        self.assertEqual(self._counts(self.root, None),
+                         {'active_site_count': 0, 'inactive_site_count': 1,
+                          'reporting_site_count': 1})
+
+    def test_locations_other_than_sites_not_counted(self):
+        self._set_state(self.region, 'ACTIVE')
+        self.assertEqual(self._counts(self.root, None)['reporting_site_count'],
+                         0)
+
+    def test_yearly_counts_follow_program_reports(self):
+        mommy.make(core.models.ProgramReport, site=self.sites[0],
+                   program=self.program, report_date=datetime.date(2013, 5, 6))
+        mommy.make(core.models.ProgramReport, site=self.sites[1],
+                   program=self.program, report_date=datetime.date(2014, 3, 3))
+        report = mommy.make(core.models.ProgramReport, site=self.sites[0],
+                            program=self.program,
+                            report_date=datetime.date(2014, 3, 10))
+        self.assertEqual(self._counts(self.root, 2013),
+                         {'active_site_count': 1, 'inactive_site_count': 0,
+                          'reporting_site_count': 1})
+        self.assertEqual(self._counts(self.root, 2014),
+                         {'active_site_count': 2, 'inactive_site_count': 0,
+                          'reporting_site_count': 2})
+
+        report.delete()
+        self.assertEqual(self._counts(self.root, 2014),
+                         {'active_site_count': 1, 'inactive_site_count': 1,
+                          'reporting_site_count': 2})
+
+    def test_rebuild_matches_incremental_updates(self):
+        self._set_state(self.sites[0], 'ACTIVE-BAD')
+        self._set_state(self.sites[1], 'INACTIVE')
+        mommy.make(core.models.ProgramReport, site=self.sites[1],
+                   program=self.program, report_date=datetime.date(2014, 3, 3))
+        before = self._serialise_counts()
+        locations.models.LocationSiteCount.rebuild()
+        self.assertEqual(self._serialise_counts(), before)
+
+    def test_repeated_refresh_does_not_change_counts(self):
+        self._set_state(self.sites[0], 'ACTIVE')
+        before = self._serialise_counts()
+        for _ in range(2):
+            locations.models.LocationSiteCount.refresh(self.sites[0].pk,
+                                                       self.program.pk)
+        self.assertEqual(self._serialise_counts(), before)
+
+    def test_moved_report_leaves_its_previous_site(self):
+        report = mommy.make(core.models.ProgramReport, site=self.sites[0],
+                            program=self.program,
+                            report_date=datetime.date(2014, 3, 3))
+        report.site = self.sites[1]
+        report.save()
+        self.assertEqual(
+            self._counts(self.sites[0], 2014)['reporting_site_count'], 0)
+        self.assertEqual(
+            self._counts(self.sites[1], 2014)['reporting_site_count'], 1)
+        self.assertEqual(
+            self._counts(self.root, 2014)['reporting_site_count'], 1)
+
+    def test_counts_read_with_a_single_query(self):
+        self._set_state(self.sites[0], 'ACTIVE')
+        programs = [self.program, mommy.make(core.models.Program)]
+        with self.assertNumQueries(1):
+            locations.models.LocationSiteCount.get_counts(self.root, programs,
+                                                          2014)
+
+
+class WeeklyProgramTotalTest(django.test.TestCase):
+    def setUp(self):
+        country = mommy.make(locations.models.LocationType, code='adm0')
+        site_type = mommy.make(locations.models.LocationType, code='adm6')
+        self.root = mommy.make(locations.models.Location, loc_type=country)
+        self.sites = mommy.make(locations.models.Location, loc_type=site_type,
+                                parent=self.root, _quantity=2)
+        self.program = mommy.make(core.models.Program)
+        self.group = mommy.make(core.models.PatientGroup)
+        self.week = datetime.date(2014, 3, 9)
+
+    def _make_report(self, site, report_date=None, **kwargs):
+        return mommy.make(core.models.ProgramReport, site=site,
+                          program=self.program, group=self.group,
+                          report_date=report_date or self.week, **kwargs)
+
+    def _total(self, location, report_date=None):
+        return locations.models.WeeklyProgramTotal.objects.filter(
+            location=location, program=self.program, group=self.group,
+            report_date=report_date or self.week).first()
+
+    def _serialise_totals(self):
+        return sorted(
+            django.forms.models.model_to_dict(row, exclude='id').items()
+            for row in locations.models.WeeklyProgramTotal.objects.filter(
+                report_count__gt=0))
+
+    def test_totals_follow_saved_reports(self):
+        self._make_report(self.sites[0], patient_deaths=2)
+        report = self._make_report(self.sites[1], patient_deaths=3)
+        total = self._total(self.root)
+        self.assertEqual(total.report_count, 2)
+        self.assertEqual(total.patient_deaths, 5)
+        self.assertEqual(self._total(self.sites[1]).patient_deaths, 3)
+
+        report.patient_deaths = 1
+        report.save()
+        self.assertEqual(self._total(self.root).patient_deaths, 3)
+
+        report.delete()
+        total = self._total(self.root)
+        self.assertEqual(total.report_count, 1)
+        self.assertEqual(total.patient_deaths, 2)
+
+    def test_totals_follow_reports_moved_to_another_week(self):
+        report = self._make_report(self.sites[0], patients_cured=4)
+        next_week = self.week + datetime.timedelta(weeks=1)
+        report.report_date = next_week
+        report.save()
+        self.assertEqual(self._total(self.root).patients_cured, 0)
+        self.assertEqual(self._total(self.root, next_week).patients_cured, 4)
+
+    def test_rebuild_matches_incremental_updates(self):
+        self._make_report(self.sites[0], new_marasmic_patients=7)
+        self._make_report(self.sites[1], new_oedema_patients=2)
+        self._make_report(self.sites[1],
+                          report_date=self.week + datetime.timedelta(weeks=1),
+                          patients_transferred_out=1)
+        before = self._serialise_totals()
+        locations.models.WeeklyProgramTotal.rebuild()
+        self.assertEqual(self._serialise_totals(), before)
+
+    def test_repeated_refresh_does_not_change_totals(self):
+        self._make_report(self.sites[0], patients_cured=3)
+        before = self._serialise_totals()
+        for _ in range(2):
+            locations.models.WeeklyProgramTotal.refresh(
+                self.sites[0].pk, self.program.pk, self.group.pk, self.week)
+        self.assertEqual(self._serialise_totals(), before)
@@ -0,0 +1,132 @@
+"""A local stand-in for Kannel's sendsms interface, to try the outbox (or
+measure it) without sending real SMS.
+
+Point a rapidsms.backends.kannel.KannelBackend at it, e.g.
+
+    INSTALLED_BACKENDS['fake-smsc'] = {
+        'ENGINE': 'rapidsms.backends.kannel.KannelBackend',
+        'sendsms_url': 'http://127.0.0.1:13013/cgi-bin/sendsms',
+        'sendsms_params': {'smsc': 'fake', 'from': '0000',
+                           'username': 'fake', 'password': 'fake'},
+    }
+    BULKSMS_BACKEND = 'fake-smsc'
+
+and run it with the fake_smsc management command, or in a thread:
+
+    with FakeSMSC(latency=0.05, rate=20) as smsc:
+        Dispatcher().run()
+    print smsc.messages
+"""
+from __future__ import unicode_literals
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+SENDSMS_PATH = '/cgi-bin/sendsms'
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        smsc = self.server.smsc
+        url = urlparse(self.path)
+        if url.path != SENDSMS_PATH:
+            self.reply(404, 'Not found')
+            return
+        params = parse_qs(url.query)
+        recipients = params.get('to', [''])[0].split()
+        text = params.get('text', [''])[0].decode(
+            params.get('charset', ['utf-8'])[0])
+        if not recipients:
+            self.reply(400, 'Missing receiver')
+            return
+        if not smsc.accept(len(recipients)):
+            self.reply(503, 'Throttled')
+            return
+        if smsc.latency:
+            time.sleep(smsc.latency)
+        smsc.record(text, recipients)
+        self.reply(202, '0: Accepted for delivery')
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.smsc.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class FakeSMSC(object):
+    """Records the messages it is sent.  With latency, every request takes
+    that many seconds; with rate, requests which would go over rate messages
+    per second (over the last second) are refused with a 503, as an SMSC
+    throttling its clients would."""
+
+    def __init__(self, host='127.0.0.1', port=13013, latency=0, rate=None,
+                 verbose=False):
+        self.latency = latency
+        self.rate = rate
+        self.verbose = verbose
+        self.requests = []  # (time, text, recipients)
+        self.refused = 0
+        self._lock = threading.Lock()
+        self._recent = []  # (time, message count) over the last second
+        self._server = _Server((host, port), _Handler)
+        self._server.smsc = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{}:{}{}'.format(host, port, SENDSMS_PATH)
+
+    @property
+    def messages(self):
+        """(text, recipient) of every message received."""
+        return [(text, recipient) for _, text, recipients in self.requests
+                for recipient in recipients]
+
+    def accept(self, count):
+        if not self.rate:
+            return True
+        current = time.time()
+        with self._lock:
+            self._recent = [(when, n) for when, n in self._recent
+                            if when > current - 1]
+            if sum(n for _, n in self._recent) + count > self.rate:
+                self.refused += 1
+                return False
+            self._recent.append((current, count))
+        return True
+
+    def record(self, text, recipients):
+        with self._lock:
+            self.requests.append((time.time(), text, recipients))
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,105 @@
+"""Processing of the incoming messages stored by the database router.
+
+InboundRouter (messagebox.router) only stores an incoming message and queues
+a task for its connection before the backend's request returns.  The task
+processes the queued messages of the connection in the order they came in,
+while holding a lock on the connection (see messagebox.locks): messages from
+different phones are processed in parallel by the workers, those of one phone
+one after the other, so that a reporter's corrections apply after the report
+they correct.  A task finding the connection locked leaves its message to the
+task holding the lock.
+"""
+from __future__ import unicode_literals
+import logging
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router as db_router
+from django.utils.timezone import now
+from rapidsms.router import get_router
+
+from .locks import advisory_lock
+
+logger = logging.getLogger(__name__)
+
+# first key of the locks on connections, the second is the connection's id
+ADVISORY_LOCK_CLASS = 46282
+DEFAULT_FIELDS_TIMEOUT = 24 * 3600
+BACKLOG_AGE = 60  # seconds
+
+
+def _cache():
+    return caches[getattr(settings, 'INBOUND_CACHE', 'default')]
+
+
+def fields_key(message_id):
+    return 'messagebox-inbound-fields:{}'.format(message_id)
+
+
+def save_fields(message_id, fields):
+    """Keeps the extra fields of an incoming message (not stored by the
+    database router) until it is processed."""
+    if fields:
+        _cache().set(fields_key(message_id), fields, DEFAULT_FIELDS_TIMEOUT)
+
+
+def queued(connection_id):
+    # rapidsms.router.db is only installed along with the database router
+    Message = apps.get_model('db', 'Message')
+    return Message.objects.filter(
+        direction='I', status='Q',
+        transmissions__connection__pk=connection_id).order_by('pk')
+
+
+def process(connection_id):
+    """Processes the queued messages of a connection in order, unless another
+    worker is doing it.  Returns the number of messages processed."""
+    using = db_router.db_for_write(apps.get_model('db', 'Message'))
+    count = 0
+    router = None
+    while True:
+        with advisory_lock(ADVISORY_LOCK_CLASS, connection_id,
+                           using=using) as acquired:
+            if not acquired:
+                break
+            while True:
+                dbm = queued(connection_id).first()
+                if dbm is None:
+                    break
+                if router is None:
+                    router = get_router()
+                process_message(router, dbm)
+                count += 1
+        # a message stored after the last check would have been left to us
+        if not queued(connection_id).exists():
+            break
+    return count
+
+
+def process_message(router, dbm):
+    """Runs a stored incoming message through the router's apps, as
+    rapidsms.router.db.tasks.receive_async does."""
+    cache = _cache()
+    fields = cache.get(fields_key(dbm.pk)) or {}
+    message = router.create_message_from_dbm(dbm, fields)
+    status = 'R'
+    try:
+        router.process_incoming(message)
+    except Exception:
+        logger.exception('Processing incoming message %d failed', dbm.pk)
+        status = 'E'
+    dbm.transmissions.update(status=status, updated=now())
+    dbm.set_status()
+    cache.delete(fields_key(dbm.pk))
+
+
+def backlog(age=BACKLOG_AGE):
+    """Returns the ids of the connections with messages queued for more than
+    age seconds, whose task was lost (or ran before they were stored)."""
+    Transmission = apps.get_model('db', 'Transmission')
+    return list(Transmission.objects.filter(
+        message__direction='I', message__status='Q',
+        message__date__lt=now() - timedelta(seconds=age)).values_list(
+        'connection_id', flat=True).distinct())
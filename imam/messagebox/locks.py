@@ -0,0 +1,30 @@
+"""Locks across processes, held by a database session.
+
+On PostgreSQL these are session advisory locks, which are released when the
+session ends if they are not before, so a dead worker does not hold one.
+Other databases have no such locks: advisory_lock() then always succeeds.
+"""
+from __future__ import unicode_literals
+from contextlib import contextmanager
+
+from django.db import connections
+
+
+@contextmanager
+def advisory_lock(key1, key2, using='default'):
+    """Yields whether the lock on the pair of 32 bit integers (key1, key2)
+    was acquired, without waiting for it."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        yield True
+        return
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [key1, key2])
+    if not cursor.fetchone()[0]:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [key1, key2])
@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from messagebox.fakesmsc import FakeSMSC
+
+
+class Command(BaseCommand):
+    help = """Run a local fake SMSC answering Kannel's sendsms requests"""
+    option_list = BaseCommand.option_list + (
+        make_option('--host', dest='host', default='127.0.0.1'),
+        make_option('--port', type='int', dest='port', default=13013),
+        make_option('--latency', type='float', dest='latency', default=0,
+                    help='Seconds taken by every request'),
+        make_option('--rate', type='int', dest='rate', default=None,
+                    help='Messages per second over which requests are '
+                         'refused'),
+    )
+
+    def handle(self, *args, **options):
+        smsc = FakeSMSC(options['host'], options['port'],
+                        latency=options['latency'], rate=options['rate'],
+                        verbose=int(options['verbosity']) > 1)
+        self.stdout.write('Fake SMSC listening on {}'.format(smsc.url))
+        try:
+            smsc.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            smsc.stop()
+        self.stdout.write('{} messages received in {} requests, {} requests '
+                          'refused'.format(len(smsc.messages),
+                                           len(smsc.requests), smsc.refused))
@@ -0,0 +1,51 @@
+from __future__ import unicode_literals
+from django.db import models
+from django_extensions.db import fields
+
+
+class OutboundMessage(models.Model):
+    """An SMS to one recipient waiting in the outbox (see
+    messagebox.outbox), or sent from it."""
+    QUEUED = 'Q'
+    SENDING = 'P'
+    SENT = 'S'
+    FAILED = 'F'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    text = models.TextField()
+    identity = models.CharField(max_length=100)
+    backend = models.CharField(max_length=20)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES,
+                              default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    claimed = models.DateTimeField(null=True, blank=True)  # by a dispatcher
+    sent = models.DateTimeField(null=True, blank=True)
+    created = fields.CreationDateTimeField()
+
+    class Meta:
+        # the dispatcher reads the queued messages in order
+        index_together = (('status', 'id'),)
+
+    def __unicode__(self):
+        return '{}: {}'.format(self.identity, self.text)
+
+
+class ScheduledMessage(models.Model):
+    """An SMS to one recipient held until release_after, when it is released
+    to the outbox by messagebox.schedule.release()."""
+    text = models.TextField()
+    identity = models.CharField(max_length=100)
+    release_after = models.DateTimeField()
+    created = fields.CreationDateTimeField()
+
+    class Meta:
+        index_together = (('release_after', 'id'),)
+
+    def __unicode__(self):
+        return '{}: {}'.format(self.identity, self.text)
@@ -0,0 +1,315 @@
+"""Outbox of the bulk SMS sent through settings.BULKSMS_BACKEND.
+
+send_sms tasks only queue their messages (one OutboundMessage per recipient);
+a Dispatcher then sends them: it claims the queued messages by batches,
+coalesces the messages with the same text into multi-recipient sends, looks
+connections up through an in-process cache and keeps to a budget of
+OUTBOUND_RATE messages per second.  Metrics of the last run (queue depth,
+messages sent, send latency) are kept in the cache, see metrics().
+
+Messages are claimed (marked as being sent) in the transaction which reads
+them, so no two dispatchers send the same message.  On PostgreSQL a single
+dispatcher runs at a time, so that the rate holds, through an advisory lock
+which is released with the connection if the process dies.  Messages claimed
+by a dispatcher which died are queued again after OUTBOUND_CLAIM_TIMEOUT
+seconds, so they may be sent twice.
+
+Messages are handed to the RapidSMS router (so they are logged like any other
+outgoing message); with the database router the backend is called shortly
+after, from the router's own tasks.
+"""
+from __future__ import unicode_literals
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.utils.timezone import now
+from rapidsms.models import Connection
+from rapidsms.router.api import lookup_connections, send
+
+from .locks import advisory_lock
+from .models import OutboundMessage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE = 10  # messages per second
+DEFAULT_BATCH_SIZE = 500  # queued messages read at a time
+DEFAULT_MAX_RECIPIENTS = 100  # per send
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_CLAIM_TIMEOUT = 600  # seconds
+
+# key of the lock held by the running dispatcher (see messagebox.locks)
+ADVISORY_LOCK = (46281, 1)
+METRICS_KEY = 'messagebox-outbox-metrics'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _cache():
+    return caches[_setting('OUTBOUND_CACHE', 'default')]
+
+
+def enqueue(text, recipients, backend=None):
+    """Queues text for each of recipients (phone numbers) and returns the
+    number of messages queued."""
+    backend = backend or settings.BULKSMS_BACKEND
+    OutboundMessage.objects.bulk_create([
+        OutboundMessage(text=text, identity=identity, backend=backend)
+        for identity in recipients])
+    return len(recipients)
+
+
+def queue_depth():
+    return OutboundMessage.objects.filter(status__in=(
+        OutboundMessage.QUEUED, OutboundMessage.SENDING)).count()
+
+
+def metrics():
+    """Returns the metrics of the last dispatcher run (empty if there was
+    none) along with the current queue depth."""
+    stored = _cache().get(METRICS_KEY) or {}
+    stored['queue_depth'] = queue_depth()
+    return stored
+
+
+class RateLimiter(object):
+    """Token bucket letting through at most rate messages per second on
+    average, and bursts of up to burst messages (rate by default)."""
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self.waited = 0.0
+
+    def acquire(self, count=1):
+        """Waits until count messages may be sent.  Counts above the burst
+        size take the bucket into debt, so that the average rate holds."""
+        current = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (current - self.updated) * self.rate)
+        self.updated = current
+        needed = min(count, self.burst)
+        if self.tokens < needed:
+            delay = (needed - self.tokens) / self.rate
+            self.sleep(delay)
+            self.waited += delay
+            self.tokens += delay * self.rate
+            self.updated += delay
+        self.tokens -= count
+
+
+class ConnectionCache(object):
+    """Bounded cache of (backend name, identity) -> Connection.  Misses are
+    looked up in one query per backend, connections which do not exist yet
+    are created by lookup_connections."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, backend, identities):
+        """Returns the connections of identities on backend, in order."""
+        found = {}
+        with self._lock:
+            for identity in identities:
+                connection = self._entries.pop((backend, identity), None)
+                if connection is not None:
+                    self._entries[(backend, identity)] = connection
+                    found[identity] = connection
+        self.hits += len(found)
+        missing = [identity for identity in identities
+                   if identity not in found]
+        self.misses += len(missing)
+        if missing:
+            for connection in Connection.objects.filter(
+                    backend__name=backend,
+                    identity__in=missing).select_related('backend'):
+                found[connection.identity] = connection
+            new = [identity for identity in missing if identity not in found]
+            if new:
+                for connection in lookup_connections(backend, new):
+                    found[connection.identity] = connection
+            with self._lock:
+                for identity in missing:
+                    self._entries[(backend, identity)] = found[identity]
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return [found[identity] for identity in identities]
+
+    def discard(self, sender=None, instance=None, **kwargs):
+        with self._lock:
+            self._entries.pop((instance.backend.name, instance.identity), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+connection_cache = ConnectionCache()
+post_delete.connect(connection_cache.discard, sender=Connection,
+                    dispatch_uid='messagebox-connection-cache-delete')
+
+
+class Metrics(object):
+    def __init__(self, queue_depth):
+        self.started = time.time()
+        self.initial_queue_depth = queue_depth
+        self.messages = 0  # recipients sent to
+        self.sends = 0  # calls to send()
+        self.failures = 0
+        self.latencies = []
+
+    def add(self, recipients, latency, failed=False):
+        self.sends += 1
+        self.latencies.append(latency)
+        if failed:
+            self.failures += 1
+        else:
+            self.messages += recipients
+
+    def as_dict(self, limiter=None):
+        elapsed = time.time() - self.started
+        latencies = sorted(self.latencies) or [0.0]
+        return {
+            'started': self.started,
+            'elapsed': elapsed,
+            'initial_queue_depth': self.initial_queue_depth,
+            'messages': self.messages,
+            'sends': self.sends,
+            'failures': self.failures,
+            'rate': self.messages / elapsed if elapsed else 0.0,
+            'latency_mean': sum(latencies) / len(latencies),
+            'latency_max': latencies[-1],
+            'latency_p95': latencies[min(len(latencies) - 1,
+                                         int(len(latencies) * 0.95))],
+            'throttled': limiter.waited if limiter else 0.0,
+        }
+
+
+class Dispatcher(object):
+    """Sends the queued messages.  run() returns at once if another
+    dispatcher is running, which will send whatever was queued meanwhile."""
+
+    def __init__(self, rate=None, batch_size=None, max_recipients=None,
+                 max_attempts=None, limiter=None, connections=None):
+        self.rate = rate or _setting('OUTBOUND_RATE', DEFAULT_RATE)
+        self.batch_size = batch_size or _setting('OUTBOUND_BATCH_SIZE',
+                                                 DEFAULT_BATCH_SIZE)
+        self.max_recipients = max_recipients or _setting(
+            'OUTBOUND_MAX_RECIPIENTS', DEFAULT_MAX_RECIPIENTS)
+        self.max_attempts = max_attempts or _setting(
+            'OUTBOUND_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        self.limiter = limiter or RateLimiter(self.rate)
+        self.connections = connections or connection_cache
+
+    def run(self):
+        """Sends queued messages until the queue is empty or the backend
+        fails.  Returns the metrics of the run, or None if another dispatcher
+        is running."""
+        using = router.db_for_write(OutboundMessage)
+        with advisory_lock(*ADVISORY_LOCK, using=using) as acquired:
+            if not acquired:
+                return None
+            self.requeue_stale()
+            metrics = Metrics(queue_depth())
+            while True:
+                batch = self.claim()
+                if not batch:
+                    break
+                try:
+                    sent = self.send_batch(batch, metrics)
+                finally:
+                    # what a failed send left of the batch goes back to the
+                    # queue
+                    OutboundMessage.objects.filter(
+                        pk__in=[message.pk for message in batch],
+                        status=OutboundMessage.SENDING).update(
+                        status=OutboundMessage.QUEUED, claimed=None)
+                if not sent:
+                    break
+            result = metrics.as_dict(self.limiter)
+            _cache().set(METRICS_KEY, result, None)
+            logger.info('Outbox: %(messages)d messages in %(sends)d sends, '
+                        '%(failures)d failed, %(rate).1f/s, latency '
+                        '%(latency_mean).3fs (max %(latency_max).3fs)',
+                        result)
+            return result
+
+    def claim(self):
+        """Marks the next batch_size queued messages as being sent and returns
+        them."""
+        with transaction.atomic():
+            batch = list(OutboundMessage.objects.select_for_update().filter(
+                status=OutboundMessage.QUEUED).order_by('pk')[
+                :self.batch_size])
+            OutboundMessage.objects.filter(
+                pk__in=[message.pk for message in batch]).update(
+                status=OutboundMessage.SENDING, claimed=now())
+        return batch
+
+    @staticmethod
+    def requeue_stale():
+        """Queues again the messages claimed by a dispatcher which has not
+        sent them within OUTBOUND_CLAIM_TIMEOUT seconds."""
+        timeout = _setting('OUTBOUND_CLAIM_TIMEOUT', DEFAULT_CLAIM_TIMEOUT)
+        return OutboundMessage.objects.filter(
+            status=OutboundMessage.SENDING,
+            claimed__lt=now() - timedelta(seconds=timeout)).update(
+            status=OutboundMessage.QUEUED, claimed=None)
+
+    def send_batch(self, batch, metrics):
+        """Sends a batch of queued messages, coalescing those with the same
+        backend and text.  Returns False if a send failed, leaving the rest
+        of the batch queued."""
+        groups = OrderedDict()
+        for message in batch:
+            groups.setdefault((message.backend, message.text),
+                              []).append(message)
+
+        for (backend, text), messages in groups.items():
+            for start in range(0, len(messages), self.max_recipients):
+                chunk = messages[start:start + self.max_recipients]
+                if not self.send(backend, text, chunk, metrics):
+                    return False
+        return True
+
+    def send(self, backend, text, messages, metrics):
+        # the same number may have been queued several times with the text
+        identities = list(OrderedDict.fromkeys(m.identity for m in messages))
+        pks = [message.pk for message in messages]
+        self.limiter.acquire(len(identities))
+        started = time.time()
+        try:
+            send(text, self.connections.get_many(backend, identities))
+        except Exception as e:
+            metrics.add(len(identities), time.time() - started, failed=True)
+            logger.exception('Sending to %d recipients failed',
+                             len(identities))
+            # the messages of a send may have had different attempts
+            OutboundMessage.objects.filter(pk__in=pks).update(
+                attempts=F('attempts') + 1, error=unicode(e), claimed=None,
+                status=OutboundMessage.QUEUED)
+            OutboundMessage.objects.filter(
+                pk__in=pks, attempts__gte=self.max_attempts).update(
+                status=OutboundMessage.FAILED)
+            return False
+        metrics.add(len(identities), time.time() - started)
+        OutboundMessage.objects.filter(pk__in=pks).update(
+            status=OutboundMessage.SENT, sent=now(), error='')
+        return True
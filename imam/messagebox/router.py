@@ -0,0 +1,17 @@
+from __future__ import unicode_literals
+from rapidsms.router.db import DatabaseRouter
+
+from . import inbound
+from .tasks import process_inbound
+
+
+class InboundRouter(DatabaseRouter):
+    """Database router processing the incoming messages of each connection
+    in order (see messagebox.inbound)."""
+
+    def receive_incoming(self, msg):
+        # the message is stored already (by new_incoming_message), the
+        # backend's request returns once the task is queued
+        inbound.save_fields(msg.id, msg.fields)
+        for connection in msg.connections:
+            process_inbound.delay(connection.pk)
@@ -0,0 +1,97 @@
+"""Messages held until the daily sending window (ALERT_WINDOW_START to
+ALERT_WINDOW_END, local time) opens.
+
+Messages outside the window are stored as ScheduledMessage rows rather than
+as tasks with an ETA, which the workers would have to keep in memory all
+night and would run all at once in the morning.  Once the window is open,
+release() moves them to the outbox by batches of SCHEDULE_RELEASE_BATCH_SIZE
+(it is run every minute by celerybeat), sending each recipient a given text
+only once however many times it was held.
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import localtime, now
+
+from . import outbox
+from .models import ScheduledMessage
+
+DEFAULT_WINDOW_START = 8  # hour of the day
+DEFAULT_WINDOW_END = 20
+DEFAULT_RELEASE_BATCH_SIZE = 300  # messages per release
+
+
+def window(timestamp=None):
+    """Returns the local start and end of the sending window of the day of
+    timestamp (now by default)."""
+    current = localtime(timestamp or now())
+    start = current.replace(
+        hour=getattr(settings, 'ALERT_WINDOW_START', DEFAULT_WINDOW_START),
+        minute=0, second=0, microsecond=0)
+    end = current.replace(
+        hour=getattr(settings, 'ALERT_WINDOW_END', DEFAULT_WINDOW_END),
+        minute=0, second=0, microsecond=0)
+    return start, end
+
+
+def next_opening(timestamp=None):
+    """Returns when messages sent at timestamp (now by default) may go out,
+    or None if the window is open."""
+    current = localtime(timestamp or now())
+    start, end = window(current)
+    if current < start:
+        return start
+    if current > end:
+        return start + timedelta(days=1)
+    return None
+
+
+def hold(text, recipients, timestamp=None):
+    """Holds text for recipients until the window opens and returns True,
+    or returns False if the window is open and the message can be sent
+    right away."""
+    release_after = next_opening(timestamp)
+    if release_after is None:
+        return False
+    ScheduledMessage.objects.bulk_create([
+        ScheduledMessage(text=text, identity=identity,
+                         release_after=release_after)
+        for identity in recipients])
+    return True
+
+
+def release(batch_size=None, timestamp=None):
+    """Moves up to batch_size due messages to the outbox, dropping the other
+    held copies of the same text to the same recipients.  Returns the number
+    of messages queued."""
+    if batch_size is None:
+        batch_size = getattr(settings, 'SCHEDULE_RELEASE_BATCH_SIZE',
+                             DEFAULT_RELEASE_BATCH_SIZE)
+    current = timestamp or now()
+    if next_opening(current) is not None:
+        return 0
+
+    with transaction.atomic():
+        due = list(ScheduledMessage.objects.select_for_update().filter(
+            release_after__lte=current).order_by('pk')[:batch_size])
+        if not due:
+            return 0
+
+        by_text = OrderedDict()
+        for message in due:
+            by_text.setdefault(message.text, OrderedDict())[
+                message.identity] = None
+        pairs = set((message.identity, message.text) for message in due)
+        duplicates = ScheduledMessage.objects.filter(
+            identity__in=set(identity for identity, _ in pairs),
+            text__in=by_text.keys()).values_list('pk', 'identity', 'text')
+        ScheduledMessage.objects.filter(pk__in=set(
+            [message.pk for message in due] +
+            [pk for pk, identity, text in duplicates
+             if (identity, text) in pairs])).delete()
+
+        return sum(outbox.enqueue(text, list(identities))
+                   for text, identities in by_text.items())
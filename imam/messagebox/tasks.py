@@ -1,16 +1,9 @@
 from celery import task
 from celery.utils.log import get_task_logger
-from rapidsms.router.api import lookup_connections, send
-from django.conf import settings
 
-logger = get_task_logger(__name__)
-
-
-def _send_sms(message, *recipients):
-    backend = settings.BULKSMS_BACKEND
-    connections = lookup_connections(backend, recipients)
+from . import inbound, outbox, schedule
 
-    send(message, connections)
+logger = get_task_logger(__name__)
 
 
 @task()
@@ -19,4 +12,31 @@ def send_sms(message, *recipients):
         logger.warn('send_sms task called with empty recipient list')
         return
 
-    _send_sms(message, *recipients)
+    outbox.enqueue(message, recipients)
+    dispatch_outbound.delay()
+
+
+@task(ignore_result=True)
+def dispatch_outbound():
+    """Sends the queued messages, unless a dispatcher is running already."""
+    outbox.Dispatcher().run()
+
+
+@task(ignore_result=True)
+def release_scheduled():
+    """Queues the next batch of held messages if the window is open."""
+    if schedule.release():
+        dispatch_outbound.delay()
+
+
+@task(ignore_result=True)
+def process_inbound(connection_id):
+    """Processes the queued incoming messages of a connection in order."""
+    inbound.process(connection_id)
+
+
+@task(ignore_result=True)
+def process_inbound_backlog():
+    """Processes the incoming messages whose task was lost."""
+    for connection_id in inbound.backlog():
+        process_inbound.delay(connection_id)
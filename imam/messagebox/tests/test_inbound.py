@@ -0,0 +1,122 @@
+from __future__ import unicode_literals
+import unittest
+
+import mock
+from model_mommy import mommy
+from rapidsms.models import Connection
+
+import django.test
+import django.test.utils
+from django.apps import apps
+from django.db import connection
+
+from messagebox import inbound
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+
+@unittest.skipUnless(apps.is_installed('rapidsms.router.db'),
+                     "the database router is not installed")
+@django.test.utils.override_settings(CACHES=CACHES)
+class ProcessTest(django.test.TestCase):
+    def setUp(self):
+        self.connection = mommy.make(Connection, identity='+2341')
+        self.router = mock.Mock()
+        self.router.create_message_from_dbm.side_effect = \
+            lambda dbm, fields: (dbm.text, fields)
+        self.processed = []
+        self.router.process_incoming.side_effect = self.process_incoming
+        patcher = mock.patch('messagebox.inbound.get_router',
+                             return_value=self.router)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def process_incoming(self, message):
+        text, fields = message
+        self.processed.append(text)
+        if text == 'fail':
+            raise Exception('Handler failed')
+
+    def store(self, text, connection=None):
+        Message = apps.get_model('db', 'Message')
+        Transmission = apps.get_model('db', 'Transmission')
+        dbm = Message.objects.create(text=text, direction='I', status='Q')
+        Transmission.objects.create(message=dbm, status='Q',
+                                    connection=connection or self.connection)
+        return dbm
+
+    def statuses(self):
+        Message = apps.get_model('db', 'Message')
+        return list(Message.objects.order_by('pk').values_list('text',
+                                                               'status'))
+
+    def test_messages_are_processed_in_order(self):
+        for text in ('soh 1', 'soh 2', 'soh 3'):
+            self.store(text)
+
+        self.assertEqual(inbound.process(self.connection.pk), 3)
+
+        self.assertEqual(self.processed, ['soh 1', 'soh 2', 'soh 3'])
+        self.assertEqual(self.statuses(), [('soh 1', 'R'), ('soh 2', 'R'),
+                                           ('soh 3', 'R')])
+
+    def test_failed_message_does_not_stop_the_others(self):
+        self.store('fail')
+        self.store('soh 1')
+
+        self.assertEqual(inbound.process(self.connection.pk), 2)
+
+        self.assertEqual(self.statuses(), [('fail', 'E'), ('soh 1', 'R')])
+
+    def test_only_the_messages_of_the_connection_are_processed(self):
+        self.store('soh 1', mommy.make(Connection, identity='+2342'))
+        self.store('soh 2')
+
+        self.assertEqual(inbound.process(self.connection.pk), 1)
+
+        self.assertEqual(self.processed, ['soh 2'])
+
+    def test_extra_fields_are_passed_on(self):
+        dbm = self.store('soh 1')
+        inbound.save_fields(dbm.pk, {'external_id': '42'})
+        messages = []
+        self.router.process_incoming.side_effect = messages.append
+
+        inbound.process(self.connection.pk)
+
+        self.assertEqual(messages, [('soh 1', {'external_id': '42'})])
+
+    def test_messages_stored_meanwhile_are_processed(self):
+        self.store('soh 1')
+
+        def process_incoming(message):
+            self.processed.append(message[0])
+            if message[0] == 'soh 1':
+                self.store('soh 2')
+        self.router.process_incoming.side_effect = process_incoming
+
+        self.assertEqual(inbound.process(self.connection.pk), 2)
+        self.assertEqual(self.processed, ['soh 1', 'soh 2'])
+
+    @unittest.skipUnless(connection.vendor == 'postgresql',
+                         "advisory locks are only taken on PostgreSQL")
+    def test_messages_are_left_to_the_worker_processing_the_connection(self):
+        self.store('soh 1')
+        # another worker, on another database session
+        other = type(connection)(connection.settings_dict.copy(), 'other')
+        self.addCleanup(other.close)
+        cursor = other.cursor()
+        cursor.execute('SELECT pg_try_advisory_lock(%s, %s)',
+                       [inbound.ADVISORY_LOCK_CLASS, self.connection.pk])
+        self.assertTrue(cursor.fetchone()[0])
+
+        self.assertEqual(inbound.process(self.connection.pk), 0)
+        self.assertEqual(self.statuses(), [('soh 1', 'Q')])
+
+        cursor.execute('SELECT pg_advisory_unlock(%s, %s)',
+                       [inbound.ADVISORY_LOCK_CLASS, self.connection.pk])
+        self.assertEqual(inbound.process(self.connection.pk), 1)
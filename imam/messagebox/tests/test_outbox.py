@@ -0,0 +1,219 @@
+from __future__ import unicode_literals
+from datetime import timedelta
+
+import mock
+
+import django.test
+import django.test.utils
+from django.utils.timezone import now
+
+from messagebox import outbox
+from messagebox.fakesmsc import FakeSMSC
+from messagebox.models import OutboundMessage
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.time = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.time += seconds
+
+
+class RateLimiterTest(django.test.SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = outbox.RateLimiter(10, clock=self.clock,
+                                          sleep=self.clock.sleep)
+
+    def test_burst_goes_through_at_once(self):
+        self.limiter.acquire(10)
+        self.assertEqual(self.clock.slept, [])
+
+    def test_waits_for_the_tokens_needed(self):
+        self.limiter.acquire(10)
+        self.limiter.acquire(5)
+        self.assertEqual(self.clock.slept, [0.5])
+        self.assertEqual(self.limiter.waited, 0.5)
+
+    def test_tokens_come_back_with_time(self):
+        self.limiter.acquire(10)
+        self.clock.time += 0.3
+        self.limiter.acquire(5)
+        self.assertAlmostEqual(self.clock.slept[0], 0.2)
+
+    def test_counts_over_the_burst_keep_the_average_rate(self):
+        self.limiter.acquire(30)
+        self.limiter.acquire(10)
+        # the 20 messages over the burst are paid for before the next send
+        self.assertEqual(self.clock.slept, [3.0])
+
+
+@django.test.utils.override_settings(BULKSMS_BACKEND='bulk', CACHES=CACHES)
+class DispatcherTest(django.test.TestCase):
+    def setUp(self):
+        self.connections = mock.Mock()
+        self.connections.get_many.side_effect = \
+            lambda backend, identities: list(identities)
+        patcher = mock.patch('messagebox.outbox.send')
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def dispatcher(self, **kwargs):
+        kwargs.setdefault('rate', 1000)
+        return outbox.Dispatcher(connections=self.connections, **kwargs)
+
+    def sends(self):
+        return [(text, list(recipients))
+                for (text, recipients), _ in self.send.call_args_list]
+
+    def statuses(self):
+        return list(OutboundMessage.objects.order_by('pk').values_list(
+            'identity', 'status', 'attempts'))
+
+    def test_messages_with_the_same_text_are_sent_together(self):
+        outbox.enqueue('Low stock', ['+2341', '+2342', '+2341'])
+        outbox.enqueue('Reminder', ['+2343'])
+        outbox.enqueue('Low stock', ['+2344'])
+
+        result = self.dispatcher().run()
+
+        self.assertEqual(self.sends(), [
+            ('Low stock', ['+2341', '+2342', '+2344']),
+            ('Reminder', ['+2343']),
+        ])
+        self.assertEqual(set(OutboundMessage.objects.values_list(
+            'status', flat=True)), set([OutboundMessage.SENT]))
+        self.assertEqual((result['messages'], result['sends']), (4, 2))
+        self.assertEqual(outbox.metrics()['queue_depth'], 0)
+
+    def test_sends_are_limited_to_max_recipients(self):
+        outbox.enqueue('Low stock', ['+2341', '+2342', '+2343'])
+
+        self.dispatcher(max_recipients=2, batch_size=2).run()
+
+        self.assertEqual(self.sends(), [
+            ('Low stock', ['+2341', '+2342']),
+            ('Low stock', ['+2343']),
+        ])
+
+    def test_failed_send_is_retried_up_to_max_attempts(self):
+        outbox.enqueue('Low stock', ['+2341'])
+        outbox.enqueue('Reminder', ['+2342'])
+        self.send.side_effect = Exception('Backend down')
+
+        self.dispatcher(max_attempts=2).run()
+        # the rest of the batch is left queued
+        self.assertEqual(self.statuses(), [
+            ('+2341', OutboundMessage.QUEUED, 1),
+            ('+2342', OutboundMessage.QUEUED, 0),
+        ])
+        self.assertEqual(OutboundMessage.objects.get(
+            identity='+2341').error, 'Backend down')
+
+        self.dispatcher(max_attempts=2).run()
+        self.assertEqual(self.statuses()[0],
+                         ('+2341', OutboundMessage.FAILED, 2))
+
+        self.send.side_effect = None
+        self.dispatcher(max_attempts=2).run()
+        self.assertEqual(self.statuses(), [
+            ('+2341', OutboundMessage.FAILED, 2),
+            ('+2342', OutboundMessage.SENT, 0),
+        ])
+
+    def test_attempts_are_counted_per_message(self):
+        outbox.enqueue('Low stock', ['+2341', '+2342', '+2343'])
+        # a retry sent along with fresh messages of the same text
+        OutboundMessage.objects.filter(identity='+2341').update(attempts=1)
+        OutboundMessage.objects.filter(identity='+2342').update(attempts=2)
+        self.send.side_effect = Exception('Backend down')
+
+        self.dispatcher(max_attempts=3).run()
+
+        self.assertEqual(self.statuses(), [
+            ('+2341', OutboundMessage.QUEUED, 2),
+            ('+2342', OutboundMessage.FAILED, 3),
+            ('+2343', OutboundMessage.QUEUED, 1),
+        ])
+
+    def test_claimed_messages_are_left_to_their_dispatcher(self):
+        outbox.enqueue('Low stock', ['+2341', '+2342', '+2343'])
+
+        first = self.dispatcher(batch_size=2).claim()
+        second = self.dispatcher(batch_size=2).claim()
+
+        self.assertEqual([message.identity for message in first],
+                         ['+2341', '+2342'])
+        self.assertEqual([message.identity for message in second],
+                         ['+2343'])
+        self.assertEqual(self.dispatcher().claim(), [])
+
+    def test_messages_of_a_dead_dispatcher_are_queued_again(self):
+        outbox.enqueue('Low stock', ['+2341', '+2342'])
+        self.dispatcher(batch_size=2).claim()
+        OutboundMessage.objects.filter(identity='+2341').update(
+            claimed=now() - timedelta(seconds=outbox.DEFAULT_CLAIM_TIMEOUT + 1))
+
+        self.dispatcher().run()
+
+        self.assertEqual(self.sends(), [('Low stock', ['+2341'])])
+        self.assertEqual(self.statuses(), [
+            ('+2341', OutboundMessage.SENT, 0),
+            ('+2342', OutboundMessage.SENDING, 0),
+        ])
+
+
+@django.test.utils.override_settings(
+    BULKSMS_BACKEND='fake-smsc', CACHES=CACHES,
+    RAPIDSMS_ROUTER='rapidsms.router.blocking.BlockingRouter')
+class FakeSMSCTest(django.test.TestCase):
+    def run_dispatcher(self, smsc, **kwargs):
+        backends = {
+            'fake-smsc': {
+                'ENGINE': 'rapidsms.backends.kannel.KannelBackend',
+                'sendsms_url': smsc.url,
+                'sendsms_params': {'smsc': 'fake', 'from': '0000',
+                                   'username': 'fake', 'password': 'fake'},
+            },
+        }
+        with django.test.utils.override_settings(INSTALLED_BACKENDS=backends):
+            return outbox.Dispatcher(
+                connections=outbox.ConnectionCache(), **kwargs).run()
+
+    def test_messages_are_sent_to_the_smsc(self):
+        outbox.enqueue('Low stock', ['+2341', '+2342'])
+        outbox.enqueue('Reminder', ['+2343'])
+
+        with FakeSMSC(port=0) as smsc:
+            result = self.run_dispatcher(smsc, rate=100)
+
+        self.assertEqual(sorted(smsc.messages), [
+            ('Low stock', '+2341'), ('Low stock', '+2342'),
+            ('Reminder', '+2343')])
+        self.assertEqual(len(smsc.requests), 2)
+        self.assertEqual(result['messages'], 3)
+        self.assertFalse(OutboundMessage.objects.exclude(
+            status=OutboundMessage.SENT).exists())
+
+    def test_throttled_messages_stay_queued(self):
+        outbox.enqueue('Low stock', ['+2341', '+2342'])
+
+        with FakeSMSC(port=0, rate=1) as smsc:
+            result = self.run_dispatcher(smsc, rate=100)
+
+        self.assertEqual((smsc.messages, smsc.refused), ([], 1))
+        self.assertEqual(result['failures'], 1)
+        self.assertEqual(list(OutboundMessage.objects.values_list(
+            'status', 'attempts')), [(OutboundMessage.QUEUED, 1)] * 2)
@@ -0,0 +1,86 @@
+from __future__ import unicode_literals
+from datetime import datetime
+
+import django.test
+import django.test.utils
+from django.utils.timezone import get_current_timezone, make_aware
+
+from messagebox import schedule
+from messagebox.models import OutboundMessage, ScheduledMessage
+
+
+def local(*args):
+    return make_aware(datetime(*args), get_current_timezone())
+
+
+@django.test.utils.override_settings(ALERT_WINDOW_START=8,
+                                     ALERT_WINDOW_END=20)
+class WindowTest(django.test.SimpleTestCase):
+    def test_before_the_window_waits_for_the_opening(self):
+        self.assertEqual(schedule.next_opening(local(2015, 6, 1, 7, 59, 59)),
+                         local(2015, 6, 1, 8))
+
+    def test_window_includes_its_edges(self):
+        self.assertIsNone(schedule.next_opening(local(2015, 6, 1, 8)))
+        self.assertIsNone(schedule.next_opening(local(2015, 6, 1, 20)))
+
+    def test_after_the_window_waits_for_the_next_day(self):
+        self.assertEqual(schedule.next_opening(local(2015, 6, 1, 20, 0, 1)),
+                         local(2015, 6, 2, 8))
+        self.assertEqual(schedule.next_opening(local(2015, 6, 30, 23, 30)),
+                         local(2015, 7, 1, 8))
+
+
+@django.test.utils.override_settings(ALERT_WINDOW_START=8,
+                                     ALERT_WINDOW_END=20,
+                                     BULKSMS_BACKEND='bulk')
+class HoldTest(django.test.TestCase):
+    evening = local(2015, 6, 1, 21)
+    morning = local(2015, 6, 2, 8, 1)
+
+    def queued(self):
+        return sorted(OutboundMessage.objects.values_list('text', 'identity'))
+
+    def test_messages_in_the_window_are_not_held(self):
+        self.assertFalse(schedule.hold('Low stock', ['+2341'],
+                                       local(2015, 6, 1, 12)))
+        self.assertFalse(ScheduledMessage.objects.exists())
+
+    def test_messages_are_held_until_the_window_opens(self):
+        self.assertTrue(schedule.hold('Low stock', ['+2341', '+2342'],
+                                      self.evening))
+
+        self.assertEqual(set(ScheduledMessage.objects.values_list(
+            'identity', 'release_after')),
+            set([('+2341', local(2015, 6, 2, 8)),
+                 ('+2342', local(2015, 6, 2, 8))]))
+        self.assertEqual(schedule.release(timestamp=local(2015, 6, 2, 7)), 0)
+        self.assertEqual(self.queued(), [])
+
+    def test_release_goes_by_batches(self):
+        schedule.hold('Low stock', ['+2341', '+2342', '+2343'], self.evening)
+
+        self.assertEqual(schedule.release(2, self.morning), 2)
+        self.assertEqual(self.queued(), [('Low stock', '+2341'),
+                                         ('Low stock', '+2342')])
+        self.assertEqual(schedule.release(2, self.morning), 1)
+        self.assertEqual(schedule.release(2, self.morning), 0)
+        self.assertEqual(len(self.queued()), 3)
+
+    def test_recipient_gets_a_text_once(self):
+        for hour in (21, 22, 23):
+            schedule.hold('Low stock', ['+2341'], local(2015, 6, 1, hour))
+        schedule.hold('Low stock', ['+2342'], self.evening)
+        schedule.hold('Reminder', ['+2341'], self.evening)
+
+        # the other copies are dropped, even beyond the batch
+        self.assertEqual(schedule.release(1, self.morning), 1)
+        self.assertEqual(self.queued(), [('Low stock', '+2341')])
+        self.assertEqual(sorted(ScheduledMessage.objects.values_list(
+            'text', 'identity')), [('Low stock', '+2342'),
+                                   ('Reminder', '+2341')])
+
+        self.assertEqual(schedule.release(timestamp=self.morning), 2)
+        self.assertEqual(self.queued(), [('Low stock', '+2341'),
+                                         ('Low stock', '+2342'),
+                                         ('Reminder', '+2341')])
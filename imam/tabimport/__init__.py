@@ -8,30 +8,35 @@ Usage:
 >>> for data_line in smart_file:
 >>>     do_something_with(data_line['header'])
 
+XLSX files are read by tabimport.xlsx, which streams the sheets from the zip
+container without xlrd.
+
+Rows are SortedDicts by default.  CSV, XLS and XLSX files can also return them
+as plain tuples (row_type='tuple', in the order of get_columns()) or as
+namedtuples (row_type='namedtuple'), which are cheaper to build:
+>>> smart_file = FileFactory(file_path, row_type='tuple')
+
 """
 import csv
 import logging
+import re
 import tempfile
+from collections import namedtuple
 from datetime import datetime
-
-try:
-    # XLS/XLSX format
-    # http://www.lexicon.net/sjmachin/xlrd.html
-    import xlrd
-    has_xlrd = True
-except ImportError:
-    has_xlrd = False
-
-try:
-    # ODF format
-    import ooolib
-    has_ooolib = True
-except ImportError:
-    has_ooolib = False
+from importlib import import_module
 
 from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext as _
 
+def optional_module(name):
+    """ Imports one of the optional reader libraries (xlrd for XLS/XLSX,
+    ooolib for ODF) the first time a file needing it is read, so that
+    importing tabimport stays cheap; returns None if it is not installed."""
+    try:
+        return import_module(name)
+    except ImportError:
+        return None
+
 class UnsupportedFileFormat(Exception):
     pass
 
@@ -45,7 +50,10 @@ class FileFactory(object):
         format = cls._sniff_format(datafile)
         if format == 'ods':
             return ODSImportedFile(datafile, **imp_params)
-        elif format in ('xls', 'xlsx'):
+        elif format == 'xlsx':
+            from .xlsx import XLSXImportedFile
+            return XLSXImportedFile(datafile, **imp_params)
+        elif format == 'xls':
             return XLSImportedFile(datafile, **imp_params)
         elif format == 'csv':
             return CSVImportedFile(datafile, **imp_params)
@@ -76,16 +84,23 @@ class ImportedFile(object):
     # Set to True if the external lib does not support file-like objects
     force_file_to_disk = False
 
-    def __init__(self, datafile, sheet_index=0, skip_lines=None):
+    row_types = ('dict', 'tuple', 'namedtuple')
+
+    def __init__(self, datafile, sheet_index=0, skip_lines=None, row_type='dict'):
         """ datafile can be either a path (string) or a file object
             sheet_index is the spreadsheet index, if applicable
-            skip_lines is a list of row indexes to skip """
+            skip_lines is a list of row indexes to skip
+            row_type is one of 'dict', 'tuple' or 'namedtuple' """
         # Some internal variables are initialized in activate_sheet so as they
         # are resetted whenever a new sheet is activated
+        if row_type not in self.row_types:
+            raise ValueError("Unknown row type '%s'" % row_type)
+        self.row_type = row_type
         self._headers = {} # dict of lists
-        self._ignored_headers_idx = {} # dict of lists
+        self._ignored_headers_idx = {} # dict of sets
+        self._columns = {} # dict of (column indexes, headers, row class)
         self.data_sheet_indexes = [sheet_index]
-        self.skip_lines = skip_lines
+        self.skip_lines = set(skip_lines or ())
         self.file_content = None
         if isinstance(datafile, basestring):
             self.file_path = datafile
@@ -123,6 +138,43 @@ class ImportedFile(object):
     def current_sheet_name(self):
         raise NotImplementedError("Abstract class")
 
+    def only_sheet(self, idx):
+        """ Restricts reading to the sheet idx (instead of moving on to the
+        next data sheets once its rows have been read) """
+        self.activate_sheet(idx)
+        self.data_sheet_indexes = [idx]
+
+    def get_columns(self):
+        """ Returns the indexes and the headers of the columns of the current
+        sheet which are not ignored, computed once per sheet """
+        if not self.current_index in self._columns:
+            headers = self.get_headers()
+            ignored = self._ignored_headers_idx[self.current_index]
+            indexes = tuple(i for i in range(len(headers)) if i not in ignored)
+            names = tuple(headers[i] for i in indexes)
+            row_class = None
+            if self.row_type == 'namedtuple':
+                row_class = namedtuple('Row', [self._field_name(h) for h in names], rename=True)
+            self._columns[self.current_index] = (indexes, names, row_class)
+        return self._columns[self.current_index][:2]
+
+    @staticmethod
+    def _field_name(header):
+        # namedtuple only takes ASCII identifiers, other names are replaced by
+        # positional ones (_0, _1...)
+        name = re.sub(r'\W+', '_', unicode(header).strip())
+        return name.encode('ascii', 'replace')
+
+    def _make_row(self, values):
+        """ Builds a row of the configured type from the values of the columns
+        returned by get_columns() """
+        if self.row_type == 'tuple':
+            return tuple(values)
+        row_class = self._columns[self.current_index][2]
+        if row_class is not None:
+            return row_class(*values)
+        return SortedDict(zip(self._columns[self.current_index][1], values))
+
     def check_header_validity(self, possible_headers, mandatory_headers, case_sensitive=False): # TODO: ignore_pattern
         """ This method has the side effect of swallowing the first line (headers) of the file """
         errors = []
@@ -141,10 +193,10 @@ class ImportedFile(object):
                         (self.current_sheet_name(),
                          "(%s header empty)" % idx_to_header(i),
                          _("Empty header")))
-                    self._ignored_headers_idx[self.current_index].append(i)
+                    self._ignored_headers_idx[self.current_index].add(i)
                 elif h_norm not in possible_headers:
                     warnings.append((self.current_sheet_name(), h, _("Unknown header")))
-                    self._ignored_headers_idx[self.current_index].append(i)
+                    self._ignored_headers_idx[self.current_index].add(i)
                 elif h in good_headers:
                     errors.append(_("The column '%s' is twice in your file's headers (sheet '%s')") % (h, self.current_sheet_name()))
                 else:
@@ -152,7 +204,8 @@ class ImportedFile(object):
             for h in mandatory_headers:
                 if h not in good_headers:
                     errors.append(_("The header '%s' is mandatory and is missing in sheet '%s' of your file") % (h, self.current_sheet_name()))
-        self.activate_sheet(0)
+            self._columns.pop(self.current_index, None)
+        self.activate_sheet(self.data_sheet_indexes[0])
         if errors:
             raise HeaderError(u"\n".join(errors))
         return warnings
@@ -160,11 +213,12 @@ class ImportedFile(object):
 
 class CSVImportedFile(ImportedFile):
     encoding = 'latin-1'
-    def __init__(self, datafile, sheet_index=0, **kwds):
-        super(CSVImportedFile, self).__init__(datafile, sheet_index)
+    def __init__(self, datafile, sheet_index=0, fieldnames=None, row_type='dict', **kwds):
+        """ kwds are passed to csv.reader as formatting parameters """
+        super(CSVImportedFile, self).__init__(datafile, sheet_index, row_type=row_type)
         if isinstance(datafile, basestring):
             # if datafile is a path, try to open the file
-            datafile = open(datafile, 'r')
+            datafile = open(datafile, 'rb')
         try:
             dialect = csv.Sniffer().sniff(datafile.read(2048))
             # Python 2.4 csv module weakness ?
@@ -175,113 +229,137 @@ class CSVImportedFile(ImportedFile):
             dialect.delimiter = ";"
         self.delimiter = dialect.delimiter
         datafile.seek(0)
-        datafile = UTF8Recoder(datafile, self.encoding)
-        self.reader = csv.DictReader(datafile, dialect=dialect, **kwds)
-        # It may happen that fieldnames are not filled before first line has been read
-        self._first_line_read = False
-        self._first_line = None
+        # rows are read as bytes and each value is decoded once
+        self.reader = csv.reader(datafile, dialect=dialect, **kwds)
+        self._fieldnames = fieldnames
+        self.activate_sheet(sheet_index)
 
     def get_headers(self):
         if not self.current_index in self._headers:
-            self._ignored_headers_idx[self.current_index] = []
-            if not self._first_line_read:
-                self._first_line = self.reader.next()
-                self._first_line_read = True
-            self._headers[self.current_index] = self.reader.fieldnames
-            if not isinstance(self._headers[self.current_index], list):
-                self._headers[self.current_index] = self._headers[self.current_index].split(self.delimiter)
+            self._ignored_headers_idx[self.current_index] = set()
+            if self._fieldnames is None:
+                self._fieldnames = [value.decode(self.encoding) for value in next(self.reader, [])]
+            self._headers[self.current_index] = list(self._fieldnames)
         return self._headers[self.current_index]
 
     def next(self):
-        """ Returns a SortedDict : {'DESCRIPTOR': value, ...} """
-        if self._first_line:
-            row = self._first_line
-            self._first_line = None
-        else:
-            row = self.reader.next()
-        for key, val in row.items():
-            if val is None: val = ""
-            row[key] = unicode(val, "utf-8")
-        return row
+        """ Returns a row of the configured type ({'DESCRIPTOR': value, ...}
+        by default) """
+        indexes = self.get_columns()[0]
+        values = self.reader.next()
+        while not values:
+            values = self.reader.next()
+        size = len(values)
+        encoding = self.encoding
+        return self._make_row([values[i].decode(encoding) if i < size else u"" for i in indexes])
 
     def current_sheet_name(self):
         return u"1"
 
 
 class XLSImportedFile(ImportedFile):
-    """ XLS reader based on xlrd (multiple sheets not yet implemented)"""
-    def __init__(self, datafile, sheet_index=0, skip_lines=None):
-        if not has_xlrd:
+    """ XLS reader based on xlrd
+
+    Worksheets are loaded on demand (for XLS files, xlrd always loads all of an
+    XLSX workbook) and released once all their rows have been read, so only
+    one of them is held in memory at a time. """
+    def __init__(self, datafile, sheet_index=0, skip_lines=None, row_type='dict'):
+        # http://www.lexicon.net/sjmachin/xlrd.html
+        self.xlrd = xlrd = optional_module('xlrd')
+        if xlrd is None:
             raise NotImplementedError("The xlrd library is not available")
-        super(XLSImportedFile, self).__init__(datafile, sheet_index, skip_lines)
+        super(XLSImportedFile, self).__init__(datafile, sheet_index, skip_lines, row_type)
         try:
-            self.book = xlrd.open_workbook(filename=self.file_path, file_contents=self.file_content)
+            self.book = xlrd.open_workbook(filename=self.file_path, file_contents=self.file_content, on_demand=True)
         except xlrd.XLRDError, e:
             logging.warn("XLS import error: %s" % str(e))
             raise UnsupportedFileFormat(_(u"Unable to read the file. Are you sure it is an XLS file?"))
-        self.data_sheet_indexes = [i for i, ws in enumerate(self.book.sheets()) if (ws.nrows > 0 and ws.ncols > 0)]
+        self.data_sheet_indexes = []
+        for i in range(self.book.nsheets):
+            ws = self.book.sheet_by_index(i)
+            if ws.nrows > 0 and ws.ncols > 0:
+                self.data_sheet_indexes.append(i)
+            if self.data_sheet_indexes[:1] != [i]:
+                self._unload_sheet(i)
+        self.current_index = None
         self.activate_sheet(self.data_sheet_indexes[0])
 
     def get_headers(self):
         if not self.current_index in self._headers:
-            self._headers[self.current_index] = []
-            self._ignored_headers_idx[self.current_index] = []
-            row = self.current_sheet.row(0)
-            for i, cell in enumerate(row):
-                self._headers[self.current_index].append(unicode(cell.value).strip())
+            self._headers[self.current_index] = [unicode(value).strip() for value in self.current_sheet.row_values(0)]
+            self._ignored_headers_idx[self.current_index] = set()
         return self._headers[self.current_index]
 
     def next(self):
-        """ Returns a SortedDict : {'DESCRIPTOR': value, ...} """
-        while self.skip_lines and self._row_index in self.skip_lines:
+        """ Returns a row of the configured type ({'DESCRIPTOR': value, ...}
+        by default) """
+        while self._row_index in self.skip_lines:
             self._row_index += 1
         if self._row_index >= self._nrows:
-            # Increment current_index and skip to next sheet, if any
-            new_index = self.data_sheet_indexes.index(self.current_index)+1
-            if new_index < len(self.book.sheets()):
-                self.activate_sheet(new_index)
+            # skip to next sheet, if any
+            position = self.data_sheet_indexes.index(self.current_index) + 1
+            if position < len(self.data_sheet_indexes):
+                self.activate_sheet(self.data_sheet_indexes[position])
                 return self.next()
             raise StopIteration
-        row_dict = SortedDict()
-        row = self.current_sheet.row(self._row_index)
-        headers = self.get_headers()
-        for i, cell in enumerate(row):
-            if i in self._ignored_headers_idx[self.current_index]:
-                continue
-            if cell.ctype == xlrd.XL_CELL_DATE:
-                value = datetime(*xlrd.xldate_as_tuple(cell.value, self.book.datemode))
-            else:
-                value = cell.value
-            row_dict[headers[i]] = value
+        sheet = self.current_sheet
+        values = sheet.row_values(self._row_index)
+        types = sheet.row_types(self._row_index)
         self._row_index += 1
-        return row_dict
+        date_type = self.xlrd.XL_CELL_DATE
+        row = []
+        for i in self.get_columns()[0]:
+            if types[i] == date_type:
+                row.append(datetime(*self.xlrd.xldate_as_tuple(values[i], self.book.datemode)))
+            else:
+                row.append(values[i])
+        return self._make_row(row)
 
     def activate_sheet(self, idx):
+        if self.current_index is not None and self.current_index != idx:
+            self._unload_sheet(self.current_index)
         super(XLSImportedFile, self).activate_sheet(idx)
         self.current_sheet = self.book.sheet_by_index(idx)
         self._nrows = self.current_sheet.nrows
         self._ncols = self.current_sheet.ncols
 
+    def _unload_sheet(self, idx):
+        # xlrd does not support loading XLSX sheets on demand
+        if self.book.on_demand:
+            self.book.unload_sheet(idx)
+
     def current_sheet_name(self):
-        return self.book.sheet_by_index(self.current_index).name
+        return self.current_sheet.name
 
 
 class ODSImportedFile(ImportedFile):
-    """ OO Calc reader based on ooolib (multiple sheets not yet implemented)"""
-    # FIXME: missing multi-sheet import
-    def __init__(self, datafile, sheet_index=0, skip_lines=None):
-        if not has_ooolib:
+    """ OO Calc reader based on ooolib """
+    def __init__(self, datafile, sheet_index=0, skip_lines=None, row_type='dict'):
+        ooolib = optional_module('ooolib')
+        if ooolib is None:
             raise NotImplementedError("The ooolib library is not available")
-        super(ODSImportedFile, self).__init__(datafile, sheet_index, skip_lines)
-        book = ooolib.Calc(opendoc=self.file_path)
-        book.set_sheet_index(sheet_index)
-        self.current_sheet = book
+        super(ODSImportedFile, self).__init__(datafile, sheet_index, skip_lines, row_type)
+        self.book = ooolib.Calc(opendoc=self.file_path)
+        self.data_sheet_indexes = []
+        for i in range(self.book.get_sheet_count()):
+            self.book.set_sheet_index(i)
+            ncols, nrows = self.book.get_sheet_dimensions()
+            if ncols > 0 and nrows > 0:
+                self.data_sheet_indexes.append(i)
+        if not self.data_sheet_indexes:
+            raise UnsupportedFileFormat(_(u"The file does not contain any data"))
+        self.activate_sheet(self.data_sheet_indexes[0])
+
+    def activate_sheet(self, idx):
+        super(ODSImportedFile, self).activate_sheet(idx)
+        self.book.set_sheet_index(idx)
+        self.current_sheet = self.book
         (self._ncols, self._nrows) = self.current_sheet.get_sheet_dimensions()
 
     def get_headers(self):
         if not self.current_index in self._headers:
             self._headers[self.current_index] = []
-            self._ignored_headers_idx[self.current_index] = []
+            self._ignored_headers_idx[self.current_index] = set()
             for i in range(self._ncols):
                 cell_value = self.current_sheet.get_cell_value(i+1, 1)
                 if cell_value:
@@ -292,20 +370,25 @@ class ODSImportedFile(ImportedFile):
         return self._headers[self.current_index]
 
     def next(self):
-        """ Returns a SortedDict : {'DESCRIPTOR': value, ...} """
+        """ Returns a row of the configured type ({'DESCRIPTOR': value, ...}
+        by default) """
         while self.skip_lines and self._row_index in self.skip_lines:
             self._row_index += 1
         if self._row_index >= self._nrows:
+            # skip to next sheet, if any
+            position = self.data_sheet_indexes.index(self.current_index) + 1
+            if position < len(self.data_sheet_indexes):
+                self.activate_sheet(self.data_sheet_indexes[position])
+                return self.next()
             raise StopIteration
-        row_dict = SortedDict()
-        for i in range(self._ncols):
+        row = []
+        for i in self.get_columns()[0]:
             cell_value = self.current_sheet.get_cell_value(i+1, self._row_index+1)
             if cell_value and cell_value[0] == 'formula' and cell_value[1]:
                 raise ValueError(_("The ODS file contains formula. Please convert them to raw values before importing the file."))
-            row_dict[self.get_headers()[i]] = cell_value and cell_value[1] or u""
+            row.append(cell_value and cell_value[1] or u"")
         self._row_index += 1
-        return row_dict
+        return self._make_row(row)
 
     def current_sheet_name(self):
-        return "??" # FIXME: self.current_sheet.title
-
+        return self.current_sheet.get_sheet_name()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the speed and memory use of the tabimport readers.
+
+Usage:
+    python -m tabimport.benchmark FILE.xls|FILE.xlsx|FILE.csv
+    python -m tabimport.benchmark --rows 200000 FILE.csv   (writes FILE first)
+
+Every reader runs in a process of its own so that its peak resident set size
+can be measured.  'legacy' reads the file the way tabimport did before the
+readers were made to stream (whole workbook loaded, a SortedDict built for
+each row from cell objects, CSV values decoded twice); for XLSX files it is
+also the only mode using xlrd.
+"""
+import csv
+import multiprocessing
+import random
+import resource
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+from django.utils.datastructures import SortedDict
+
+import tabimport
+
+
+MODES = ('legacy', 'dict', 'tuple', 'namedtuple')
+
+
+def legacy_rows(path):
+    """ Yields the rows of path as the previous readers built them """
+    if path.endswith('.csv'):
+        with open(path, 'rb') as f:
+            dialect = csv.Sniffer().sniff(f.read(2048))
+            f.seek(0)
+            lines = (line.decode('latin-1').encode('utf-8') for line in f)
+            for row in csv.DictReader(lines, dialect=dialect):
+                for key, val in row.items():
+                    row[key] = unicode(val or "", "utf-8")
+                yield row
+        return
+
+    import xlrd
+    book = xlrd.open_workbook(path)
+    for sheet in book.sheets():
+        if not (sheet.nrows and sheet.ncols):
+            continue
+        headers = [unicode(cell.value).strip() for cell in sheet.row(0)]
+        ignored = []
+        for index in range(1, sheet.nrows):
+            row_dict = SortedDict()
+            for i, cell in enumerate(sheet.row(index)):
+                if i in ignored:
+                    continue
+                if cell.ctype == xlrd.XL_CELL_DATE:
+                    value = datetime(*xlrd.xldate_as_tuple(cell.value, book.datemode))
+                else:
+                    value = cell.value
+                row_dict[headers[i]] = value
+            yield row_dict
+
+
+def _measure(path, mode, queue):
+    started = time.time()
+    if mode == 'legacy':
+        rows = legacy_rows(path)
+    else:
+        rows = tabimport.FileFactory(path, row_type=mode)
+    count = 0
+    for row in rows:
+        count += 1
+    elapsed = time.time() - started
+    # ru_maxrss is in kilobytes on Linux (bytes on OS X)
+    queue.put((count, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def measure(path, mode):
+    """ Returns the number of rows, the seconds and the peak RSS of reading
+    path in a new process with the given reader mode """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(path, mode, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def write_csv(path, rows, columns=20):
+    """ Writes a latin-1 CSV file of random facility-like rows """
+    random.seed(0)
+    with open(path, 'wb') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(['Colonne %d' % i for i in range(columns)])
+        for n in xrange(rows):
+            writer.writerow([(u'Site é %d' % random.randint(1, 10 ** 6)).encode('latin-1')] +
+                            [random.randint(0, 1000) for i in range(columns - 1)])
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] FILE')
+    parser.add_option('--rows', type='int', default=0,
+                      help='first write a synthetic CSV file of that many rows to FILE')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('A file is required')
+    path = args[0]
+    if options.rows:
+        if not path.endswith('.csv'):
+            parser.error('Only CSV files can be generated')
+        write_csv(path, options.rows)
+
+    print '%-12s %10s %10s %12s %12s' % ('reader', 'rows', 'seconds', 'rows/s', 'peak RSS kB')
+    for mode in MODES:
+        count, elapsed, maxrss = measure(path, mode)
+        print '%-12s %10d %10.2f %12.0f %12d' % (
+            mode, count, elapsed, count / elapsed if elapsed else 0, maxrss)
+
+
+if __name__ == '__main__':
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure()
+    main()
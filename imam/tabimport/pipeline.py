@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel import of tabular files.
+
+Every sheet of every file is read by a process of a pool, which parses and
+validates its rows with parse_row and sends them by batches to the calling
+process, the single writer, which stores them with write_batch:
+
+>>> def parse_row(row):
+>>>     return {'code': row['Code'], 'name': row['Name'].strip()}
+>>> results = run([path1, path2], parse_row, bulk_create_writer(Site))
+>>> print format_report(results)
+
+The batches go through a bounded queue: readers wait while it is full, so
+parsing never runs more than max_pending batches ahead of the writer and
+memory use does not depend on the size of the files.  A sheet whose reader
+dies (killed, or crashing the interpreter) is reported as aborted.
+
+parse_row runs in the worker processes and its return values are pickled, so
+it should return plain values (dicts of field values rather than model
+instances).  It rejects a row by raising ValueError or ValidationError, or
+skips it by returning None.
+"""
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing.queues import SimpleQueue
+from Queue import Empty
+
+from django.core.exceptions import ValidationError
+from django.db import connections, transaction
+
+from . import FileFactory, HeaderError, UnsupportedFileFormat
+
+DEFAULT_BATCH_SIZE = 500
+# error messages kept per sheet, the others are only counted
+MAX_ERRORS = 100
+
+
+class SheetResult(object):
+    """ Counters, timings and errors of the import of one sheet """
+
+    def __init__(self, filename, sheet):
+        self.filename = filename
+        self.sheet = sheet
+        self.name = None
+        self.rows = 0  # read
+        self.skipped = 0
+        self.rejected = 0  # by parse_row
+        self.written = 0
+        self.failed = 0  # rows of the batches write_batch failed on
+        self.errors = []  # (row number or None, message)
+        self.error_count = 0
+        self.parse_seconds = 0.0
+        self.started = time.time()
+        self.finished = None
+        self.aborted = False
+
+    def add_error(self, number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((number, message))
+
+    @property
+    def seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        """ Rows imported per second, from the start of the sheet until its
+        last batch was written """
+        return self.written / self.seconds if self.seconds else 0.0
+
+    def __unicode__(self):
+        return u"%s [%s]: %d rows read, %d written, %d rejected, %d failed, %d skipped in %.1fs (parsing %.1fs), %.0f rows/s%s" % (
+            self.filename, self.name or self.sheet, self.rows, self.written,
+            self.rejected, self.failed, self.skipped, self.seconds,
+            self.parse_seconds, self.rate, self.aborted and u" (aborted)" or u"")
+
+
+def bulk_create_writer(model, using=None):
+    """ Returns a write_batch function creating instances of model from dicts
+    of field values """
+    def write_batch(rows):
+        model.objects.using(using).bulk_create([model(**values) for values in rows])
+    return write_batch
+
+
+def format_report(results):
+    lines = []
+    for result in results:
+        lines.append(unicode(result))
+        for number, message in result.errors:
+            lines.append(u"    %s%s" % (number and u"row %d: " % number or u"", message))
+        if result.error_count > len(result.errors):
+            lines.append(u"    ... and %d more errors" % (result.error_count - len(result.errors)))
+    return u"\n".join(lines)
+
+
+# state of the worker processes, set by _init_worker
+_worker = {}
+
+
+def _init_worker(queue, started, parse_row, options):
+    _worker.update(queue=queue, started=started, parse_row=parse_row,
+                   options=options)
+
+
+def _parse_sheet(task):
+    """ Reads one sheet in a worker process, sending ('rows', key, rows)
+    messages for its batches and a final ('done', key, result) """
+    key, filename, path, sheet = task
+    # unlike the queue, which sends from a thread, SimpleQueue.put() has
+    # sent the message when it returns, even if the worker dies right after
+    _worker['started'].put((key, os.getpid()))
+    queue = _worker['queue']
+    parse_row = _worker['parse_row']
+    options = _worker['options']
+    result = SheetResult(filename, sheet)
+    batch = []
+
+    def flush():
+        started = time.time()
+        # blocks while the queue is full, until the writer catches up
+        queue.put(('rows', key, batch[:]))
+        result.parse_seconds -= time.time() - started
+        del batch[:]
+
+    started = time.time()
+    try:
+        reader = FileFactory(path, row_type=options['row_type'])
+        reader.only_sheet(sheet)
+        result.name = reader.current_sheet_name()
+        if options['possible_headers'] is not None:
+            reader.check_header_validity(options['possible_headers'],
+                                         options['mandatory_headers'])
+        for number, row in enumerate(reader, 1):
+            result.rows += 1
+            try:
+                values = parse_row(row)
+            except (ValueError, ValidationError), e:
+                result.rejected += 1
+                result.add_error(number, u"; ".join(getattr(e, 'messages', None) or [unicode(e)]))
+                continue
+            if values is None:
+                result.skipped += 1
+                continue
+            batch.append(values)
+            if len(batch) >= options['batch_size']:
+                flush()
+        if batch:
+            flush()
+    except (HeaderError, UnsupportedFileFormat, NotImplementedError), e:
+        result.aborted = True
+        result.add_error(None, unicode(e))
+    except Exception:
+        result.aborted = True
+        result.add_error(None, traceback.format_exc().decode('utf-8', 'replace'))
+    finally:
+        for connection in connections.all():
+            connection.close()
+    result.parse_seconds += time.time() - started
+    queue.put(('done', key, result))
+
+
+def _local_path(datafile):
+    """ Returns the path of datafile, a path or a django (Uploaded)File,
+    and whether it is a temporary copy to remove once imported """
+    if isinstance(datafile, basestring):
+        return datafile, False
+    try:
+        return datafile.temporary_file_path(), False
+    except AttributeError:
+        pass
+    fd, path = tempfile.mkstemp(suffix='.%s' % FileFactory._sniff_format(datafile))
+    with os.fdopen(fd, 'wb') as f:
+        for data in datafile.chunks():
+            f.write(data)
+    return path, True
+
+
+def run(datafiles, parse_row, write_batch, processes=None,
+        batch_size=DEFAULT_BATCH_SIZE, max_pending=None, row_type='dict',
+        possible_headers=None, mandatory_headers=(), using=None):
+    """ Imports all the data sheets of datafiles (paths or django
+    (Uploaded)Files) and returns a SheetResult for each of them.
+
+    Sheets are read by a pool of processes (one per CPU by default), at most
+    max_pending batches (twice the number of processes by default) waiting
+    for the writer.  write_batch(rows) is called in this process, in a
+    transaction on the database using, with up to batch_size values returned
+    by parse_row.  If
+    possible_headers is given, the headers of each sheet are checked with
+    check_header_validity first.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    options = {
+        'row_type': row_type,
+        'batch_size': batch_size,
+        'possible_headers': possible_headers,
+        'mandatory_headers': mandatory_headers,
+    }
+    temporary = []
+    results = OrderedDict()
+    try:
+        tasks = []
+        for datafile in datafiles:
+            path, is_temporary = _local_path(datafile)
+            if is_temporary:
+                temporary.append(path)
+            filename = getattr(datafile, 'name', path)
+            try:
+                sheets = FileFactory(path).data_sheet_indexes
+            except (UnsupportedFileFormat, NotImplementedError), e:
+                result = results[(filename, None)] = SheetResult(filename, None)
+                result.aborted = True
+                result.add_error(None, unicode(e))
+                result.finished = time.time()
+                continue
+            for sheet in sheets:
+                key = (filename, sheet)
+                results[key] = SheetResult(filename, sheet)
+                tasks.append((key, filename, path, sheet))
+
+        # the workers must not share the connection of this process
+        for connection in connections.all():
+            connection.close()
+        queue = multiprocessing.Queue(max_pending or 2 * processes)
+        started = SimpleQueue()
+        pool = multiprocessing.Pool(processes, _init_worker, (queue, started, parse_row, options))
+        lost = False
+        try:
+            parsing = pool.map_async(_parse_sheet, tasks, chunksize=1)
+            readers = {}  # sheet key -> pid of the worker reading it
+            pending = len(tasks)
+            while pending:
+                try:
+                    kind, key, payload = queue.get(timeout=1)
+                except Empty:
+                    if parsing.ready():
+                        # all the tasks returned, the sheets which did not
+                        # report are lost (a worker failed to pickle them)
+                        break
+                    for key in _dead_readers(started, readers):
+                        result = results[key]
+                        if result.finished is not None:
+                            continue
+                        result.aborted = True
+                        result.add_error(None, u"The process reading the sheet died")
+                        result.finished = time.time()
+                        pending -= 1
+                        # the pool never gets the result of the task of a
+                        # dead worker, so it has to be terminated
+                        lost = True
+                    continue
+                result = results[key]
+                if kind == 'rows':
+                    _write(result, write_batch, payload, using)
+                elif result.finished is None:
+                    _finish(result, payload)
+                    pending -= 1
+        except BaseException:
+            # the workers may be blocked on the full queue, which nobody
+            # reads any more
+            pool.terminate()
+            raise
+        else:
+            if lost:
+                pool.terminate()
+            else:
+                pool.close()
+        finally:
+            pool.join()
+    finally:
+        for path in temporary:
+            os.remove(path)
+    for result in results.values():
+        if result.finished is None:
+            result.aborted = True
+            result.add_error(None, u"The sheet was not entirely read")
+            result.finished = time.time()
+    return results.values()
+
+
+def _dead_readers(started, readers):
+    """ Updates readers with the sheets started since and returns the keys of
+    those whose worker is not running any more """
+    while not started.empty():
+        key, pid = started.get()
+        readers[key] = pid
+    running = set(process.pid for process in multiprocessing.active_children())
+    dead = [key for key, pid in readers.items() if pid not in running]
+    for key in dead:
+        del readers[key]
+    return dead
+
+
+def _write(result, write_batch, rows, using=None):
+    try:
+        with transaction.atomic(using=using):
+            write_batch(rows)
+    except Exception, e:
+        logging.exception("Import of %s failed" % result.filename)
+        result.failed += len(rows)
+        result.add_error(None, u"%d rows not imported: %s" % (len(rows), e))
+    else:
+        result.written += len(rows)
+
+
+def _finish(result, parsed):
+    """ Merges the counters of the worker into result """
+    for attr in ('name', 'rows', 'skipped', 'rejected', 'parse_seconds',
+                 'aborted', 'started'):
+        setattr(result, attr, getattr(parsed, attr))
+    for number, message in parsed.errors:
+        result.add_error(number, message)
+    result.error_count += parsed.error_count - len(parsed.errors)
+    result.finished = time.time()
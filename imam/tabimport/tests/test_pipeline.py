@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+import django.test
+
+from tabimport import pipeline
+from .test_readers import write_csv, write_xlsx
+
+
+def parse_row(row):
+    if row['Code'] == 'DIE':
+        # as if the worker was killed
+        os._exit(1)
+    if not row['Beds']:
+        return None
+    return {'code': row['Code'], 'beds': int(float(row['Beds']))}
+
+
+class Stop(BaseException):
+    pass
+
+
+class PipelineTest(django.test.TransactionTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.written = []
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write_batch(self, rows):
+        self.written.extend(rows)
+
+    def test_all_sheets_are_imported(self):
+        write_csv(self.path('sites.csv'), [u"Code;Beds", u"KN1;4", u"KN2;x",
+                                           u"KN3;", u"KN4;2", u"KN5;1"])
+        write_xlsx(self.path('sites.xlsx'), [
+            ('Kano', [['Code', 'Beds'], ['KN6', 3]]),
+            ('Kaduna', [['Code', 'Beds'], ['KD1', 5], ['KD2', 6]]),
+        ])
+        results = pipeline.run([self.path('sites.csv'), self.path('sites.xlsx')],
+                               parse_row, self.write_batch, processes=2,
+                               batch_size=2)
+
+        self.assertEqual(sorted(self.written),
+                         sorted([{'code': code, 'beds': beds} for code, beds in
+                                 [('KN1', 4), ('KN4', 2), ('KN5', 1),
+                                  ('KN6', 3), ('KD1', 5), ('KD2', 6)]]))
+        self.assertEqual([(result.name, result.rows, result.written,
+                           result.rejected, result.skipped, result.aborted)
+                          for result in results],
+                         [(u"1", 5, 3, 1, 1, False),
+                          (u"Kano", 1, 1, 0, 0, False),
+                          (u"Kaduna", 2, 2, 0, 0, False)])
+        self.assertEqual(results[0].errors[0][0], 2)
+
+    def test_unreadable_file_is_reported(self):
+        write_csv(self.path('sites.xlsx'), [u"Code;Beds", u"KN1;4"])
+        result, = pipeline.run([self.path('sites.xlsx')], parse_row,
+                               self.write_batch, processes=1)
+        self.assertTrue(result.aborted)
+        self.assertEqual(self.written, [])
+
+    def test_sheet_of_a_dead_worker_is_aborted(self):
+        write_xlsx(self.path('sites.xlsx'), [
+            ('Kaduna', [['Code', 'Beds'], ['DIE', 1], ['KD1', 5]]),
+            ('Kano', [['Code', 'Beds'], ['KN1', 4]]),
+            ('Katsina', [['Code', 'Beds'], ['KT1', 2]]),
+        ])
+        results = pipeline.run([self.path('sites.xlsx')], parse_row,
+                               self.write_batch, processes=1, batch_size=1)
+
+        self.assertEqual([(result.name, result.written, result.aborted)
+                          for result in results],
+                         [(None, 0, True), (u"Kano", 1, False),
+                          (u"Katsina", 1, False)])
+        self.assertEqual(results[0].errors,
+                         [(None, u"The process reading the sheet died")])
+
+    def test_workers_are_stopped_when_the_writer_fails(self):
+        write_csv(self.path('sites.csv'), [u"Code;Beds"] + [
+            u"KN%d;1" % i for i in range(1000)])
+
+        def write_batch(rows):
+            raise Stop()
+
+        # the worker is blocked on the full queue when the writer stops
+        with self.assertRaises(Stop):
+            pipeline.run([self.path('sites.csv')], parse_row, write_batch,
+                         processes=1, batch_size=1, max_pending=1)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from datetime import datetime
+
+import django.test
+
+from tabimport import (CSVImportedFile, FileFactory, HeaderError,
+                       UnsupportedFileFormat, optional_module)
+from tabimport.xlsx import XLSXImportedFile
+
+xlrd = optional_module('xlrd')
+xlwt = optional_module('xlwt')
+
+WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets>%s</sheets>
+</workbook>"""
+WORKBOOK_SHEET = '<sheet name="%s" sheetId="%d" r:id="rId%d"/>'
+RELATIONSHIPS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">%s</Relationships>"""
+RELATIONSHIP = '<Relationship Id="rId%d" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet%d.xml"/>'
+# cell style 1 is a date
+STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<cellXfs count="2"><xf numFmtId="0"/><xf numFmtId="14"/></cellXfs>
+</styleSheet>"""
+SHARED_STRINGS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">%s</sst>"""
+WORKSHEET = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>%s</sheetData></worksheet>"""
+
+
+def _column(index):
+    name = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = chr(65 + remainder) + name
+    return name
+
+
+def write_xlsx(path, sheets):
+    """ Writes an XLSX file with sheets, a list of (name, rows); strings are
+    shared, numbers are stored as such and datetimes as dates """
+    strings = []
+    with zipfile.ZipFile(path, 'w') as xlsx:
+        xlsx.writestr('xl/workbook.xml', WORKBOOK % ''.join(
+            WORKBOOK_SHEET % (name, i, i) for i, (name, rows) in enumerate(sheets, 1)))
+        xlsx.writestr('xl/_rels/workbook.xml.rels', RELATIONSHIPS % ''.join(
+            RELATIONSHIP % (i, i) for i in range(1, len(sheets) + 1)))
+        xlsx.writestr('xl/styles.xml', STYLES)
+        for i, (name, rows) in enumerate(sheets, 1):
+            xml_rows = []
+            for number, row in enumerate(rows, 1):
+                cells = []
+                for column, value in enumerate(row):
+                    reference = '%s%d' % (_column(column), number)
+                    if value is None:
+                        continue
+                    if isinstance(value, datetime):
+                        serial = (value - datetime(1899, 12, 30)).days
+                        cells.append('<c r="%s" s="1"><v>%d</v></c>' % (reference, serial))
+                    elif isinstance(value, basestring):
+                        strings.append(value)
+                        cells.append('<c r="%s" t="s"><v>%d</v></c>' % (reference, len(strings) - 1))
+                    else:
+                        cells.append('<c r="%s"><v>%s</v></c>' % (reference, value))
+                xml_rows.append('<row r="%d">%s</row>' % (number, ''.join(cells)))
+            xlsx.writestr('xl/worksheets/sheet%d.xml' % i,
+                          WORKSHEET % ''.join(xml_rows))
+        xlsx.writestr('xl/sharedStrings.xml', (SHARED_STRINGS % ''.join(
+            u'<si><t>%s</t></si>' % value for value in strings)).encode('utf-8'))
+
+
+def write_csv(path, lines, encoding='latin-1'):
+    with open(path, 'wb') as f:
+        f.write(u"\r\n".join(lines).encode(encoding) + "\r\n")
+
+
+class ReaderTest(django.test.SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+class CSVReaderTest(ReaderTest):
+    def test_rows_are_dicts_of_decoded_values(self):
+        write_csv(self.path('sites.csv'), [u"Code;Name", u"KN1;Kanó", u"", u"KN2;Gwale"])
+        reader = FileFactory(self.path('sites.csv'))
+        self.assertIsInstance(reader, CSVImportedFile)
+        self.assertEqual(reader.delimiter, ';')
+        self.assertEqual([dict(row) for row in reader],
+                         [{u'Code': u'KN1', u'Name': u'Kanó'},
+                          {u'Code': u'KN2', u'Name': u'Gwale'}])
+
+    def test_tuple_rows(self):
+        write_csv(self.path('sites.csv'), [u"Code,Name", u"KN1,Kano", u"KN2,"])
+        reader = FileFactory(self.path('sites.csv'), row_type='tuple')
+        self.assertEqual(list(reader), [(u'KN1', u'Kano'), (u'KN2', u'')])
+
+    def test_unknown_headers_are_ignored(self):
+        write_csv(self.path('sites.csv'), [u"Code,Notes,Name", u"KN1,x,Kano"])
+        reader = FileFactory(self.path('sites.csv'))
+        warnings = reader.check_header_validity(['Code', 'Name'], ['Code'])
+        self.assertEqual(warnings, [(u"1", u"Notes", u"Unknown header")])
+        self.assertEqual([dict(row) for row in reader],
+                         [{u'Code': u'KN1', u'Name': u'Kano'}])
+
+    def test_missing_mandatory_header(self):
+        write_csv(self.path('sites.csv'), [u"Name", u"Kano"])
+        reader = FileFactory(self.path('sites.csv'))
+        with self.assertRaises(HeaderError):
+            reader.check_header_validity(['Code', 'Name'], ['Code'])
+
+    def test_unknown_format(self):
+        with self.assertRaises(UnsupportedFileFormat):
+            FileFactory(self.path('sites.txt'))
+
+
+class XLSXReaderTest(ReaderTest):
+    def setUp(self):
+        super(XLSXReaderTest, self).setUp()
+        write_xlsx(self.path('sites.xlsx'), [
+            ('Sites', [
+                ['Code', 'Name', 'Opened', 'Beds'],
+                ['KN1', u'Kanó', datetime(2014, 3, 1), 12],
+                ['KN2', None, None, 4],
+            ]),
+            ('Empty', []),
+            ('More sites', [
+                ['Code', 'Name'],
+                ['KD1', 'Kaduna'],
+            ]),
+        ])
+
+    def test_rows_of_all_data_sheets(self):
+        reader = FileFactory(self.path('sites.xlsx'))
+        self.assertIsInstance(reader, XLSXImportedFile)
+        self.assertEqual(reader.data_sheet_indexes, [0, 2])
+        self.assertEqual(reader.current_sheet_name(), u'Sites')
+        self.assertEqual([dict(row) for row in reader], [
+            {u'Code': u'KN1', u'Name': u'Kanó',
+             u'Opened': datetime(2014, 3, 1), u'Beds': 12.0},
+            {u'Code': u'KN2', u'Name': u'', u'Opened': u'', u'Beds': 4.0},
+            {u'Code': u'KD1', u'Name': u'Kaduna'},
+        ])
+
+    def test_only_sheet(self):
+        reader = FileFactory(self.path('sites.xlsx'), row_type='tuple')
+        reader.only_sheet(2)
+        self.assertEqual(reader.current_sheet_name(), u'More sites')
+        self.assertEqual(list(reader), [(u'KD1', u'Kaduna')])
+
+    def test_not_an_xlsx_file(self):
+        write_csv(self.path('sites.xlsx'), [u"Code", u"KN1"])
+        with self.assertRaises(UnsupportedFileFormat):
+            FileFactory(self.path('sites.xlsx'))
+
+
+@unittest.skipUnless(xlrd and xlwt, "xlrd and xlwt are needed for XLS files")
+class XLSReaderTest(ReaderTest):
+    def setUp(self):
+        super(XLSReaderTest, self).setUp()
+        book = xlwt.Workbook()
+        sheet = book.add_sheet('Sites')
+        date_style = xlwt.easyxf(num_format_str='YYYY-MM-DD')
+        for column, value in enumerate(['Code', 'Name', 'Opened']):
+            sheet.write(0, column, value)
+        sheet.write(1, 0, 'KN1')
+        sheet.write(1, 1, u'Kanó')
+        sheet.write(1, 2, datetime(2014, 3, 1), date_style)
+        book.add_sheet('Empty')
+        sheet = book.add_sheet('More sites')
+        sheet.write(0, 0, 'Code')
+        sheet.write(1, 0, 'KD1')
+        book.save(self.path('sites.xls'))
+
+    def test_rows_of_all_data_sheets(self):
+        reader = FileFactory(self.path('sites.xls'))
+        self.assertEqual(reader.data_sheet_indexes, [0, 2])
+        self.assertEqual([dict(row) for row in reader], [
+            {u'Code': u'KN1', u'Name': u'Kanó',
+             u'Opened': datetime(2014, 3, 1)},
+            {u'Code': u'KD1'},
+        ])
+
+    def test_only_sheet(self):
+        reader = FileFactory(self.path('sites.xls'), row_type='tuple')
+        reader.only_sheet(2)
+        self.assertEqual(reader.current_sheet_name(), u'More sites')
+        self.assertEqual(list(reader), [(u'KD1',)])
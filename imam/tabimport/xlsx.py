@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+XLSX reader parsing the worksheets incrementally (with iterparse) straight
+from the zip container, so that memory use does not depend on the size of the
+sheets.  Only the shared strings table and the list of date styles of the
+workbook are kept in memory.
+"""
+import posixpath
+import re
+import zipfile
+from datetime import datetime, timedelta
+from io import BytesIO
+from xml.etree import cElementTree as ElementTree
+
+from django.utils.translation import ugettext as _
+
+from . import ImportedFile, UnsupportedFileFormat
+
+# built-in number formats which are dates or times (as in xlrd)
+DATE_FORMAT_IDS = set(range(14, 23) + range(27, 37) + range(45, 48) + range(50, 59))
+
+_date_format_noise = re.compile(r'"[^"]*"|\\.|\[[^\]]*\]|_.|\*.')
+_date_format_chars = re.compile(r'[dmyhs]', re.IGNORECASE)
+
+
+def _local(tag):
+    """ Tag name without its namespace """
+    return tag.rsplit('}', 1)[-1]
+
+
+def _attribute(element, name):
+    """ Value of the attribute name, whatever its namespace """
+    for key, value in element.attrib.items():
+        if _local(key) == name:
+            return value
+    return None
+
+
+def _column_index(reference):
+    """ 'A1' -> 0, 'AB12' -> 27 """
+    index = 0
+    for char in reference:
+        if 'A' <= char <= 'Z':
+            index = index * 26 + ord(char) - 64
+        else:
+            break
+    return index - 1
+
+
+def _text(element):
+    """ Text of a shared or inline string, concatenating rich text runs and
+    leaving out phonetic runs """
+    parts = []
+    for child in element:
+        tag = _local(child.tag)
+        if tag == 't':
+            parts.append(child.text or u"")
+        elif tag == 'r':
+            parts.extend(t.text or u"" for t in child if _local(t.tag) == 't')
+    return u"".join(parts)
+
+
+class XLSXImportedFile(ImportedFile):
+    """ XLSX reader based on the standard library only """
+
+    def __init__(self, datafile, sheet_index=0, skip_lines=None, row_type='dict'):
+        super(XLSXImportedFile, self).__init__(datafile, sheet_index, skip_lines, row_type)
+        try:
+            self.zip = zipfile.ZipFile(self.file_path or BytesIO(self.file_content))
+            self._sheets = self._read_workbook()
+            self._date_styles = self._read_date_styles()
+        except (zipfile.BadZipfile, KeyError, SyntaxError):
+            raise UnsupportedFileFormat(_(u"Unable to read the file. Are you sure it is an XLSX file?"))
+        self._shared_strings = None
+        self.data_sheet_indexes = [i for i in range(len(self._sheets)) if self._has_rows(i)]
+        if not self.data_sheet_indexes:
+            raise UnsupportedFileFormat(_(u"The file does not contain any data"))
+        self._rows = None
+        self.activate_sheet(self.data_sheet_indexes[0])
+
+    def _read_workbook(self):
+        """ Returns the list of (name, path in the zip) of the sheets """
+        targets = {}
+        for rel in ElementTree.fromstring(self.zip.read('xl/_rels/workbook.xml.rels')):
+            target = rel.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join('xl', target))
+            targets[rel.get('Id')] = target
+        workbook = ElementTree.fromstring(self.zip.read('xl/workbook.xml'))
+        self.date1904 = False
+        sheets = []
+        for element in workbook.iter():
+            tag = _local(element.tag)
+            if tag == 'workbookPr':
+                self.date1904 = element.get('date1904') in ('1', 'true')
+            elif tag == 'sheet':
+                sheets.append((element.get('name'), targets[_attribute(element, 'id')]))
+        return sheets
+
+    def _read_date_styles(self):
+        """ Returns the set of the indexes of the cell styles which format
+        numbers as dates """
+        try:
+            styles = ElementTree.fromstring(self.zip.read('xl/styles.xml'))
+        except KeyError:
+            return set()
+        date_formats = set(DATE_FORMAT_IDS)
+        cell_formats = []
+        for element in styles:
+            tag = _local(element.tag)
+            if tag == 'numFmts':
+                for fmt in element:
+                    code = _date_format_noise.sub('', fmt.get('formatCode', ''))
+                    if _date_format_chars.search(code):
+                        date_formats.add(int(fmt.get('numFmtId')))
+            elif tag == 'cellXfs':
+                cell_formats = [int(xf.get('numFmtId', 0)) for xf in element]
+        return set(i for i, fmt_id in enumerate(cell_formats) if fmt_id in date_formats)
+
+    @property
+    def shared_strings(self):
+        if self._shared_strings is None:
+            self._shared_strings = []
+            try:
+                source = self.zip.open('xl/sharedStrings.xml')
+            except KeyError:
+                return self._shared_strings
+            for event, element in ElementTree.iterparse(source):
+                if _local(element.tag) == 'si':
+                    self._shared_strings.append(_text(element))
+                    element.clear()
+            source.close()
+        return self._shared_strings
+
+    def _iter_rows(self, idx):
+        """ Yields (row index, list of values) for the rows of sheet idx """
+        source = self.zip.open(self._sheets[idx][1])
+        try:
+            sheet_data = None
+            for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+                tag = _local(element.tag)
+                if event == 'start':
+                    if tag == 'sheetData':
+                        sheet_data = element
+                    continue
+                if tag != 'row':
+                    continue
+                index = int(element.get('r', 0)) - 1
+                values = []
+                for cell in element:
+                    if _local(cell.tag) != 'c':
+                        continue
+                    reference = cell.get('r')
+                    if reference:
+                        column = _column_index(reference)
+                        if column > len(values):
+                            values.extend([u""] * (column - len(values)))
+                    values.append(self._cell_value(cell))
+                # drop the rows parsed so far, so that memory stays flat
+                if sheet_data is not None:
+                    sheet_data.clear()
+                yield index, values
+        finally:
+            source.close()
+
+    def _cell_value(self, cell):
+        cell_type = cell.get('t', 'n')
+        value = None
+        for child in cell:
+            tag = _local(child.tag)
+            if tag == 'v':
+                value = child.text
+            elif tag == 'is':
+                return _text(child)
+        if value is None:
+            return u""
+        if cell_type == 's':
+            return self.shared_strings[int(value)]
+        if cell_type == 'n':
+            number = float(value)
+            if int(cell.get('s', 0)) in self._date_styles:
+                return self._to_datetime(number)
+            return number
+        if cell_type == 'b':
+            return int(value)
+        return value
+
+    def _to_datetime(self, number):
+        epoch = datetime(1904, 1, 1) if self.date1904 else datetime(1899, 12, 30)
+        return epoch + timedelta(seconds=round(number * 86400))
+
+    def _has_rows(self, idx):
+        rows = self._iter_rows(idx)
+        try:
+            next(rows)
+        except StopIteration:
+            return False
+        rows.close()
+        return True
+
+    def activate_sheet(self, idx):
+        super(XLSXImportedFile, self).activate_sheet(idx)
+        if self._rows is not None:
+            self._rows.close()
+        self._rows = self._iter_rows(idx)
+        self._pending = next(self._rows, None)
+        if self._pending is not None and self._pending[0] <= 0:
+            # the first line holds the headers
+            self._header_values = self._pending[1]
+            self._pending = None
+        else:
+            self._header_values = []
+
+    def get_headers(self):
+        if not self.current_index in self._headers:
+            self._headers[self.current_index] = [unicode(value).strip() for value in self._header_values]
+            self._ignored_headers_idx[self.current_index] = set()
+        return self._headers[self.current_index]
+
+    def next(self):
+        """ Returns a row of the configured type ({'DESCRIPTOR': value, ...}
+        by default) """
+        while True:
+            if self._pending is not None:
+                index, values = self._pending
+                self._pending = None
+            else:
+                try:
+                    index, values = next(self._rows)
+                except StopIteration:
+                    # skip to next sheet, if any
+                    position = self.data_sheet_indexes.index(self.current_index) + 1
+                    if position >= len(self.data_sheet_indexes):
+                        raise
+                    self.activate_sheet(self.data_sheet_indexes[position])
+                    continue
+            if index not in self.skip_lines:
+                break
+        size = len(values)
+        return self._make_row([values[i] if i < size else u"" for i in self.get_columns()[0]])
+
+    def current_sheet_name(self):
+        return self._sheets[self.current_index][0]
@@ -5,11 +5,11 @@ __author__ = 'www.grillazz.com'
 from .models import PdfForms
 from django.contrib import admin
 from django.contrib.admin import site
-import adminactions.actions as actions
+from core.lazy import lazy_action
 
-# register all adminactions
-site.add_action(actions.export_as_fixture)
-site.add_action(actions.export_as_csv)
+# register all adminactions (imported when first used)
+site.add_action(lazy_action('adminactions.actions', 'export_as_fixture'))
+site.add_action(lazy_action('adminactions.actions', 'export_as_csv'))
 
 class pdfFormsAdmin(admin.ModelAdmin, ):
     list_display = ('formName',)
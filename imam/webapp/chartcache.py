@@ -0,0 +1,96 @@
+"""Cache of the JSON served by DashboardChartDataView.
+
+Entries are keyed on the (year, location, program) the chart was drawn for and
+are dropped whenever a program report which may appear in them is saved or
+deleted.  When reports are loaded in bulk (without signals) all the entries
+are dropped at once by clear(), which changes the generation that is part of
+every key, as the cache backends cannot delete keys by prefix.  Each entry also carries an ETag and the time it was computed so that
+browsers can revalidate instead of downloading the series again.
+"""
+from __future__ import unicode_literals
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from core.utils import iso_week_ends
+from locations.models import Location
+
+
+DEFAULT_TIMEOUT = 3600  # seconds
+GENERATION_KEY = 'dashboard-chart-generation'
+
+
+def _cache():
+    return caches[getattr(settings, 'DASHBOARD_CHART_CACHE', 'default')]
+
+
+def _generation():
+    cache = _cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # a random one, so that the entries of a generation which was
+        # evicted are not used again
+        cache.add(GENERATION_KEY, uuid.uuid4().hex, None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def make_key(year, location_id, program_id, generation=None):
+    """program_id is None (or 0) for the chart of all programs."""
+    return 'dashboard-chart:{}:{}:{}:{}'.format(
+        generation or _generation(), year, location_id, program_id or 0)
+
+
+def get(year, location_id, program_id):
+    """Returns the cached entry, a dict with the keys body, etag and
+    last_modified, or None."""
+    return _cache().get(make_key(year, location_id, program_id))
+
+
+def store(year, location_id, program_id, body):
+    """Caches body (the JSON text of the chart data) and returns the entry."""
+    entry = {
+        'body': body,
+        'etag': hashlib.md5(body.encode('utf-8')).hexdigest(),
+        'last_modified': time.time(),
+    }
+    _cache().set(make_key(year, location_id, program_id), entry,
+                 getattr(settings, 'DASHBOARD_CHART_CACHE_TIMEOUT',
+                         DEFAULT_TIMEOUT))
+    return entry
+
+
+def chart_years(report_date):
+    """Returns the years whose chart includes report_date.  The chart of a
+    year runs from the end of week 52 of the year before it to the end of its
+    own week 52."""
+    return [year for year in (report_date.year - 1, report_date.year,
+                              report_date.year + 1)
+            if iso_week_ends(52, year - 1) <= report_date <=
+            iso_week_ends(52, year)]
+
+
+def invalidate(site_id, program_id, report_date):
+    """Drop the entries which a report of the given site and program for
+    report_date may appear in, i.e. those of the site and its ancestors, for
+    that program and for all programs."""
+    site = Location.objects.filter(pk=site_id).first()
+    if site is None:
+        return
+    location_ids = site.get_ancestors(include_self=True).values_list(
+        'pk', flat=True)
+    generation = _generation()
+    _cache().delete_many([
+        make_key(year, location_id, chart_program_id, generation)
+        for year in chart_years(report_date)
+        for location_id in location_ids
+        for chart_program_id in (program_id, None)
+    ])
+
+
+def clear():
+    """Drop all the entries (they expire with the timeout)."""
+    _cache().set(GENERATION_KEY, uuid.uuid4().hex, None)
@@ -1,8 +1,12 @@
 from __future__ import unicode_literals
 from datetime import date
+import threading
+import time
 
 from django import forms
+from django.conf import settings
 from django.db.models import Max, Min
+from django.db.models.signals import post_delete, post_save
 import django_filters
 from django.utils.translation import ugettext as _
 
@@ -12,27 +16,76 @@ from locations.models import Location
 from core.utils import iso_normalize
 
 
-CATEGORY_CHOICES = list(
-    ProgramCategory.objects.all().values_list('pk', 'acronym'))
-POSITION_CHOICES = list(Position.objects.all().values_list('pk', 'description'))
-PROGRAM_CHOICES = list(Program.objects.all().values_list(
-    'pk', 'code'))  # exclude(code='SFP').values_list('pk', 'code'))
-try:
-    MAX_DATE = ProgramReport.objects.aggregate(Max('report_date')).values()[0]
-except Exception:  # todo: this exception clause is too broad
-    MAX_DATE = iso_normalize(date.today())
-if MAX_DATE is None:
-    MAX_DATE = iso_normalize(date.today())
-try:
-    MIN_DATE = ProgramReport.objects.aggregate(Min('report_date')).values()[0]
-except Exception:  # todo: this exception clause is too broad
-    MIN_DATE = iso_normalize(date.today())
-if MIN_DATE is None:
-    MIN_DATE = iso_normalize(date.today())
-
-YEAR_CHOICES = [
-    (year, str(year)) for year in xrange(MAX_DATE.year, MIN_DATE.year - 1, -1)
-]
+class CachedValue(object):
+    """A value computed on first use and then reused until it is older than
+    ttl seconds or until an instance of one of the given models is saved or
+    deleted.  Nothing is computed at import time.
+    """
+
+    def __init__(self, compute, models=(), ttl=None):
+        self.compute = compute
+        self.ttl = ttl if ttl is not None else getattr(
+            settings, 'FILTER_CHOICES_TTL', 300)
+        self._value = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        for model in models:
+            uid = 'filter-choices-{}-{}'.format(id(self), model.__name__)
+            post_save.connect(self.invalidate, sender=model,
+                              dispatch_uid=uid + '-save', weak=False)
+            post_delete.connect(self.invalidate, sender=model,
+                                dispatch_uid=uid + '-delete', weak=False)
+
+    def get(self):
+        with self._lock:
+            if time.time() >= self._expires:
+                self._value = self.compute()
+                self._expires = time.time() + self.ttl
+            return self._value
+
+    def invalidate(self, **kwargs):
+        with self._lock:
+            self._expires = 0
+
+
+def _report_date_range():
+    try:
+        dates = ProgramReport.objects.aggregate(Min('report_date'),
+                                                Max('report_date'))
+    except Exception:  # todo: this exception clause is too broad
+        dates = {}
+    today = iso_normalize(date.today())
+    return (dates.get('report_date__min') or today,
+            dates.get('report_date__max') or today)
+
+
+category_choices = CachedValue(
+    lambda: list(ProgramCategory.objects.values_list('pk', 'acronym')),
+    models=(ProgramCategory,))
+position_choices = CachedValue(
+    lambda: list(Position.objects.values_list('pk', 'description')),
+    models=(Position,))
+# exclude(code='SFP').values_list('pk', 'code'))
+program_choices = CachedValue(
+    lambda: list(Program.objects.values_list('pk', 'code')),
+    models=(Program,))
+report_date_range = CachedValue(_report_date_range, models=(ProgramReport,))
+
+
+def get_min_date():
+    return report_date_range.get()[0]
+
+
+def get_max_date():
+    return report_date_range.get()[1]
+
+
+def get_year_choices():
+    min_date, max_date = report_date_range.get()
+    return [
+        (year, str(year)) for year in xrange(max_date.year, min_date.year - 1,
+                                             -1)
+    ]
 
 
 def make_period_choices():
@@ -40,6 +93,21 @@ def make_period_choices():
             range(1, 54)]
 
 
+class LazyChoiceFilter(django_filters.ChoiceFilter):
+    """ChoiceFilter which gets its choices from get_choices() whenever its form
+    field is created (i.e. for each filter set) rather than when it is
+    defined."""
+
+    def get_choices(self):
+        raise NotImplementedError
+
+    @property
+    def field(self):
+        if not hasattr(self, '_field'):
+            self.extra['choices'] = self.get_choices()
+        return super(LazyChoiceFilter, self).field
+
+
 class LocationChoiceFilter(django_filters.ChoiceFilter):
     def __init__(self, *args, **kwargs):
         super(LocationChoiceFilter, self).__init__(*args, **kwargs)
@@ -85,10 +153,9 @@ class PersonnelLocationChoiceFilter(LocationChoiceFilter):
         return qs
 
 
-class PositionChoiceFilter(django_filters.ChoiceFilter):
-    def __init__(self, *args, **kwargs):
-        kwargs['choices'] = [('', '')] + POSITION_CHOICES
-        super(PositionChoiceFilter, self).__init__(*args, **kwargs)
+class PositionChoiceFilter(LazyChoiceFilter):
+    def get_choices(self):
+        return [('', '')] + position_choices.get()
 
     def filter(self, qs, value):
         if value:
@@ -102,10 +169,9 @@ class PositionChoiceFilter(django_filters.ChoiceFilter):
         return qs
 
 
-class CategoryChoiceFilter(django_filters.ChoiceFilter):
-    def __init__(self, *args, **kwargs):
-        kwargs['choices'] = [('', '')] + CATEGORY_CHOICES
-        super(CategoryChoiceFilter, self).__init__(*args, **kwargs)
+class CategoryChoiceFilter(LazyChoiceFilter):
+    def get_choices(self):
+        return [('', '')] + category_choices.get()
 
     def filter(self, qs, value):
         if value:
@@ -125,10 +191,9 @@ class PeriodChoiceFilter(django_filters.ChoiceFilter):
         super(PeriodChoiceFilter, self).__init__(*args, **kwargs)
 
 
-class ProgramChoiceFilter(django_filters.ChoiceFilter):
-    def __init__(self, *args, **kwargs):
-        kwargs['choices'] = [('0', _('All'))] + PROGRAM_CHOICES
-        super(ProgramChoiceFilter, self).__init__(*args, **kwargs)
+class ProgramChoiceFilter(LazyChoiceFilter):
+    def get_choices(self):
+        return [('0', _('All'))] + program_choices.get()
 
     def filter(self, qs, value):
         if value:
@@ -137,13 +202,16 @@ class ProgramChoiceFilter(django_filters.ChoiceFilter):
         return qs
 
 
-class YearChoiceFilter(django_filters.ChoiceFilter):
+class YearChoiceFilter(LazyChoiceFilter):
     def __init__(self, *args, **kwargs):
-        kwargs['choices'] = YEAR_CHOICES
-        if 'initial' not in kwargs:
-            kwargs['initial'] = MAX_DATE.year
+        self.default_initial = 'initial' not in kwargs
         super(YearChoiceFilter, self).__init__(*args, **kwargs)
 
+    def get_choices(self):
+        if self.default_initial:
+            self.extra['initial'] = get_max_date().year
+        return get_year_choices()
+
     def filter(self, qs, value):
         if value:
             return qs.filter(created__year=value)
@@ -5,6 +5,11 @@ __author__ = 'www.grillazz.com'
 
 from django.db import models
 
+from core.models import ProgramReport
+from core.signals import weekly_totals_rebuilt
+from core.utils import on_commit
+from . import chartcache
+
 # Create your models here.
 
 
@@ -22,3 +27,35 @@ class PdfForms(models.Model):
 
         # def get_absolute_url(self):
         #    return reverse("pdf_url", kwargs={"slug": self.slug})
+
+
+def _program_report_changed(sender, instance, **kwargs):
+    # once committed, or a chart computed meanwhile would be cached without
+    # the change
+    changes = [(instance.site_id, instance.program_id, instance.report_date)]
+    # the week the report was in before being moved (see locations.models)
+    previous = getattr(instance, '_weekly_total_key', None)
+    if previous:
+        site_id, program_id, group_id, report_date = previous
+        changes.append((site_id, program_id, report_date))
+
+    def invalidate():
+        for change in changes:
+            chartcache.invalidate(*change)
+    on_commit(invalidate)
+
+
+def _weekly_totals_rebuilt(sender, **kwargs):
+    # after reports were loaded in bulk (without post_save) or locations
+    # were moved
+    on_commit(chartcache.clear)
+
+
+models.signals.post_save.connect(_program_report_changed,
+                                 sender=ProgramReport,
+                                 dispatch_uid='dashboard-chart-report-saved')
+models.signals.post_delete.connect(_program_report_changed,
+                                   sender=ProgramReport,
+                                   dispatch_uid='dashboard-chart-report-deleted')
+weekly_totals_rebuilt.connect(_weekly_totals_rebuilt,
+                              dispatch_uid='dashboard-chart-totals-rebuilt')
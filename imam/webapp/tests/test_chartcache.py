@@ -0,0 +1,111 @@
+from __future__ import unicode_literals
+import datetime
+
+from model_mommy import mommy
+
+import django.core.cache
+import django.db
+import django.test
+import django.test.utils
+
+import core.models
+import locations.models
+import webapp.chartcache
+import webapp.views
+
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chart-test',
+    },
+}
+
+
+@django.test.utils.override_settings(CACHES=CACHES)
+class ChartCacheInvalidationTest(django.test.TransactionTestCase):
+    def setUp(self):
+        django.core.cache.caches['default'].clear()
+        site_type = mommy.make(locations.models.LocationType, code='adm6')
+        self.root = mommy.make(locations.models.Location)
+        self.site = mommy.make(locations.models.Location, loc_type=site_type,
+                               parent=self.root)
+        self.program = mommy.make(core.models.Program)
+        self.report_date = datetime.date(2014, 3, 9)
+        for location in (self.root, self.site):
+            webapp.chartcache.store(2014, location.pk, None, '{}')
+
+    def cached(self):
+        return [webapp.chartcache.get(2014, location.pk, None) is not None
+                for location in (self.root, self.site)]
+
+    def make_report(self):
+        return mommy.make(core.models.ProgramReport, site=self.site,
+                          program=self.program, report_date=self.report_date)
+
+    def test_saved_report_invalidates_charts_once_committed(self):
+        with django.db.transaction.atomic():
+            self.make_report()
+            self.assertEqual(self.cached(), [True, True])
+        self.assertEqual(self.cached(), [False, False])
+
+    def test_rolled_back_report_leaves_charts_cached(self):
+        try:
+            with django.db.transaction.atomic():
+                self.make_report()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.cached(), [True, True])
+
+    def test_other_years_are_left_cached(self):
+        webapp.chartcache.store(2012, self.root.pk, None, '{}')
+        self.make_report()
+        self.assertIsNotNone(webapp.chartcache.get(2012, self.root.pk, None))
+
+    def test_rebuilt_totals_clear_every_chart(self):
+        webapp.chartcache.store(2012, self.root.pk, self.program.pk, '{}')
+
+        with django.db.transaction.atomic():
+            locations.models.WeeklyProgramTotal.rebuild()
+            self.assertEqual(self.cached(), [True, True])
+        self.assertEqual(self.cached(), [False, False])
+        self.assertIsNone(webapp.chartcache.get(2012, self.root.pk,
+                                                self.program.pk))
+
+
+@django.test.utils.override_settings(CACHES=CACHES)
+class DashboardChartDataViewTest(django.test.TestCase):
+    def setUp(self):
+        django.core.cache.caches['default'].clear()
+        self.location = mommy.make(locations.models.Location)
+        self.factory = django.test.RequestFactory()
+        self.view = webapp.views.DashboardChartDataView.as_view()
+
+    def get(self, **headers):
+        request = self.factory.get('/chart-data/', **headers)
+        request.session = {'filter_data': {'year': 2014,
+                                           'location': self.location.pk}}
+        return self.view(request)
+
+    def test_response_carries_etag(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        entry = webapp.chartcache.get(2014, self.location.pk, None)
+        self.assertEqual(response['ETag'], '"{}"'.format(entry['etag']))
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.get()['ETag']
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_other_etag_gets_the_data(self):
+        self.get()
+        response = self.get(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_cached_entry_is_served_without_queries(self):
+        self.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get().status_code, 200)
@@ -1,16 +1,22 @@
 from __future__ import unicode_literals
 from datetime import date, timedelta, datetime, time
+import json
 import dateutil.parser
 
 from django.contrib.auth import REDIRECT_FIELD_NAME, login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.urlresolvers import reverse_lazy
-from django.http import HttpResponseRedirect, JsonResponse
+from django.db.models import Sum
+from django.http import HttpResponse, HttpResponseNotModified, \
+    HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.utils.decorators import method_decorator
-from django.utils.http import is_safe_url
+from django.utils.http import http_date, is_safe_url, parse_etags, \
+    parse_http_date_safe, quote_etag
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import DetailView, ListView, UpdateView, View, \
     TemplateView
@@ -18,19 +24,21 @@ from rapidsms.contrib.messagelog.models import Message
 import reversion
 from django.conf import settings
 
-from locations.models import Location, LocationType
+from locations.models import Location, LocationSiteCount, LocationType, \
+    WeeklyProgramTotal
 from core.models import PatientGroup, Personnel, Program, ProgramReport, \
     StockOutReport, StockReport
+from webapp import chartcache
 from webapp.models import PdfForms
 from .filters import PersonnelFilterSet, ProgramReportFilterSet, \
-    SiteFilterSet, StockOutReportFilterSet, StockReportFilterSet
+    SiteFilterSet, StockOutReportFilterSet, StockReportFilterSet, \
+    get_max_date
 from .forms import ProgramReportForm
 from .form_helpers import make_personnel_filter_form_helper, \
     make_program_report_filter_form_helper, \
     make_site_filter_form_helper, make_stock_filter_form_helper
 from form_helpers import make_base_program_report_filter_form_helper
-from core.utils import iso_normalize, iso_week_ends, Totalizer
-from filters import MAX_DATE
+from core.utils import iso_normalize, iso_week_ends
 
 
 def get_recent_report_data():
@@ -70,8 +78,23 @@ def signin(request):
     return render_to_response('webapp/login.html', context)
 
 
+# Totals shown on the dashboard chart for each report date and the
+# ProgramReport fields which are added up for each of them
+DASHBOARD_CHART_TOTALS = {
+    'Atot': ('new_marasmic_patients', 'new_oedema_patients',
+             'new_relapsed_patients'),
+    'Tout': ('patients_transferred_out',),
+    'Dead': ('patient_deaths',),
+    'DefT': ('confirmed_patient_defaults', 'unconfirmed_patient_defaults'),
+    'Dcur': ('patients_cured',),
+    'Dmed': ('unresponsive_patients',),
+}
+
+
 def generate_dashboard_summary(qs, start_date,
                                end_date):  # qs is a django query set
+    # qs may be of ProgramReport or WeeklyProgramTotal, which have the same
+    # report_date and indicator fields
 
     def epoch(dat):
         """Convert datetime.date to unix epoch microseconds for JSON transmit
@@ -80,13 +103,15 @@ def generate_dashboard_summary(qs, start_date,
         diff = datetime.combine(dat, time()) - datetime(1970, 1, 1)
         return int(diff.total_seconds()) * 1000
 
-    totals = {}  # collect total information for each report date
-    for report in qs:
-        smry = DashboardChartSummaryItem(report).summary
-        try:
-            totals[report.report_date] += smry
-        except KeyError:
-            totals[report.report_date] = Totalizer(smry)
+    # collect total information for each report date, summed by the database
+    sums = dict(
+        ('sum_' + field, Sum(field))
+        for fields in DASHBOARD_CHART_TOTALS.values() for field in fields)
+    totals = {}
+    for row in qs.order_by().values('report_date').annotate(**sums):
+        totals[row['report_date']] = dict(
+            (key, sum(row['sum_' + field] or 0 for field in fields))
+            for key, fields in DASHBOARD_CHART_TOTALS.items())
 
     if not totals:  # an empty selection produces an empty chart
         return None
@@ -163,11 +188,11 @@ def dashboard(request):
     if request.method == 'POST' or initial_data:
 
         if request.method == 'POST':
-            year = str_to_int(request.POST.get('year', MAX_DATE.year))
+            year = str_to_int(request.POST.get('year', get_max_date().year))
             location_id = str_to_int(request.POST.get('location', 0))
             program_id = str_to_int(request.POST.get('program', 0))
         else:
-            year = str_to_int(initial_data.get('year', MAX_DATE.year))
+            year = str_to_int(initial_data.get('year', get_max_date().year))
             location_id = str_to_int(initial_data.get('location', 0))
             program_id = str_to_int(initial_data.get('program', 0))
 
@@ -184,7 +209,7 @@ def dashboard(request):
            year == date.today().year:
             response['latest_global_data'] = True
     else:
-        year = MAX_DATE.year
+        year = get_max_date().year
         programs = Program.objects.all()  # exclude(code='SFP')
         program_id = ''
         location = Location.root()
@@ -200,16 +225,13 @@ def dashboard(request):
         'program': program_id
     }
     request.session['filter_data'] = filter_data
+    programs = list(programs)
+    site_counts = LocationSiteCount.get_counts(location, programs, year)
     response['programs'] = []
     for program in programs:
         program_data = {'code': program.code,
-                        'description': program.description,
-                        'active_site_count': location.active_site_count(program,
-                                                                        year),
-                        'inactive_site_count': location.inactive_site_count(
-                            program, year),
-                        'reporting_site_count': location.reporting_site_count(
-                            program, year)}
+                        'description': program.description}
+        program_data.update(site_counts[program.pk])
         response['programs'].append(program_data)
 
     filter_set = ProgramReportFilterSet(filter_data)
@@ -221,36 +243,6 @@ def dashboard(request):
     )
 
 
-class DashboardChartSummaryItem(object):
-    def __init__(self, programreport):
-        # period = programreport.period_number
-
-        self.period_name = '{:%Y-%m-%d}'.format(programreport.report_date)
-
-        self.summary = {
-            'period_name': self.period_name,
-            # 'group_period_name': u'{} {}'.format(
-            # period_name, programreport.created.year),
-            'Atot': (programreport.new_marasmic_patients or 0) +
-                    (programreport.new_oedema_patients or 0) +
-                    (programreport.new_relapsed_patients or 0),
-            'Arel': programreport.readmitted_patients or 0,
-            'Tin': programreport.patients_transferred_in or 0,
-            'Tout': programreport.patients_transferred_out or 0,
-            'Dead': programreport.patient_deaths or 0,
-            'DefT': (programreport.confirmed_patient_defaults or 0) + (
-                programreport.unconfirmed_patient_defaults or 0),
-            'Dcur': programreport.patients_cured or 0,
-            'Dmed': programreport.unresponsive_patients or 0,
-            'End': programreport.patients_at_period_end or 0,
-        }
-
-        if programreport.pk:
-            self.summary['group_period_name'] = 'w{} {}'.format(
-                programreport.period_number,
-                programreport.report_date.year)
-
-
 class DashboardChartDataView(View):
     """View class for dashboard chart data.
     """
@@ -290,22 +282,48 @@ class DashboardChartDataView(View):
         location_id = check_initial(initial_data, 'location')
         if location_id is None:
             location_id = 1
-        location = Location.objects.filter(pk=location_id).first()
-        # If location not found, return an empty data set, otherwise find all
-        # descendant sites of the location and proceed.
-        if not isinstance(location, Location):
-            return JsonResponse({})
-        else:
-            sites = location.get_site_descendants()
 
-        result = ProgramReport.objects.filter(site__in=sites).filter(
-            report_date__gte=start_date).filter(report_date__lte=end_date)
+        entry = chartcache.get(year, location_id, program_id)
+        if entry is None:
+            location = Location.objects.filter(pk=location_id).first()
+            # If location not found, return an empty data set, otherwise use
+            # the weekly totals of all descendant sites of the location.
+            if not isinstance(location, Location):
+                return JsonResponse({})
 
-        if program_id is not None and program_id is not 0:
-            result = result.filter(program_id=program_id)
+            result = WeeklyProgramTotal.objects.filter(
+                location=location).filter(report_date__gte=start_date).filter(
+                report_date__lte=end_date)
 
-        ds = generate_dashboard_summary(result, start_date, end_date)
-        return JsonResponse(ds)
+            if program_id is not None and program_id is not 0:
+                result = result.filter(program_id=program_id)
+
+            ds = generate_dashboard_summary(result, start_date, end_date)
+            entry = chartcache.store(year, location_id, program_id,
+                                     json.dumps(ds, cls=DjangoJSONEncoder))
+
+        if self._not_modified(request, entry):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(entry['body'],
+                                    content_type='application/json')
+        # The data depends on the filter stored in the session, hence the
+        # revalidation on every request.
+        response['ETag'] = quote_etag(entry['etag'])
+        response['Last-Modified'] = http_date(entry['last_modified'])
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
+    @staticmethod
+    def _not_modified(request, entry):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            return entry['etag'] in parse_etags(if_none_match)
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE'))
+        return if_modified_since is not None and \
+            int(entry['last_modified']) <= if_modified_since
 
 
 class FilteredListView(ListView):